@@ -61,6 +61,42 @@ def create_navigation_bar(parent, window_controller, show_home_button=True):
     ttk.Separator(parent).pack(side="top", fill="x")
 
 
+def show_distribution(parent, data, value_format):
+    """Fill the parent frame with a distribution report, value_format turns a value into text"""
+    # Wipe the previous report
+    for child in parent.winfo_children():
+        child.destroy()
+
+    def text(value):
+        return "-" if value is None else value_format(value)
+
+    # Percentiles
+    tk.Label(parent, text="Percentiles", font=FONTS["m"]).grid(row=0, column=0, columnspan=2, sticky="nsew")
+    for row, (pct, value) in enumerate(data["percentiles"].items(), start=1):
+        tk.Label(parent, text=f"{pct}%: ", font=FONTS["s"]).grid(row=row, column=0, sticky="nse")
+        tk.Label(parent, text=text(value), font=FONTS["s"]).grid(row=row, column=1, sticky="nsw", padx=5)
+
+    # Equal sized buckets
+    tk.Label(parent, text=f"{len(data['buckets'])} equal buckets", font=FONTS["m"]).grid(row=0, column=2,
+                                                                                        columnspan=2, sticky="nsew")
+    for row, bucket in enumerate(data["buckets"], start=1):
+        tk.Label(parent, text=f"{text(bucket['lower'])} to {text(bucket['upper'])}: ",
+                 font=FONTS["s"]).grid(row=row, column=2, sticky="nse")
+        tk.Label(parent, text=str(bucket["count"]), font=FONTS["s"]).grid(row=row, column=3, sticky="nsw", padx=5)
+
+    # Bands
+    tk.Label(parent, text="Accounts per band", font=FONTS["m"]).grid(row=0, column=4, columnspan=2, sticky="nsew")
+    for row, band in enumerate(data["bands"], start=1):
+        if band["lower"] is None:
+            name = f"Under {value_format(band['upper'])}: "
+        elif band["upper"] is None:
+            name = f"{value_format(band['lower'])} and over: "
+        else:
+            name = f"{value_format(band['lower'])} to {value_format(band['upper'])}: "
+        tk.Label(parent, text=name, font=FONTS["s"]).grid(row=row, column=4, sticky="nse")
+        tk.Label(parent, text=str(band["count"]), font=FONTS["s"]).grid(row=row, column=5, sticky="nsw", padx=5)
+
+
 class ScrollableFrame(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
@@ -243,6 +279,14 @@ class LandingPage(PageBase):
                   command=lambda: controller.show_page(ReportOverdraft.__name__))
         self.overdraft_rep.pack(side="top", fill="x", pady=10)
 
+        self.projection_rep = tk.Button(reports_frame, text="Interest Projection", font=FONTS["m"],
+                  command=lambda: controller.show_page(ReportProjection.__name__))
+        self.projection_rep.pack(side="top", fill="x", pady=10)
+
+        self.geographic_rep = tk.Button(reports_frame, text="Geographic Report", font=FONTS["m"],
+                  command=lambda: controller.show_page(ReportGeographic.__name__))
+        self.geographic_rep.pack(side="top", fill="x", pady=10)
+
     def page_update(self):
         """Runs when the page is shown"""
         # Disable reports buttons if admin doesn't haven full rights
@@ -251,12 +295,16 @@ class LandingPage(PageBase):
             self.interest_rep.configure(state="normal")
             self.overdraft_rep.configure(state="normal")
             self.balance_rep.configure(state="normal")
+            self.projection_rep.configure(state="normal")
+            self.geographic_rep.configure(state="normal")
             self.rep_notif.configure(text="")
         else:
             self.full_rep.configure(state="disabled")
             self.interest_rep.configure(state="disabled")
             self.overdraft_rep.configure(state="disabled")
             self.balance_rep.configure(state="disabled")
+            self.projection_rep.configure(state="disabled")
+            self.geographic_rep.configure(state="disabled")
             self.rep_notif.configure(text="Only avilable for full admins.")
 class CustomerSearch(PageBase):
     """Search function for customers"""
@@ -2858,6 +2906,25 @@ class ReportAll(PageBase):
         self.customers = tk.Label(customers_frame, text="", font=FONTS["m"])
         self.customers.grid(row=row, column=1)
 
+        row += 1
+
+        # Customers without accounts
+        tk.Label(customers_frame, text="Without accounts: ", font=FONTS["m"]).grid(row=row, column=0, sticky="nse")
+
+        self.customers_empty = tk.Label(customers_frame, text="", font=FONTS["m"])
+        self.customers_empty.grid(row=row, column=1)
+
+        row += 1
+
+        # Largest customers, filled in when loaded
+        tk.Label(customers_frame, text="Highest total balances", font=FONTS["m"]).grid(row=row, column=0,
+                                                                                       columnspan=2, sticky="nsew")
+
+        row += 1
+
+        self.top_customers = tk.Frame(customers_frame)
+        self.top_customers.grid(row=row, column=0, columnspan=2, sticky="nsew")
+
     def load_interest(self):
         """Get interest report, then populate data fields"""
         data = SYSTEM.interest_report()
@@ -2902,9 +2969,26 @@ class ReportAll(PageBase):
 
     def load_customers(self):
         """Get the customers report and load the data onto the page"""
-        data = SYSTEM.customer_report()
+        data = SYSTEM.customer_report(top=5)
 
         self.customers.configure(text=str(data["customers_pop"]))
+        self.customers_empty.configure(text=str(data["without_accounts"]))
+
+        for child in self.top_customers.winfo_children():
+            child.destroy()
+
+        for row, customer in enumerate(data["top_by_balance"]):
+            tk.Label(self.top_customers, font=FONTS["s"],
+                     text=f"{customer['first_name']} {customer['last_name']} ({customer['accounts']} accounts): "
+                          f"£{round(customer['total_balance'] / 100, 2)}").grid(row=row, column=0, sticky="nsw")
+            tk.Button(self.top_customers, text="View Customer", font=FONTS["s"],
+                      command=lambda cid=customer["customer_id"]: self.view_customer(cid)).grid(row=row, column=1,
+                                                                                                sticky="nsew")
+
+    def view_customer(self, customer_id: int):
+        """Opens the customer page with the given customer loaded"""
+        self.controller.Pages[CustomerView.__name__].load_customer_info(customer_id)
+        self.controller.show_page(CustomerView.__name__)
 
     def show_account(self, accid):
         """Shows the account page with the given user loaded"""
@@ -2974,10 +3058,18 @@ class ReportInterest(PageBase):
         self.interest_low_button = tk.Button(interest_frame, text="View Account", font=FONTS["m"])
         self.interest_low_button.grid(row=row, column=2, sticky="nsew")
 
+        # Distribution of the rates
+        ttk.Separator(self).pack(side="top", fill="x", pady=5)
+        self.distribution_frame = tk.Frame(self)
+        self.distribution_frame.pack(side="top")
+
     def load_interest(self):
         """Get interest report, then populate data fields"""
         data = SYSTEM.interest_report()
 
+        show_distribution(self.distribution_frame, SYSTEM.distribution_report("interest_rate"),
+                          lambda value: str(round(value, 2)) + "%")
+
         self.interest_accounts.configure(text=str(data["accounts_pop"]))
         self.interest_total.configure(text="£" + str(round(data["interest_gained"] / 100, 2)))
         self.interest_mean.configure(text=str(round(data["mean"], 2)))
@@ -3053,10 +3145,19 @@ class ReportOverdraft(PageBase):
         self.overdraft_low_button = tk.Button(overdraft_frame, text="View Account", font=FONTS["m"])
         self.overdraft_low_button.grid(row=row, column=2, sticky="nsew")
 
+        # Distribution of how much of their overdraft accounts are using
+        ttk.Separator(self).pack(side="top", fill="x", pady=5)
+        tk.Label(self, text="Overdraft used", font=FONTS["m"]).pack(side="top", fill="x")
+        self.distribution_frame = tk.Frame(self)
+        self.distribution_frame.pack(side="top")
+
     def load_overdraft(self):
         """Load the overdraft data in"""
         data = SYSTEM.overdraft_report()
 
+        show_distribution(self.distribution_frame, SYSTEM.distribution_report("overdraft_utilisation"),
+                          lambda value: str(round(value * 100, 1)) + "%")
+
         self.overdraft_accounts.configure(text=str(data["accounts_pop"]))
         self.overdraft_total.configure(text="£" + str(round(data["total"] / 100, 2)))
         self.overdraft_mean.configure(text="£" + str(round(data["mean"] / 100, 2)))
@@ -3133,10 +3234,18 @@ class ReportBalance(PageBase):
         self.balance_low_button = tk.Button(balance_frame, text="View Account", font=FONTS["m"])
         self.balance_low_button.grid(row=row, column=2, sticky="nsew")
 
+        # Distribution of the balances
+        ttk.Separator(self).pack(side="top", fill="x", pady=5)
+        self.distribution_frame = tk.Frame(self)
+        self.distribution_frame.pack(side="top")
+
     def load_balance(self):
         """Get interest report, then populate data fields"""
         data = SYSTEM.balance_report()
 
+        show_distribution(self.distribution_frame, SYSTEM.distribution_report("balance"),
+                          lambda value: "£" + str(round(value / 100, 2)))
+
         self.balance_accounts.configure(text=str(data["accounts_pop"]))
         self.balance_total.configure(text="£" + str(round(data["total"] / 100, 2)))
         self.balance_mean.configure(text="£" + str(round(data["mean"] / 100, 2)))
@@ -3157,6 +3266,121 @@ class ReportBalance(PageBase):
         self.load_balance()
 
 
+class ReportProjection(PageBase):
+    """Projected balances with monthly compound interest"""
+    def __init__(self, parent, controller):
+        super().__init__(parent, controller)
+
+        create_navigation_bar(self, controller)
+
+        # Title
+        tk.Label(self, text="Interest Projection", font=FONTS["l"]).pack(side="top", fill="x", pady=5)
+
+        projection_frame = ScrollableFrame(self)
+        projection_frame.pack(side="top", fill="both", expand=True)
+
+        # Filled in when the report is loaded, the columns depend on the horizons
+        self.results_frame = projection_frame.widget_frame
+
+    def add_row(self, row, name, totals, horizons, font="m"):
+        """Add a row of projected totals to the table"""
+        tk.Label(self.results_frame, text=name, font=FONTS[font]).grid(row=row, column=0, sticky="nsw", padx=5)
+        tk.Label(self.results_frame, text=str(totals["accounts"]),
+                 font=FONTS[font]).grid(row=row, column=1, sticky="nse", padx=5)
+        tk.Label(self.results_frame, text="£" + str(round(totals["balance"] / 100, 2)),
+                 font=FONTS[font]).grid(row=row, column=2, sticky="nse", padx=5)
+
+        for column, months in enumerate(horizons, start=3):
+            tk.Label(self.results_frame, text="£" + str(round(totals["projected"][months] / 100, 2)),
+                     font=FONTS[font]).grid(row=row, column=column, sticky="nse", padx=5)
+
+    def load_projection(self):
+        """Get projection report, then populate the table"""
+        data = SYSTEM.interest_projection_report()
+
+        # Wipe the previous report
+        for child in self.results_frame.winfo_children():
+            child.destroy()
+
+        horizons = data["horizons"]
+        headings = ["", "Accounts", "Balance now"] + [f"{months} months" for months in horizons]
+
+        row = 0
+        for section, groups in (("Account type", data["by_type"]), ("Rate band", data["by_band"])):
+            tk.Label(self.results_frame, text=section, font=FONTS["l"]).grid(row=row, column=0, sticky="nsw",
+                                                                               pady=5)
+            row += 1
+
+            for column, heading in enumerate(headings):
+                tk.Label(self.results_frame, text=heading, font=FONTS["s"]).grid(row=row, column=column,
+                                                                                 sticky="nse", padx=5)
+            row += 1
+
+            for name, totals in groups.items():
+                self.add_row(row, name, totals, horizons)
+                row += 1
+
+            self.add_row(row, "Total", data["total"], horizons, font="l")
+            row += 1
+
+            ttk.Separator(self.results_frame).grid(row=row, column=0, columnspan=len(headings), sticky="ew", pady=5)
+            row += 1
+
+    def page_update(self):
+        """runs when the page is shown"""
+        self.load_projection()
+
+
+class ReportGeographic(PageBase):
+    """Customers, accounts and balances by city and postcode area"""
+    def __init__(self, parent, controller):
+        super().__init__(parent, controller)
+
+        create_navigation_bar(self, controller)
+
+        # Title
+        tk.Label(self, text="Geographic Report", font=FONTS["l"]).pack(side="top", fill="x", pady=5)
+
+        geographic_frame = ScrollableFrame(self)
+        geographic_frame.pack(side="top", fill="both", expand=True)
+
+        # Filled in when the report is loaded
+        self.results_frame = geographic_frame.widget_frame
+
+    def load_geographic(self):
+        """Get the largest cities and postcode areas, then populate the table"""
+        # Wipe the previous report
+        for child in self.results_frame.winfo_children():
+            child.destroy()
+
+        column = 0
+        for level, title in (("city", "Cities"), ("outward", "Postcode areas")):
+            data = SYSTEM.geographic_report(level=level, page_size=20)
+
+            tk.Label(self.results_frame, text=f"{title} ({data['total']})",
+                     font=FONTS["l"]).grid(row=0, column=column, columnspan=4, sticky="nsw", pady=5, padx=10)
+
+            for offset, heading in enumerate(("", "Customers", "Accounts", "Balance")):
+                tk.Label(self.results_frame, text=heading, font=FONTS["s"]).grid(row=1, column=column + offset,
+                                                                                 sticky="nse", padx=5)
+
+            for row, area in enumerate(data["areas"], start=2):
+                tk.Label(self.results_frame, text=area["area"], font=FONTS["m"]).grid(row=row, column=column,
+                                                                                       sticky="nsw", padx=5)
+                tk.Label(self.results_frame, text=str(area["customers"]),
+                         font=FONTS["m"]).grid(row=row, column=column + 1, sticky="nse", padx=5)
+                tk.Label(self.results_frame, text=str(area["accounts"]),
+                         font=FONTS["m"]).grid(row=row, column=column + 2, sticky="nse", padx=5)
+                tk.Label(self.results_frame, text="£" + str(round(area["total_balance"] / 100, 2)),
+                         font=FONTS["m"]).grid(row=row, column=column + 3, sticky="nse", padx=5)
+
+            column += 4
+
+    def page_update(self):
+        """runs when the page is shown"""
+        self.load_geographic()
+
+
 if __name__ == "__main__":
     win = Window()
     win.mainloop()
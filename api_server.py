@@ -0,0 +1,543 @@
+import asyncio
+import json
+import re
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import bank
+from metrics import metrics, start_metrics_server
+from sessions import SessionManager
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 4
+
+# Largest request body that will be read (bytes)
+MAX_BODY = 1024 * 1024
+
+HTTP_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+                404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+                500: "Internal Server Error"}
+
+
+# Converting the system classes into json friendly data
+def customer_to_dict(customer) -> dict:
+    """Turn a Customer into a dict"""
+    if customer is None:
+        return None
+    return {"id": customer.customer_id, "first_name": customer.first_name, "last_name": customer.last_name,
+            "address": customer.address}
+
+
+def account_to_dict(account) -> dict:
+    """Turn a BankAccount into a dict"""
+    if account is None:
+        return None
+    return {"id": account.account_id, "account_name": account.account_name, "account_number": account.account_num,
+            "balance": account.balance, "interest_rate": account.interest_rate,
+            "overdraft_limit": account.overdraft_limit, "customer_id": account.customer.customer_id}
+
+
+def to_json_data(value):
+    """Recursively convert the values returned by the BankingSystem into json friendly data"""
+    if isinstance(value, bank.BankAccount):
+        return account_to_dict(value)
+    if isinstance(value, bank.Customer):
+        return customer_to_dict(value)
+    if isinstance(value, dict):
+        return {key: to_json_data(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_data(val) for val in value]
+    return value
+
+
+def result_to_response(result, *names) -> tuple:
+    """Turn the (status, reply, ...) tuples returned by the system into a http status and json body.
+    The decorators return a plain string when the admin is not allowed to run the function."""
+    if isinstance(result, str):
+        if "full access" in result:
+            return 403, {"ok": False, "message": result}
+        return 401, {"ok": False, "message": result}
+
+    if not isinstance(result, tuple):
+        return 200, {"ok": True, "data": to_json_data(result)}
+
+    body = {"ok": bool(result[0]), "message": result[1]}
+    for name, value in zip(names, result[2:]):
+        body[name] = to_json_data(value)
+
+    return (200 if result[0] else 400), body
+
+
+def read_fields(body: dict, fields: dict, required=()) -> dict:
+    """Check the body only has the given fields (name -> type) and convert them, None values are left as they are
+    unless the field is required. Raises ValueError for anything else, which is returned as a 400."""
+    unknown = sorted(set(body) - set(fields))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    missing = [name for name in required if body.get(name) is None]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+
+    values = {}
+    for name, value in body.items():
+        kind = fields[name]
+        if value is None:
+            values[name] = None
+        elif kind is list:
+            # An address, its lines in order
+            if not isinstance(value, list) or len(value) != ADDRESS_LINES or \
+                    not all(line is None or isinstance(line, str) for line in value):
+                raise ValueError(f"{name} must be a list of {ADDRESS_LINES} strings")
+            values[name] = value
+        elif kind is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"{name} must be true or false")
+            values[name] = value
+        elif isinstance(kind, tuple):
+            # One of a set of options
+            if value not in kind:
+                raise ValueError(f"{name} must be one of {', '.join(kind)}")
+            values[name] = value
+        elif isinstance(value, (dict, list, bool)):
+            raise ValueError(f"{name} must be a {kind.__name__}")
+        else:
+            values[name] = kind(value)
+    return values
+
+
+def read_amount(body: dict) -> int:
+    """The amount of a deposit, withdrawal or transfer, a positive whole number of pence"""
+    amount = body.get("amount")
+    if isinstance(amount, str) and amount.strip().isdigit():
+        amount = int(amount)
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        raise ValueError("amount must be a positive whole number of pence")
+    return amount
+
+
+# Fields the customer and account routes take, and their types. list is an address (see read_fields).
+ADDRESS_LINES = 5
+COMPARISONS = ("=", ">", "<")
+CUSTOMER_SEARCH_FIELDS = {"cid": int, "fname": str, "lname": str, "addr": list, "must_include_all": bool,
+                          "exact": bool, "get_all": bool}
+CUSTOMER_FIELDS = {"fname": str, "lname": str, "addr": list}
+ACCOUNT_CREATE_FIELDS = {"account_name": str, "interest_rate": float, "overdraft_limit": int, "customer_id": int,
+                         "account_num": int}
+ACCOUNT_SEARCH_FIELDS = {"cust_first": str, "cust_last": str, "get_all": bool, "accid": int, "account_name": str,
+                         "account_number": int, "cust_id": int, "balance": int, "balance_opts": COMPARISONS,
+                         "interest_rate": float, "interest_opts": COMPARISONS, "overdraft_limit": int,
+                         "overdraft_opts": COMPARISONS, "must_include_all": bool, "exact_fields": bool}
+ACCOUNT_UPDATE_FIELDS = {"account_name": str, "overdraft_limit": int, "interest_rate": float}
+
+
+# Route handlers, each takes (system, token, match, query, body) and returns (http status, json body)
+# They run on the executor threads.
+def handle_open_session(system, token, match, query, body):
+    stat, reply = system.open_session(body.get("username", ""), body.get("password", ""))
+    if stat:
+        return 201, {"ok": True, "token": reply}
+    return 401, {"ok": False, "message": reply}
+
+
+def handle_close_session(system, token, match, query, body):
+    return result_to_response(system.close_session(token))
+
+
+def handle_search_customers(system, token, match, query, body):
+    values = read_fields(body, CUSTOMER_SEARCH_FIELDS)
+    if values.get("addr") is None:
+        values["addr"] = [None] * ADDRESS_LINES
+    customers = system.search_customers(session=token, **values)
+    if isinstance(customers, str):
+        return result_to_response(customers)
+    return 200, {"ok": True, "message": customers[1], "customers": to_json_data(customers[0])}
+
+
+def handle_get_customer(system, token, match, query, body):
+    data = system.get_customer_data(int(match.group(1)), session=token)
+    if isinstance(data, str):
+        return result_to_response(data)
+    if data["customer"] is None:
+        return 404, {"ok": False, "message": "Customer not found."}
+    return 200, {"ok": True, "data": to_json_data(data)}
+
+
+def handle_create_customer(system, token, match, query, body):
+    values = read_fields(body, CUSTOMER_FIELDS, required=CUSTOMER_FIELDS)
+    if None in values["addr"]:
+        raise ValueError(f"addr must be a list of {ADDRESS_LINES} strings")
+    result = system.create_new_customer(values["fname"], values["lname"], values["addr"], session=token)
+    status, response = result_to_response(result, "customer_id")
+    return (201 if status == 200 else status), response
+
+
+def handle_update_customer(system, token, match, query, body):
+    values = read_fields(body, CUSTOMER_FIELDS)
+    if values.get("addr") is None:
+        values["addr"] = [None] * ADDRESS_LINES
+    result = system.update_customer(int(match.group(1)), session=token, **values)
+    return result_to_response(result, "customer")
+
+
+def handle_delete_customer(system, token, match, query, body):
+    return result_to_response(system.delete_customer(int(match.group(1)), session=token))
+
+
+def handle_search_accounts(system, token, match, query, body):
+    accounts = system.search_accounts(session=token, **read_fields(body, ACCOUNT_SEARCH_FIELDS))
+    if isinstance(accounts, str):
+        return result_to_response(accounts)
+    return 200, {"ok": True, "message": accounts[1], "accounts": to_json_data(accounts[0])}
+
+
+def handle_get_account(system, token, match, query, body):
+    account = system.get_account_data(int(match.group(1)), session=token)
+    if isinstance(account, str):
+        return result_to_response(account)
+    if account is None:
+        return 404, {"ok": False, "message": "Account not found."}
+    return 200, {"ok": True, "account": account_to_dict(account)}
+
+
+def handle_create_account(system, token, match, query, body):
+    values = read_fields(body, ACCOUNT_CREATE_FIELDS,
+                         required=("account_name", "interest_rate", "overdraft_limit", "customer_id"))
+    result = system.create_new_account(values["account_name"], values["interest_rate"], values["overdraft_limit"],
+                                       values["customer_id"], account_num=values.get("account_num"), session=token)
+    status, response = result_to_response(result, "account_id")
+    return (201 if status == 200 else status), response
+
+
+def handle_update_account(system, token, match, query, body):
+    return result_to_response(system.update_account(int(match.group(1)), session=token,
+                                                    **read_fields(body, ACCOUNT_UPDATE_FIELDS)), "account")
+
+
+def handle_delete_account(system, token, match, query, body):
+    return result_to_response(system.delete_account(int(match.group(1)), session=token))
+
+
+def handle_deposit(system, token, match, query, body):
+    return result_to_response(system.deposit(int(match.group(1)), read_amount(body),
+                                             idempotency_key=body.get("idempotency_key"), session=token))
+
+
+def handle_withdraw(system, token, match, query, body):
+    return result_to_response(system.withdraw(int(match.group(1)), read_amount(body),
+                                              idempotency_key=body.get("idempotency_key"), session=token))
+
+
+def handle_transfer(system, token, match, query, body):
+    return result_to_response(system.transfer(int(body.get("from_acc_num")), int(body.get("to_acc_num")),
+                                              read_amount(body), idempotency_key=body.get("idempotency_key"),
+                                              session=token))
+
+
+def handle_batch_transfer(system, token, match, query, body):
+    transfers = [(int(item[0]), int(item[1]), int(item[2])) for item in body.get("transfers", [])]
+    results = system.batch_transfer(transfers, session=token)
+    if isinstance(results, str):
+        return result_to_response(results)
+    return 200, {"ok": True, "results": [{"ok": stat, "message": reply} for stat, reply in results]}
+
+
+REPORTS = {"interest": "interest_report", "balance": "balance_report",
+           "overdraft": "overdraft_report", "customer": "customer_report",
+           "overdraft_risk": "overdraft_risk_report", "customer_rollup": "customer_rollup_report",
+           "geographic": "geographic_report"}
+# Query string parameters each report takes, and their types
+REPORT_PARAMS = {"customer": {"top": int},
+                 "overdraft_risk": {"top": int, "near_limit": float},
+                 "customer_rollup": {"sort": str, "page": int, "page_size": int, "min_accounts": int},
+                 "geographic": {"level": str, "sort": str, "page": int, "page_size": int}}
+
+
+def handle_report(system, token, match, query, body):
+    if match.group(1) not in REPORTS:
+        return 404, {"ok": False, "message": "Unknown report."}
+
+    params = {name: convert(query[name]) for name, convert in REPORT_PARAMS.get(match.group(1), {}).items()
+              if name in query}
+    report = getattr(system, REPORTS[match.group(1)])(session=token, **params)
+    if isinstance(report, str):
+        return result_to_response(report)
+    return 200, {"ok": True, "report": to_json_data(report)}
+
+
+# (http method, path regex, handler, needs a session token)
+ROUTES = [
+    ("POST", r"/session", handle_open_session, False),
+    ("DELETE", r"/session", handle_close_session, True),
+    ("POST", r"/customers/search", handle_search_customers, True),
+    ("POST", r"/customers", handle_create_customer, True),
+    ("GET", r"/customers/(\d+)", handle_get_customer, True),
+    ("PATCH", r"/customers/(\d+)", handle_update_customer, True),
+    ("DELETE", r"/customers/(\d+)", handle_delete_customer, True),
+    ("POST", r"/accounts/search", handle_search_accounts, True),
+    ("POST", r"/accounts", handle_create_account, True),
+    ("GET", r"/accounts/(\d+)", handle_get_account, True),
+    ("PATCH", r"/accounts/(\d+)", handle_update_account, True),
+    ("DELETE", r"/accounts/(\d+)", handle_delete_account, True),
+    ("POST", r"/accounts/(\d+)/deposit", handle_deposit, True),
+    ("POST", r"/accounts/(\d+)/withdraw", handle_withdraw, True),
+    ("POST", r"/transfer", handle_transfer, True),
+    ("POST", r"/transfer/batch", handle_batch_transfer, True),
+    ("GET", r"/reports/(\w+)", handle_report, True),
+]
+ROUTES = [(method, re.compile(path + "$"), handler, needs_session) for method, path, handler, needs_session in ROUTES]
+# Routes that take an idempotency key
+IDEMPOTENT_HANDLERS = (handle_deposit, handle_withdraw, handle_transfer)
+
+
+class ApiServer:
+    """Serves the BankingSystem over HTTP/JSON.
+    Database work runs on a thread pool, each worker thread has its own BankingSystem (and so its own sqlite
+    connection) but they all share one SessionManager, so a token works whichever worker handles the request."""
+    def __init__(self, db_filepath="Files/Data/data.db", host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 workers=DEFAULT_WORKERS):
+        self.db_filepath = db_filepath
+        self.host = host
+        self.port = port
+
+        self.sessions = SessionManager()
+
+        self.worker_state = threading.local()
+        self.systems = []  # Every system made by the workers, so they can be closed on shutdown
+        self.systems_lock = threading.Lock()
+
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bank-worker")
+
+        # Requests that have been handed to the executor and not finished yet
+        self.in_flight = 0
+
+        self.server = None
+
+        metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self) -> list:
+        """Worker pool numbers for the metrics registry"""
+        with self.systems_lock:
+            connections = len(self.systems)
+
+        return [("bank_pool_workers", "gauge", "Worker threads in the api server pool.", [({}, self.workers)]),
+                ("bank_pool_connections", "gauge", "Database connections opened by the pool.", [({}, connections)]),
+                ("bank_pool_in_flight", "gauge", "Requests waiting for or running on the pool.",
+                 [({}, self.in_flight)]),
+                ("bank_pool_queued", "gauge", "Requests waiting for a free worker.",
+                 [({}, self.executor._work_queue.qsize())]),
+                ("bank_sessions_active", "gauge", "Session tokens that have not expired.",
+                 [({}, self.sessions.active_sessions())])]
+
+    def worker_system(self) -> bank.BankingSystem:
+        """Return the BankingSystem belonging to the current worker thread, creating it on first use"""
+        system = getattr(self.worker_state, "system", None)
+        if system is None:
+            system = bank.BankingSystem(db_filepath=self.db_filepath)
+            system.sessions = self.sessions
+            self.worker_state.system = system
+
+            with self.systems_lock:
+                self.systems.append(system)
+        return system
+
+    def run_handler(self, handler, token, match, query, body) -> tuple:
+        """Run a route handler on the current (worker) thread"""
+        try:
+            return handler(self.worker_system(), token, match, query, body)
+        except (TypeError, ValueError) as e:
+            return 400, {"ok": False, "message": f"Bad request data. {str(e)}"}
+        except Exception as e:
+            print(f"Error while handling request: {str(e)}")
+            return 500, {"ok": False, "message": "An error occurred when handling the request."}
+
+    async def dispatch(self, method: str, target: str, headers: dict, raw_body: bytes) -> tuple:
+        """Find the route for the request and run it on the executor"""
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            body = json.loads(raw_body.decode('utf-8')) if raw_body else {}
+        except ValueError:
+            return 400, {"ok": False, "message": "Request body must be JSON."}
+
+        if not isinstance(body, dict):
+            return 400, {"ok": False, "message": "Request body must be a JSON object."}
+
+        path_found = False
+        for route_method, path, handler, needs_session in ROUTES:
+            match = path.match(url.path)
+            if match is None:
+                continue
+
+            path_found = True
+            if route_method != method:
+                continue
+
+            token = None
+            auth = headers.get("authorization", "")
+            if auth.startswith("Bearer "):
+                token = auth[len("Bearer "):].strip()
+
+            if needs_session and not token:
+                return 401, {"ok": False, "message": "Session token required."}
+
+            # Idempotency keys can be sent as a header as well as in the body, only the balance changes take them
+            if handler in IDEMPOTENT_HANDLERS and "idempotency-key" in headers:
+                body.setdefault("idempotency_key", headers["idempotency-key"])
+
+            loop = asyncio.get_running_loop()
+            self.in_flight += 1
+            try:
+                return await loop.run_in_executor(self.executor, self.run_handler, handler, token, match, query, body)
+            finally:
+                self.in_flight -= 1
+
+        if path_found:
+            return 405, {"ok": False, "message": "Method not allowed."}
+        return 404, {"ok": False, "message": "Not found."}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Read requests off a connection until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.write_response(writer, 400, {"ok": False, "message": "Bad request line."}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0) or 0)
+                if length > MAX_BODY:
+                    await self.write_response(writer, 413, {"ok": False, "message": "Body too large."}, False)
+                    break
+                raw_body = await reader.readexactly(length) if length else b""
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+                status, response = await self.dispatch(method.upper(), target, headers, raw_body)
+                await self.write_response(writer, status, response, keep_alive)
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def write_response(writer: asyncio.StreamWriter, status: int, response: dict, keep_alive: bool):
+        """Send a json response"""
+        data = json.dumps(response).encode('utf-8')
+        head = f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n" \
+               f"Content-Type: application/json\r\n" \
+               f"Content-Length: {len(data)}\r\n" \
+               f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        writer.write(head.encode('latin-1') + data)
+        await writer.drain()
+
+    async def start(self):
+        """Start listening for connections"""
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        # Pick up the real port if 0 was given
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        """Start the server and run until cancelled"""
+        await self.start()
+        print(f"Serving the banking system on http://{self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        """Stop the server, workers and close the database connections"""
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=True)
+        metrics.remove_collector(self.collect_metrics)
+
+        with self.systems_lock:
+            for system in self.systems:
+                system.connection.close_connection()
+            self.systems = []
+
+
+class ApiClient:
+    """Small blocking client for the api server, mainly for scripts and load testing"""
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=30):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.token = None
+
+    def request(self, method: str, path: str, body: dict = None) -> tuple:
+        """Send a request and return the (http status, json body)"""
+        headers = {"Content-Type": "application/json"}
+        if self.token is not None:
+            headers["Authorization"] = "Bearer " + self.token
+
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        self.conn.request(method, path, body=data, headers=headers)
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+
+    def login(self, username: str, password: str) -> tuple:
+        """Open a session and use its token for the following requests"""
+        status, body = self.request("POST", "/session", {"username": username, "password": password})
+        if body["ok"]:
+            self.token = body["token"]
+            return True, ""
+        return False, body["message"]
+
+    def logout(self):
+        """Close the session"""
+        status, body = self.request("DELETE", "/session")
+        self.token = None
+        return body["ok"], body["message"]
+
+    def close(self):
+        """Close the connection to the server"""
+        self.conn.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the banking system over HTTP/JSON.")
+    parser.add_argument("--db", default="Files/Data/data.db", help="Database file to use.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of threads (and database connections) to run queries on.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics.")
+    args = parser.parse_args()
+
+    server = ApiServer(db_filepath=args.db, host=args.host, port=args.port, workers=args.workers)
+
+    if args.metrics_port is not None:
+        start_metrics_server(args.host, args.metrics_port)
+        print(f"Serving metrics on http://{args.host}:{args.metrics_port}/metrics")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("Stopping.")
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
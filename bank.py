@@ -1,73 +1,244 @@
 from accounts import Customer, Admin, BankAccount
 from connection import Connection
 
+from sessions import SessionManager
+from metrics import metrics
+from profiling import profiler
+from report_cache import report_cache
+import interest
+import distributions
+import export
+import importer
+
+import functools
+import os
 from random import randint
+import threading
+from time import perf_counter
+
+# Password hashing settings. Changing these only affects new hashes, old hashes are still verified
+# and get upgraded the next time the admin logs in.
+HASH_ALGORITHM = "pbkdf2-sha512"
+HASH_COSTS = {"pbkdf2-sha512": 100000,  # Iterations
+              "scrypt": "16384:8:1"}  # n:r:p
+HASH_SALT_BYTES = 32
+
+
+def is_valid_amount(amount) -> bool:
+    """Amounts of money moved are a positive whole number of pence"""
+    return isinstance(amount, int) and not isinstance(amount, bool) and amount > 0
 
 
 # Decorators
+# Both decorators take an optional session= keyword with a token from BankingSystem.open_session.
+# With a session the call runs as that sessions admin, without one the instance login (self.logged_in) is used.
+# Calls made from inside a decorated method run as the same admin as the outer call.
+def _run_as_session_admin(self, function, args, kwargs, check_rights):
+    """Work out the admin for this call, check their rights and run the function as them"""
+    token = kwargs.pop("session", None)
+    outer_admin = getattr(self.context, "admin", None)
+
+    if token is not None:
+        admin = self.sessions.get_admin(token)
+        if admin is None:
+            return "Session is invalid or has expired."
+    elif outer_admin is not None:
+        admin = outer_admin
+    elif self.logged_in:
+        admin = self.admin
+    else:
+        return "Admin log-on required."
+
+    if check_rights and not admin.has_full_rights():
+        return "Admin must have full access rights."
+
+    self.context.admin = admin
+    self.context.session = token if token is not None else getattr(self.context, "session", None)
+    try:
+        return function(self, *args, **kwargs)
+    finally:
+        if outer_admin is None:
+            self.context.admin = None
+            self.context.session = None
+
+
+def _record_metrics(name, call):
+    """Run the call and record how long it took and how it went"""
+    start = perf_counter()
+    try:
+        result = call()
+    except Exception:
+        metrics.record_call(name, perf_counter() - start, "error")
+        raise
+
+    if isinstance(result, str):
+        # The decorators return a string when the admin is not allowed to run the function
+        outcome = "denied"
+    elif isinstance(result, tuple) and len(result) > 0 and result[0] is False:
+        outcome = "failed"
+    else:
+        outcome = "ok"
+
+    metrics.record_call(name, perf_counter() - start, outcome)
+    return result
+
+
+def _instrumented_call(name, call):
+    """Run the call through whichever of the profiler and metrics are switched on"""
+    if profiler.enabled:
+        unprofiled_call = call
+        call = lambda: profiler.run(name, unprofiled_call)
+
+    if metrics.enabled:
+        return _record_metrics(name, call)
+    return call()
+
+
 def require_login(function):
-    # Only allows the function to run if the logged_in attr is True
+    # Only allows the function to run if there is a logged in admin for this call
+    @functools.wraps(function)
     def wrapper(self, *args, **kwargs):
-        if self.logged_in:
-            return function(self, *args, **kwargs)
-        return "Admin log-on required."
+        if metrics.enabled or profiler.enabled:
+            return _instrumented_call(function.__name__,
+                                      lambda: _run_as_session_admin(self, function, args, kwargs, False))
+        return _run_as_session_admin(self, function, args, kwargs, False)
     return wrapper
 
 
 def require_full_rights(function):
-    # Only allows the function to run if the logged_in attr is true and the admin attr has full rights
+    # Only allows the function to run if there is a logged in admin for this call and they have full rights
+    @functools.wraps(function)
     def wrapper(self, *args, **kwargs):
-        if self.logged_in:
-            if self.admin.has_full_rights():
-                return function(self, *args, **kwargs)
-            else:
-                return "Admin must have full access rights."
-        else:
-            return "Admin log-on required."
+        if metrics.enabled or profiler.enabled:
+            return _instrumented_call(function.__name__,
+                                      lambda: _run_as_session_admin(self, function, args, kwargs, True))
+        return _run_as_session_admin(self, function, args, kwargs, True)
+    return wrapper
+
+
+def record_metrics(function):
+    # Records metrics (and profiles) for methods that don't need a login, e.g. login itself
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if metrics.enabled or profiler.enabled:
+            return _instrumented_call(function.__name__, lambda: function(self, *args, **kwargs))
+        return function(self, *args, **kwargs)
+    return wrapper
+
+
+def cached_report(function):
+    # Returns the cached result while the accounts and customers haven't changed, goes under require_login
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if not report_cache.enabled:
+            return function(self, *args, **kwargs)
+        key = (self.db_filepath, function.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # e.g. a list argument, just run the report
+            return function(self, *args, **kwargs)
+        return report_cache.get(key, self.connection.get_data_version(), lambda: function(self, *args, **kwargs))
     return wrapper
 
 
 class BankingSystem:
     """Class that handles the banking system"""
-    def __init__(self, db_filepath="Files/Data/data.db"):
-        self.connection = Connection(db_filepath=db_filepath)
+    def __init__(self, db_filepath="Files/Data/data.db", commit_batch_size: int = 1):
+        # commit_batch_size > 1 groups balance changes into fewer commits, see Connection.flush
+        self.connection = Connection(db_filepath=db_filepath, commit_batch_size=commit_batch_size)
+        # Reports are cached per database
+        self.db_filepath = os.path.abspath(db_filepath)
 
         self.logged_in = False
         self.admin = None
 
+        # Session tokens let one instance serve many admins at once
+        self.sessions = SessionManager()
+        # Holds the admin (and session) of the call currently running on this thread
+        self.context = threading.local()
+
+    def current_admin(self):
+        """Return the admin the current call is running as"""
+        admin = getattr(self.context, "admin", None)
+        if admin is not None:
+            return admin
+        return self.admin
+
     # Hashing systems
     # adapted from https://www.vitoshacademy.com/hashing-passwords-in-python/
+    # Stored hashes are in the form $<algorithm>$<cost>$<salt>$<hash>, hashes without the leading $ are
+    # the original format (128 hex char salt followed by a pbkdf2-sha512 hash at 100000 iterations)
     @staticmethod
-    def hash_password(password):
+    def hash_password(password, algorithm=None, cost=None):
         """Hash&salt a string"""
-        import hashlib, binascii, os
+        import binascii, os
+
+        if algorithm is None:
+            algorithm = HASH_ALGORITHM
+
+        if cost is None:
+            cost = HASH_COSTS[algorithm]
+
         # Generate random salt
-        salt = hashlib.sha3_512(os.urandom(60)).hexdigest().encode('ascii')
+        salt = binascii.hexlify(os.urandom(HASH_SALT_BYTES)).decode('ascii')
+
+        pwdhash = BankingSystem._derive_hash(password, algorithm, cost, salt)
+
+        # Return the self describing hash
+        return f"${algorithm}${cost}${salt}${pwdhash}"
 
-        # Hash password and salt
-        pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'),
-                                      salt, 100000)
+    @staticmethod
+    def _derive_hash(password, algorithm, cost, salt):
+        """Run the given algorithm at the given cost and return the hex digest"""
+        import hashlib, binascii
+
+        if algorithm == "pbkdf2-sha512":
+            pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'),
+                                          salt.encode('ascii'), int(cost))
+        elif algorithm == "scrypt":
+            # Cost is stored as n:r:p
+            n, r, p = [int(part) for part in cost.split(":")]
+            pwdhash = hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('ascii'),
+                                     n=n, r=r, p=p, maxmem=128 * n * r * p + 1024 * 1024, dklen=64)
+        else:
+            raise ValueError(f"Unknown hashing algorithm: {algorithm}")
 
-        pwdhash = binascii.hexlify(pwdhash)
-        # Return hash
-        return (salt + pwdhash).decode('ascii')
+        return binascii.hexlify(pwdhash).decode('ascii')
+
+    @staticmethod
+    def _split_hash(stored_hash):
+        """Separate a stored hash into its algorithm, cost, salt and hash"""
+        if stored_hash.startswith("$"):
+            # Skip the empty string before the first $
+            algorithm, cost, salt, pwdhash = stored_hash.split("$")[1:]
+            return algorithm, cost, salt, pwdhash
+
+        # Original format, salt is the first 128 chars
+        return "pbkdf2-sha512", "100000", stored_hash[:128], stored_hash[128:]
 
     @staticmethod
     def verify_hash(stored_hash, password):
         """Hash the password and compared with the stored data"""
-        import hashlib
-        import binascii
-        # Separate the salt and hash
-        salt = stored_hash[:128]
-        stored_hash = stored_hash[128:]
+        import hmac
+
+        try:
+            algorithm, cost, salt, stored_hash = BankingSystem._split_hash(stored_hash)
+            passhash = BankingSystem._derive_hash(password, algorithm, cost, salt)
+        except ValueError as e:
+            print(str(e))
+            return False
 
-        # Hash the provided password
-        passhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'),
-                                      salt.encode('ascii'),
-                                      100000)
-        passhash = binascii.hexlify(passhash).decode('ascii')
+        return hmac.compare_digest(stored_hash, passhash)
 
-        return stored_hash == passhash
+    @staticmethod
+    def needs_rehash(stored_hash) -> bool:
+        """Check if the stored hash was made with something other than the current algorithm and cost"""
+        if not stored_hash.startswith("$"):
+            return True
+
+        algorithm, cost, salt, pwdhash = BankingSystem._split_hash(stored_hash)
+        return algorithm != HASH_ALGORITHM or cost != str(HASH_COSTS[HASH_ALGORITHM])
 
     # Admin and login control
     @require_full_rights
@@ -95,33 +266,67 @@ class BankingSystem:
 
         return self.connection.create_admin_account(fname, lname, addr, username, hash_res, rights)
 
-    def login(self, username, password) -> tuple:
-        """verify login details and then set the admin"""
+    def authenticate(self, username, password) -> tuple:
+        """verify login details and return the admin"""
 
         if not self.connection.connected:
-            return False, "Connection to database could not be established."
+            return None, "Connection to database could not be established."
 
         # Fetch the admin class
         admin, reply = self.connection.get_admin(username=username)  # Returns the admin class
         if len(admin) > 1:
-            return False, "Bad information received from the database."
+            return None, "Bad information received from the database."
         elif len(admin) < 1:
-            return False, "Login credentials are invalid."
+            return None, "Login credentials are invalid."
         else:
             admin = admin[0]  # Turn list into single element
 
         if self.verify_hash(admin.get_password(), password):
-            self.admin = admin
-            self.logged_in = True
-            return True, ""
+            # Upgrade old or outdated hashes now that we know the password
+            if self.needs_rehash(admin.get_password()):
+                new_hash = self.hash_password(password)
+                stat, reply = self.connection.update_admin_password(admin.admin_id, new_hash)
+                if stat:
+                    admin.set_password(new_hash)
+
+            return admin, ""
         else:
-            return False, "Login credentials are invalid."
+            return None, "Login credentials are invalid."
+
+    @record_metrics
+    def login(self, username, password) -> tuple:
+        """verify login details and then set the admin"""
+        admin, reply = self.authenticate(username, password)
+
+        if admin is None:
+            return False, reply
+
+        self.admin = admin
+        self.logged_in = True
+        return True, ""
 
     def log_out(self):
         """Changes log in status and connected admin"""
         self.admin = None
         self.logged_in = False
 
+    @record_metrics
+    def open_session(self, username, password) -> tuple:
+        """Verify login details once and return a session token to pass as session= to other calls"""
+        admin, reply = self.authenticate(username, password)
+
+        if admin is None:
+            return False, reply
+
+        return True, self.sessions.issue(admin)
+
+    @record_metrics
+    def close_session(self, token) -> tuple:
+        """End a session so its token can no longer be used"""
+        if self.sessions.revoke(token):
+            return True, ""
+        return False, "Session is invalid or has expired."
+
     # Account and customer control
     @require_login
     def generate_new_account_number(self) -> int:
@@ -166,7 +371,14 @@ class BankingSystem:
     @require_login
     def update_admin(self, adid, **kwargs):
         """Update the admin account"""
-        return self.connection.update_admin(adid, **kwargs)
+        stat, reply, admin = self.connection.update_admin(adid, **kwargs)
+
+        # Keep the session copy of the admin up to date if they updated themselves
+        session = getattr(self.context, "session", None)
+        if stat and session is not None and admin.admin_id == self.current_admin().admin_id:
+            self.sessions.update_admin(session, admin)
+
+        return stat, reply, admin
 
     @require_login
     def update_admin_password(self, old, new, new_conf):
@@ -175,12 +387,18 @@ class BankingSystem:
         if new != new_conf:
             return False, "New passwords dont match."
 
-        if not self.verify_hash(self.admin.password, old):
+        admin = self.current_admin()
+
+        if not self.verify_hash(admin.password, old):
             return False, "Invalid password provided."
 
         new_hash = self.hash_password(new)
 
-        return self.connection.update_admin_password(self.admin.admin_id, new_hash)
+        stat, reply = self.connection.update_admin_password(admin.admin_id, new_hash)
+        if stat:
+            admin.set_password(new_hash)
+
+        return stat, reply
 
     @require_login
     def delete_account(self, accid):
@@ -203,32 +421,32 @@ class BankingSystem:
         return self.connection.delete_customer(cid)
 
     @require_login
-    def withdraw(self, acc_id: int, amount: int):
-        """Withdraw money from an account"""
-
-        balance, reply = self.connection.get_balance(account_id=acc_id)
-        overdraft, reply = self.connection.get_overdraft(account_id=acc_id)
+    def withdraw(self, acc_id: int, amount: int, idempotency_key: str = None):
+        """Withdraw money from an account.
+        Retrying with the same idempotency_key returns the first result instead of withdrawing again."""
+        if not is_valid_amount(amount):
+            return False, "Amount must be a positive number of pence"
 
-        new_bal = balance - amount
-
-        if new_bal < 0 - overdraft:
-            return False, "Insufficient funds available"
-        else:
-            return self.connection.change_balance(new_bal, account_id=acc_id)
+        # The overdraft limit is checked by the update itself
+        return self.connection.apply_balance_change(acc_id, -amount, "withdraw", idempotency_key=idempotency_key)
 
     @require_login
-    def deposit(self, acc_id: int, amount: int):
-        """Add money to the account"""
-
-        balance, reply = self.connection.get_balance(account_id=acc_id)
-
-        new_bal = balance + amount
+    def deposit(self, acc_id: int, amount: int, idempotency_key: str = None):
+        """Add money to the account.
+        Retrying with the same idempotency_key returns the first result instead of depositing again."""
+        if not is_valid_amount(amount):
+            return False, "Amount must be a positive number of pence"
 
-        return self.connection.change_balance(new_bal, account_id=acc_id)
+        return self.connection.apply_balance_change(acc_id, amount, "deposit", idempotency_key=idempotency_key)
 
     @require_login
-    def transfer(self, from_acc_num: int, to_acc_num: int, amount: int) -> tuple:
-        """Transfer money from one account to another"""
+    def transfer(self, from_acc_num: int, to_acc_num: int, amount: int, idempotency_key: str = None) -> tuple:
+        """Transfer money from one account to another.
+        Retrying with the same idempotency_key returns the first result instead of transferring again."""
+        # A negative amount would take money from the to account, which has no overdraft check
+        if not is_valid_amount(amount):
+            return False, "Amount must be a positive number of pence"
+
         # Get the account for the from account
         accounts, reply = self.search_accounts(account_number=from_acc_num)
 
@@ -244,13 +462,75 @@ class BankingSystem:
             to_acc = accounts[0]
         else:
             return False, "Could not find to account"
-        stat, reason = self.withdraw(from_acc.account_id, amount)
+
+        # Both sides are applied in one transaction
+        stat, reason = self.connection.transfer_balance(from_acc.account_id, to_acc.account_id, amount,
+                                                        idempotency_key=idempotency_key)
         if stat:
-            self.deposit(to_acc.account_id, amount)
             return True, ""
         else:
             return False, f"Could not remove the money from the sender. Reason: {reason}"
 
+    @require_login
+    def batch_transfer(self, transfers, chunk_size: int = 10000) -> list:
+        """Apply many (from_acc_num, to_acc_num, amount) transfers, e.g. an end of day run.
+        transfers can be a list or any iterable, it is applied in transactions of chunk_size items.
+        Returns a (status, reason) for each item in order."""
+        results = []
+        chunk = []
+
+        for transfer in transfers:
+            chunk.append(tuple(transfer))
+            if len(chunk) >= chunk_size:
+                results += self.connection.batch_transfer(chunk)
+                chunk = []
+
+        if chunk:
+            results += self.connection.batch_transfer(chunk)
+
+        return results
+
+    @require_full_rights
+    def accrue_interest(self, run_id: str, periods_per_year: int = 1, rounding: str = interest.DEFAULT_ROUNDING,
+                        dry_run: bool = False) -> tuple:
+        """Pay a period of interest to every account, rerunning a run_id resumes it"""
+        summary = interest.accrue_interest(self.connection, run_id, periods_per_year=periods_per_year,
+                                           rounding=rounding, dry_run=dry_run)
+        return summary["ok"], summary["message"], summary
+
+    @require_full_rights
+    def export_data(self, name: str, filepath: str, file_format: str = None, compress: bool = None,
+                    progress=None) -> tuple:
+        """Write customers, accounts or a report (see export.EXPORT_SQL) to a CSV or JSON Lines file"""
+        if name not in export.EXPORT_SQL:
+            return False, f"Unknown export: {name}", None
+
+        try:
+            summary = export.export_rows(self.connection, name, filepath, file_format, compress, progress=progress)
+        except (OSError, ValueError) as e:
+            return False, f"Could not export. Reason: {str(e)}", None
+        return True, f"Exported {summary['rows']} rows.", summary
+
+    @require_full_rights
+    def import_data(self, kind: str, filepath: str, import_id: str, reject_path: str = None, file_format: str = None,
+                    customer_import_id: str = None, keep_account_numbers: bool = True, progress=None) -> tuple:
+        """Bulk import customers or accounts from a CSV or JSON Lines file, rerunning an import_id resumes it"""
+        if kind not in importer.KINDS:
+            return False, f"Unknown import: {kind}", None
+
+        try:
+            summary = importer.import_file(self.connection, kind, filepath, import_id, reject_path, file_format,
+                                           customer_import_id=customer_import_id,
+                                           keep_account_numbers=keep_account_numbers, progress=progress)
+        except (OSError, ValueError) as e:
+            return False, f"Could not import. Reason: {str(e)}", None
+        return summary["ok"], summary["message"], summary
+
+    @require_login
+    def get_statement(self, acc_id: int, start: float = None, end: float = None, limit: int = None) -> tuple:
+        """Get the ledger entries of an account between two unix timestamps"""
+        return self.connection.get_statement(acc_id, start=start, end=end, limit=limit)
+
     @require_login
     def get_customer_data(self, customer_id: int) -> dict:
         """Gets all customer data including connected accounts"""
@@ -366,110 +646,127 @@ class BankingSystem:
 
     # Reports
     @require_login
+    @cached_report
     def interest_report(self) -> dict:
         """Check the interest of all accounts"""
-        accounts, reply = self.search_accounts(get_all=True)
-
-        highest_interest = accounts[0]
-        lowest_interest = accounts[0]
-
-        cumulative_interest = 0.0
+        # Totals come from bank_stats, which the triggers keep up to date
+        stats = self.connection.get_bank_stats()
+        accounts_pop = stats.get("accounts", 0)
 
-        interest_gained = 0.0
+        data = {"highest": self.connection.get_extreme_account("interest_rate", highest=True),
+                "lowest": self.connection.get_extreme_account("interest_rate", highest=False),
+                "mean": stats["total_rate"] / accounts_pop if accounts_pop else 0.0,
+                "interest_gained": stats.get("total_interest", 0.0),
+                "accounts_pop": accounts_pop}
 
-        for account in accounts:
-            # Check if highest interest
-            if account.interest_rate > highest_interest.interest_rate:
-                highest_interest = account
-
-            # Check lowest
-            if account.interest_rate < lowest_interest.interest_rate:
-                lowest_interest = account
-
-            cumulative_interest += account.interest_rate
-
-            interest_earned = account.calculate_interest_for_year()
-
-            interest_gained += interest_earned
-
-        mean_interest = cumulative_interest / len(accounts)
-
-        data = {"highest": highest_interest,
-                "lowest": lowest_interest,
-                "mean": mean_interest,
-                "interest_gained": interest_gained,
-                "accounts_pop": len(accounts)}
+        return data
 
+    @require_login
+    @cached_report
+    def interest_projection_report(self, horizons=interest.DEFAULT_HORIZONS,
+                                   rate_bands=interest.DEFAULT_RATE_BANDS) -> dict:
+        """Project the total of the balances in credit over several months of monthly compounding interest,
+        by account type and by rate band"""
+        data = interest.project_balances(self.connection.get_balance_totals_by_rate(), horizons, rate_bands)
+        data["accounts_pop"] = data["total"]["accounts"]
         return data
 
     @require_login
+    @cached_report
     def overdraft_report(self) -> dict:
         """Calculate the amount of overdrafts given"""
-        accounts, reply = self.search_accounts(get_all=True)
-
-        overdraft_total = 0
-
-        overdraft_highest = accounts[0]
-        overdraft_lowest = accounts[0]
-
-        for account in accounts:
-            # Check highest
-            if account.overdraft_limit > overdraft_highest.overdraft_limit:
-                overdraft_highest = account
-
-            # Check lowest
-            if account.overdraft_limit < overdraft_lowest.overdraft_limit:
-                overdraft_lowest = account
+        stats = self.connection.get_bank_stats()
+        accounts_pop = stats.get("accounts", 0)
 
-            overdraft_total += account.overdraft_limit
+        data = {"highest": self.connection.get_extreme_account("overdraft_limit", highest=True),
+                "lowest": self.connection.get_extreme_account("overdraft_limit", highest=False),
+                "mean": stats["total_overdraft"] / accounts_pop if accounts_pop else 0.0,
+                "total": stats.get("total_overdraft", 0),
+                "overdrawn": stats.get("overdrawn", 0),
+                "accounts_pop": accounts_pop}
 
-        overdraft_mean = overdraft_total / len(accounts)
-
-        data = {"highest": overdraft_highest,
-                "lowest": overdraft_lowest,
-                "mean": overdraft_mean,
-                "total": overdraft_total,
-                "accounts_pop": len(accounts)}
+        return data
 
+    @require_login
+    @cached_report
+    def overdraft_risk_report(self, top: int = 10, near_limit: float = 0.9) -> dict:
+        """Overdrawn accounts, how much they owe in total and the ones closest to (or past) their limit"""
+        data = self.connection.get_overdraft_risk(near_limit)
+        data["near_limit_fraction"] = near_limit
+        data["top"] = self.connection.get_most_overdrawn(top)
         return data
 
     @require_login
+    @cached_report
     def balance_report(self) -> dict:
         """Balance report across all accounts"""
-        accounts, reply = self.search_accounts(get_all=True)
-
-        max_balance = accounts[0]
-        min_balance = accounts[0]
-
-        total_balance = 0.0
-
-        for account in accounts:
-            # Highest account balance
-            if account.balance > max_balance.balance:
-                max_balance = account
+        stats = self.connection.get_bank_stats()
+        accounts_pop = stats.get("accounts", 0)
 
-            # lowest account balance
-            if account.balance < min_balance.balance:
-                min_balance = account
+        data = {"highest": self.connection.get_extreme_account("balance", highest=True),
+                "lowest": self.connection.get_extreme_account("balance", highest=False),
+                "mean": stats["total_balance"] / accounts_pop if accounts_pop else 0.0,
+                "total": stats.get("total_balance", 0),
+                "accounts_pop": accounts_pop}
 
-            total_balance += account.balance
-
-        mean_balance = total_balance / len(accounts)
+        return data
 
-        data = {"highest": max_balance,
-                "lowest": min_balance,
-                "mean": mean_balance,
-                "total": total_balance,
-                "accounts_pop": len(accounts)}
+    @require_login
+    @cached_report
+    def geographic_report(self, level: str = "city", sort: str = "customers", page: int = 1,
+                          page_size: int = 50) -> dict:
+        """Customers, accounts and total balance per city (level city) or postcode area (level outward)"""
+        page = max(1, page)
+        rows, total = self.connection.get_geo_stats(level, sort, limit=page_size, offset=(page - 1) * page_size)
+        return {"level": level, "sort": sort, "page": page, "page_size": page_size, "total": total,
+                "pages": (total + page_size - 1) // page_size if page_size else 0, "areas": rows}
 
+    @require_login
+    @cached_report
+    def distribution_report(self, metric: str = "balance", percentiles=distributions.DEFAULT_PERCENTILES,
+                            buckets: int = distributions.DEFAULT_BUCKETS, bands=None) -> dict:
+        """Percentiles, equal sized buckets and counts per band of balances, overdraft utilisation or interest
+        rates"""
+        if metric not in distributions.DEFAULT_BANDS:
+            return {"metric": metric, "count": 0, "percentiles": {}, "buckets": [], "bands": []}
+
+        if bands is None:
+            bands = distributions.DEFAULT_BANDS[metric]
+
+        # The values come out of the database already sorted, one batch at a time
+        data = distributions.summarise_sorted(self.connection.iter_sorted_values(metric),
+                                              self.connection.get_metric_count(metric), percentiles, buckets)
+        data["metric"] = metric
+        data["bands"] = distributions.label_bands(self.connection.get_band_counts(metric, bands), bands)
         return data
 
     @require_login
-    def customer_report(self) -> dict:
+    @cached_report
+    def customer_report(self, top: int = 10) -> dict:
         """Creates a report on customers"""
-        customers, reply = self.search_customers(get_all=True)
+        stats = self.connection.get_bank_stats()
+        customers_pop = stats.get("customers", 0)
 
-        return {"customers_pop": len(customers)}
+        tops = self.connection.get_top_customers(limit=top)
+
+        return {"customers_pop": customers_pop,
+                "without_accounts": customers_pop - self.connection.get_customers_with_accounts(),
+                "mean_accounts": stats.get("accounts", 0) / customers_pop if customers_pop else 0.0,
+                "top_by_balance": tops["balance"],
+                "top_by_accounts": tops["accounts"],
+                "top_by_exposure": tops["exposure"]}
+
+    @require_login
+    @cached_report
+    def customer_rollup_report(self, sort: str = "balance", page: int = 1, page_size: int = 50,
+                               min_accounts: int = None) -> dict:
+        """Per customer account counts, total balances and overdraft exposure, a page at a time"""
+        page = max(1, page)
+        rows, total = self.connection.get_customer_rollup(sort, limit=page_size, offset=(page - 1) * page_size,
+                                                          min_accounts=min_accounts)
+        return {"sort": sort, "page": page, "page_size": page_size, "min_accounts": min_accounts,
+                "total": total, "pages": (total + page_size - 1) // page_size if page_size else 0,
+                "customers": rows}
 
 if __name__ == "__main__":
     print("Module Only")
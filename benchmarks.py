@@ -0,0 +1,211 @@
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+from time import perf_counter, strftime
+
+# Database sizes (customers) the benchmarks are run at, there are two accounts per customer
+DEFAULT_SIZES = [1000, 10000]
+
+# Each round runs for roughly this long (seconds), the iterations per round are picked to match
+ROUND_TIME = 0.2
+DEFAULT_ROUNDS = 5
+
+# A benchmark is flagged as a regression if it got slower than this (percent)
+DEFAULT_THRESHOLD = 10.0
+
+
+def time_function(function, rounds: int = DEFAULT_ROUNDS) -> dict:
+    """Time a function, returning the per call time (micro seconds) of each round"""
+    # Calibrate the iterations so a round takes about ROUND_TIME
+    iterations = 1
+    while True:
+        start = perf_counter()
+        for i in range(iterations):
+            function()
+        taken = perf_counter() - start
+        if taken >= ROUND_TIME / 10 or iterations >= 1000000:
+            break
+        iterations *= 10
+    iterations = max(1, int(iterations * ROUND_TIME / max(taken, 1e-9)))
+
+    times = []
+    for i in range(rounds):
+        start = perf_counter()
+        for j in range(iterations):
+            function()
+        times.append((perf_counter() - start) / iterations * 1000000)
+
+    return {"median_us": statistics.median(times), "min_us": min(times), "max_us": max(times),
+            "rounds": rounds, "iterations": iterations}
+
+
+def database_benchmarks(db_filepath: str, seed: int = 0) -> tuple:
+    """Build the benchmarks that depend on the database size, returns (name -> function, the logged in system)"""
+    import bank
+    import loadtest
+
+    rand = random.Random(seed)
+    targets = loadtest.load_targets(db_filepath)
+    accounts = targets["accounts"]
+
+    system = bank.BankingSystem(db_filepath=db_filepath)
+    system.login(*loadtest.LOADTEST_ADMIN)
+    conn = system.connection
+
+    # Some fixed picks so every run does the same work
+    acc_id, acc_num = accounts[len(accounts) // 2]
+    from_num, to_num = accounts[1][1], accounts[-2][1]
+    customer = conn.get_customers(cid=targets["customers"][len(targets["customers"]) // 2])[0][0]
+    last_name = rand.choice(targets["last_names"])
+
+    def balance_round_trip():
+        balance, reply = conn.get_balance(account_id=acc_id)
+        conn.change_balance(balance, account_id=acc_id)
+
+    def transfer_round_trip():
+        system.transfer(from_num, to_num, 1)
+        system.transfer(to_num, from_num, 1)
+
+    return {
+        "connection.get_accounts.by_id": lambda: conn.get_accounts(accid=acc_id),
+        "connection.get_accounts.by_number": lambda: conn.get_accounts(account_number=acc_num),
+        "connection.get_accounts.get_all": lambda: conn.get_accounts(get_all=True),
+        "connection.get_customers.exact": lambda: conn.get_customers(fname=customer.first_name,
+                                                                     lname=customer.last_name,
+                                                                     must_include_all=True),
+        "connection.get_customers.like": lambda: conn.get_customers(lname=customer.last_name[1:-1], exact=False),
+        "connection.get_balance_change_balance": balance_round_trip,
+        "bank.transfer": transfer_round_trip,
+        "bank.search_accounts.customer_name": lambda: system.search_accounts(cust_last=last_name,
+                                                                             exact_fields=True),
+        "bank.interest_report": system.interest_report,
+        "bank.balance_report": system.balance_report,
+        "bank.overdraft_report": system.overdraft_report,
+        "bank.customer_report": system.customer_report,
+    }, system
+
+
+def hashing_benchmarks() -> dict:
+    """Benchmarks that do not touch the database"""
+    import bank
+
+    stored = bank.BankingSystem.hash_password("benchmark")
+    return {
+        "bank.hash_password": lambda: bank.BankingSystem.hash_password("benchmark"),
+        "bank.verify_hash": lambda: bank.BankingSystem.verify_hash(stored, "benchmark"),
+    }
+
+
+def run_benchmarks(sizes: list = None, rounds: int = DEFAULT_ROUNDS, only: str = None, seed: int = 0) -> dict:
+    """Run every benchmark at each database size, results are keyed as name@size"""
+    import loadtest
+    from report_cache import report_cache
+
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+
+    # The reports would only be timing cache hits, the data doesn't change between iterations
+    cache_enabled = report_cache.enabled
+    report_cache.disable()
+
+    results = {}
+
+    def run(name, size, function):
+        if only is not None and only not in name:
+            return
+        key = f"{name}@{size}"
+        results[key] = time_function(function, rounds)
+        print(f"{key}: {round(results[key]['median_us'], 1)}us")
+
+    for name, function in hashing_benchmarks().items():
+        run(name, 0, function)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            db_filepath = os.path.join(temp_dir, f"bench_{size}.db")
+            loadtest.seed_database(db_filepath, customers=size, accounts=size * 2, seed=seed)
+
+            benchmarks, system = database_benchmarks(db_filepath, seed)
+            for name, function in benchmarks.items():
+                run(name, size, function)
+
+            system.connection.close_connection()
+            os.remove(db_filepath)
+    finally:
+        os.rmdir(temp_dir)
+        if cache_enabled:
+            report_cache.enable()
+
+    return {"meta": {"time": strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                     "platform": platform.platform(), "sizes": sizes, "rounds": rounds, "seed": seed},
+            "results": results}
+
+
+def compare_results(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> tuple:
+    """Compare two result files, returns (rows, regressions) where a row is (key, old us, new us, change %)"""
+    rows = []
+    regressions = []
+
+    for key in sorted(set(old["results"]) & set(new["results"])):
+        old_time = old["results"][key]["median_us"]
+        new_time = new["results"][key]["median_us"]
+        change = (new_time - old_time) / old_time * 100 if old_time else 0.0
+
+        rows.append((key, old_time, new_time, change))
+        if change > threshold:
+            regressions.append(key)
+
+    return rows, regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the connection and banking system.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                            help="Comma separated customer counts to run at.")
+    run_parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS)
+    run_parser.add_argument("--only", default=None, help="Only run benchmarks whose name contains this.")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", default="bench_results.json", help="File to write the results to.")
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files.")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                                help="Percent slow down counted as a regression.")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = run_benchmarks(sizes, args.rounds, args.only, args.seed)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        with open(args.old) as file:
+            old = json.load(file)
+        with open(args.new) as file:
+            new = json.load(file)
+
+        rows, regressions = compare_results(old, new, args.threshold)
+        for key, old_time, new_time, change in rows:
+            flag = "  REGRESSION" if key in regressions else ""
+            print(f"{key:<55} {old_time:>12.1f}us {new_time:>12.1f}us {change:>+8.1f}%{flag}")
+
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower by more than {args.threshold}%.")
+            exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,416 @@
+import functools
+import json
 import sqlite3
+import threading
+from random import randint
+from time import time
 from accounts import Customer, BankAccount, Admin
+from query_stats import instrumentation
+
+# Append only history of every balance change. created_at is in microseconds since the epoch.
+LEDGER_SQL = ["""create table if not exists transactions
+(
+    id            integer
+        constraint transactions_pk
+            primary key autoincrement,
+    account_id    int  not null,
+    created_at    int  not null,
+    amount        int  not null,
+    balance_after int  not null,
+    kind          text not null,
+    reference     text
+);""", """create index if not exists transactions_account_id_created_at_index
+    on transactions (account_id, created_at);"""]
+
+# Results of balance changes made with an idempotency key, so a retried request returns the first result
+IDEMPOTENCY_SQL = ["""create table if not exists idempotency_keys
+(
+    key        text not null
+        constraint idempotency_keys_pk
+            primary key,
+    request    text not null,
+    result     text not null,
+    created_at int  not null
+);""", """create index if not exists idempotency_keys_created_at_index
+    on idempotency_keys (created_at);"""]
+
+# How long (seconds) an idempotency key is remembered for
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# Expired keys are removed after every this many new keys
+IDEMPOTENCY_PRUNE_EVERY = 1000
+
+# Progress of each interest accrual run, so a run that stops part way can carry on from its checkpoint.
+# A run can be split into partitions (ranges of account ids), each with its own checkpoint.
+INTEREST_SQL = ["""create table if not exists interest_runs
+(
+    run_id        text not null,
+    partition     int  not null,
+    first_id      int  not null,
+    last_id       int  not null,
+    checkpoint_id int  not null,
+    accounts      int  not null default 0,
+    interest      int  not null default 0,
+    started_at    int  not null,
+    finished_at   int,
+    constraint interest_runs_pk
+        primary key (run_id, partition)
+);"""]
+
+# Running totals of the accounts and customers tables, kept up to date by triggers so the reports can read them
+# without scanning. There is only ever one row, id 1. version goes up with every change to either table, so
+# anything worked out from them (e.g. cached reports) can tell when it is out of date.
+STATS_SQL = ["""create table if not exists bank_stats
+(
+    id              integer not null
+        constraint bank_stats_pk
+            primary key,
+    accounts        int  default 0 not null,
+    total_balance   int  default 0 not null,
+    total_overdraft int  default 0 not null,
+    total_rate      real default 0 not null,
+    total_interest  real default 0 not null,
+    overdrawn       int  default 0 not null,
+    customers       int  default 0 not null,
+    version         int  default 0 not null
+);""", """insert or ignore into bank_stats (id) values (1);""",
+             """create trigger if not exists bank_stats_account_insert after insert on accounts
+begin
+    update bank_stats set accounts=accounts+1, total_balance=total_balance+new.balance,
+        total_overdraft=total_overdraft+new.overdraft_limit, total_rate=total_rate+new.interest_rate,
+        total_interest=total_interest+new.balance*new.interest_rate/100,
+        overdrawn=overdrawn+(new.balance<0), version=version+1 where id=1;
+end;""", """create trigger if not exists bank_stats_account_update
+    after update on accounts
+begin
+    update bank_stats set total_balance=total_balance+new.balance-old.balance,
+        total_overdraft=total_overdraft+new.overdraft_limit-old.overdraft_limit,
+        total_rate=total_rate+new.interest_rate-old.interest_rate,
+        total_interest=total_interest+new.balance*new.interest_rate/100-old.balance*old.interest_rate/100,
+        overdrawn=overdrawn+(new.balance<0)-(old.balance<0), version=version+1 where id=1;
+end;""", """create trigger if not exists bank_stats_account_delete after delete on accounts
+begin
+    update bank_stats set accounts=accounts-1, total_balance=total_balance-old.balance,
+        total_overdraft=total_overdraft-old.overdraft_limit, total_rate=total_rate-old.interest_rate,
+        total_interest=total_interest-old.balance*old.interest_rate/100,
+        overdrawn=overdrawn-(old.balance<0), version=version+1 where id=1;
+end;""", """create trigger if not exists bank_stats_customer_insert after insert on customers
+begin
+    update bank_stats set customers=customers+1, version=version+1 where id=1;
+end;""", """create trigger if not exists bank_stats_customer_update after update on customers
+begin
+    update bank_stats set version=version+1 where id=1;
+end;""", """create trigger if not exists bank_stats_customer_delete after delete on customers
+begin
+    update bank_stats set customers=customers-1, version=version+1 where id=1;
+end;"""]
+
+# Works the bank_stats row out from scratch
+STATS_REBUILD_SQL = "SELECT COUNT(*), COALESCE(SUM(balance), 0), COALESCE(SUM(overdraft_limit), 0), " \
+                    "COALESCE(SUM(interest_rate), 0), COALESCE(SUM(balance*interest_rate/100), 0), " \
+                    "COALESCE(SUM(balance<0), 0), " \
+                    "(SELECT COUNT(*) FROM customers) FROM accounts"
+STATS_FIELDS = ("accounts", "total_balance", "total_overdraft", "total_rate", "total_interest", "overdrawn",
+                "customers")
+# Totals that are floats, so adding and taking away can leave them slightly out
+STATS_FLOAT_FIELDS = ("total_rate", "total_interest")
+
+# Only the overdrawn accounts are in this index, so finding them costs the same however many accounts are in credit
+OVERDRAWN_INDEX_SQL = ["""create index if not exists accounts_overdrawn_index
+    on accounts (balance, overdraft_limit) where balance < 0;"""]
+
+def sql_text(value) -> str:
+    """A value as the inside of a quoted SQL string, its quotes are doubled so it cannot end the string early"""
+    return str(value).replace("'", "''")
+
+
+def postcode_outward_sql(column: str) -> str:
+    """SQL for the outward code (the part before the space, e.g. LS7 of LS7 2LA) of a postcode column.
+    Postcodes written without the space have their last 3 characters (the inward code) taken off instead."""
+    code = f"UPPER(TRIM({column}))"
+    return f"(CASE WHEN INSTR({code}, ' ')>0 THEN SUBSTR({code}, 1, INSTR({code}, ' ')-1) " \
+           f"WHEN LENGTH({code})>3 THEN SUBSTR({code}, 1, LENGTH({code})-3) ELSE {code} END)"
+
+
+def geo_change_sql(sign: str, customers: str, accounts: str, balance: str, city: str, postcode: str) -> str:
+    """SQL adding (or with sign '-' taking away) customers, accounts and balance to a city and an outward code"""
+    if sign == "+":
+        # The area might not have a row yet
+        return "".join(f"""
+    insert into geo_stats (level, area, customers, accounts, total_balance)
+        values ('{level}', {area}, {customers}, {accounts}, {balance})
+        on conflict (level, area) do update set customers=customers+excluded.customers,
+            accounts=accounts+excluded.accounts, total_balance=total_balance+excluded.total_balance;"""
+                       for level, area in (("city", city), ("outward", postcode_outward_sql(postcode))))
+
+    return "".join(f"""
+    update geo_stats set customers=customers-({customers}), accounts=accounts-({accounts}),
+        total_balance=total_balance-({balance}) where level='{level}' and area={area};"""
+                   for level, area in (("city", city), ("outward", postcode_outward_sql(postcode))))
+
+
+def geo_account_sql(sign: str, row: str, accounts: str, balance: str) -> str:
+    """SQL adding (or taking away) accounts and balance to the areas of the customer of an account row"""
+    customer = f"(select %s from customers where id={row}.customer_id)"
+    return "".join(f"""
+    update geo_stats set accounts=accounts{sign}({accounts}), total_balance=total_balance{sign}({balance})
+        where level='{level}' and area={area};"""
+                   for level, area in (("city", customer % "address_city"),
+                                       ("outward", customer % postcode_outward_sql("address_postcode"))))
+
+
+# Customers, accounts and total balance per city and per postcode outward code, kept up to date by triggers so
+# the geographic report is a read of a few thousand rows. Accounts whose customer is gone aren't counted.
+GEO_SQL = ["""create table if not exists geo_stats
+(
+    level         text not null,
+    area          text not null,
+    customers     int  default 0 not null,
+    accounts      int  default 0 not null,
+    total_balance int  default 0 not null,
+    constraint geo_stats_pk
+        primary key (level, area)
+) without rowid;""", f"""create trigger if not exists geo_stats_customer_insert after insert on customers
+begin{geo_change_sql("+", "1", "0", "0", "new.address_city", "new.address_postcode")}
+end;""", f"""create trigger if not exists geo_stats_customer_delete before delete on customers
+begin{geo_change_sql("-", "1", "(select count(*) from accounts where customer_id=old.id)",
+                     "(select coalesce(sum(balance), 0) from accounts where customer_id=old.id)",
+                     "old.address_city", "old.address_postcode")}
+end;""", f"""create trigger if not exists geo_stats_customer_move after update of address_city, address_postcode
+    on customers when old.address_city is not new.address_city or old.address_postcode is not new.address_postcode
+begin{geo_change_sql("-", "1", "(select count(*) from accounts where customer_id=old.id)",
+                     "(select coalesce(sum(balance), 0) from accounts where customer_id=old.id)",
+                     "old.address_city", "old.address_postcode")}{
+    geo_change_sql("+", "1", "(select count(*) from accounts where customer_id=new.id)",
+                   "(select coalesce(sum(balance), 0) from accounts where customer_id=new.id)",
+                   "new.address_city", "new.address_postcode")}
+end;""", f"""create trigger if not exists geo_stats_account_insert after insert on accounts
+begin{geo_account_sql("+", "new", "1", "new.balance")}
+end;""", f"""create trigger if not exists geo_stats_account_delete after delete on accounts
+begin{geo_account_sql("-", "old", "1", "old.balance")}
+end;""", f"""create trigger if not exists geo_stats_account_balance after update of balance on accounts
+    when old.customer_id=new.customer_id and old.balance<>new.balance
+begin{geo_account_sql("+", "new", "0", "new.balance-old.balance")}
+end;""", f"""create trigger if not exists geo_stats_account_move after update of customer_id on accounts
+    when old.customer_id<>new.customer_id
+begin{geo_account_sql("-", "old", "1", "old.balance")}{geo_account_sql("+", "new", "1", "new.balance")}
+end;"""]
+
+# Works the geo_stats rows out from scratch, as (level, area, customers, accounts, total balance)
+GEO_REBUILD_SQL = "SELECT level, area, SUM(customers), SUM(accounts), SUM(total_balance) FROM (" \
+                  "SELECT 'city' AS level, address_city AS area, 1 AS customers, 0 AS accounts, " \
+                  "0 AS total_balance FROM customers " \
+                  f"UNION ALL SELECT 'outward', {postcode_outward_sql('address_postcode')}, 1, 0, 0 FROM customers " \
+                  "UNION ALL SELECT 'city', customers.address_city, 0, 1, accounts.balance " \
+                  "FROM accounts JOIN customers ON customers.id=accounts.customer_id " \
+                  f"UNION ALL SELECT 'outward', {postcode_outward_sql('customers.address_postcode')}, 0, 1, " \
+                  "accounts.balance FROM accounts JOIN customers ON customers.id=accounts.customer_id) " \
+                  "GROUP BY level, area"
+
+
+# Finding a customer's accounts, and the per customer rollups, go through customer_id
+CUSTOMER_INDEX_SQL = ["""create index if not exists accounts_customer_id_index
+    on accounts (customer_id);"""]
+
+# The highest and lowest of each reported column are read off the end of its index rather than by sorting the accounts
+EXTREMES_INDEX_SQL = ["""create index if not exists accounts_balance_index
+    on accounts (balance);""", """create index if not exists accounts_interest_rate_index
+    on accounts (interest_rate);""", """create index if not exists accounts_overdraft_limit_index
+    on accounts (overdraft_limit);"""]
+
+# Progress of each file of a bulk import, so a stopped import can carry on from its checkpoint (the number of rows
+# of the file dealt with), and the new id of every imported customer so accounts can refer to their source id.
+IMPORT_SQL = ["""create table if not exists import_runs
+(
+    import_id   text not null,
+    kind        text not null,
+    source      text not null,
+    checkpoint  int  not null default 0,
+    imported    int  not null default 0,
+    rejected    int  not null default 0,
+    started_at  int  not null,
+    finished_at int,
+    constraint import_runs_pk
+        primary key (import_id, kind)
+);""", """create table if not exists import_customer_ids
+(
+    import_id   text not null,
+    source_id   text not null,
+    customer_id int  not null,
+    constraint import_customer_ids_pk
+        primary key (import_id, source_id)
+) without rowid;"""]
+
+# Account numbers are 16 digits
+ACCOUNT_NUMBER_MIN = 1000000000000000
+ACCOUNT_NUMBER_MAX = 9999999999999999
+# Random places tried for a free block of account numbers before giving up
+ACCOUNT_NUMBER_BLOCK_ATTEMPTS = 100
+
+# Per customer account counts, total balances and overdraft exposure, one row per customer
+ROLLUP_SQL = "SELECT customers.id, customers.first_name, customers.last_name, " \
+             "COUNT(accounts.id) AS accounts, COALESCE(SUM(accounts.balance), 0) AS total_balance, " \
+             "COALESCE(SUM(MAX(-accounts.balance, 0)), 0) AS exposure, " \
+             "COALESCE(SUM(accounts.overdraft_limit), 0) AS total_overdraft " \
+             "FROM customers LEFT JOIN accounts ON accounts.customer_id=customers.id " \
+             "GROUP BY customers.id"
+ROLLUP_FIELDS = ("customer_id", "first_name", "last_name", "accounts", "total_balance", "exposure", "total_overdraft")
+# What the customer rollup can be sorted by: name -> SQL
+ROLLUP_SORTS = {"accounts": "accounts", "balance": "total_balance", "exposure": "exposure",
+                "overdraft_limit": "total_overdraft", "id": "-customers.id"}
+# The top customer lists of the customer report
+TOP_CUSTOMER_SORTS = ("balance", "accounts", "exposure")
+# What the geographic report can be sorted by: name -> SQL
+GEO_SORTS = {"customers": "customers DESC", "accounts": "accounts DESC", "balance": "total_balance DESC",
+             "area": "area"}
+
+# What can be exported: name -> query. Each is read with one SELECT, in a stable order.
+EXPORT_SQL = {"customers": "SELECT id, first_name, last_name, address_line1, address_line2, address_line3, "
+                           "address_city, address_postcode FROM customers ORDER BY id",
+              "accounts": "SELECT id, customer_id, account_name, account_number, balance, interest_rate, "
+                          "overdraft_limit FROM accounts ORDER BY id",
+              "accounts_with_customers": "SELECT accounts.id, accounts.account_name, accounts.account_number, "
+                                         "accounts.balance, accounts.interest_rate, accounts.overdraft_limit, "
+                                         "customers.id AS customer_id, customers.first_name, customers.last_name, "
+                                         "customers.address_city, customers.address_postcode "
+                                         "FROM accounts LEFT JOIN customers ON customers.id=accounts.customer_id "
+                                         "ORDER BY accounts.id",
+              "customer_rollup": "SELECT customers.id AS customer_id, customers.first_name, customers.last_name, "
+                                 "COUNT(accounts.id) AS accounts, COALESCE(SUM(accounts.balance), 0) AS total_balance, "
+                                 "COALESCE(SUM(MAX(-accounts.balance, 0)), 0) AS exposure, "
+                                 "COALESCE(SUM(accounts.overdraft_limit), 0) AS total_overdraft "
+                                 "FROM customers LEFT JOIN accounts ON accounts.customer_id=customers.id "
+                                 "GROUP BY customers.id ORDER BY customers.id",
+              "overdrawn": "SELECT id, customer_id, account_number, balance, overdraft_limit FROM accounts "
+                           "WHERE balance<0 ORDER BY balance",
+              "geographic_city": "SELECT area AS city, customers, accounts, total_balance FROM geo_stats "
+                                 "WHERE level='city' AND (customers<>0 OR accounts<>0) ORDER BY area",
+              "geographic_outward": "SELECT area AS outward_code, customers, accounts, total_balance FROM geo_stats "
+                                    "WHERE level='outward' AND (customers<>0 OR accounts<>0) ORDER BY area",
+              "ledger": "SELECT id, account_id, created_at, amount, balance_after, kind, reference FROM transactions "
+                        "ORDER BY id"}
+
+# Values the distribution reports can be made of: name -> (SQL expression, which accounts are included)
+DISTRIBUTION_METRICS = {"balance": ("balance", "1"),
+                        # How much of the overdraft is used, 0 when in credit and 1 at the limit
+                        "overdraft_utilisation": ("CAST(MAX(-balance, 0) AS REAL) / overdraft_limit",
+                                                  "overdraft_limit>0"),
+                        "interest_rate": ("interest_rate", "1")}
+
+# Most values bound into a single IN (...) list, older sqlite builds only allow 999 parameters
+MAX_IN_PARAMS = 900
+
+# Balance changes are committed in groups of this many, 1 commits every change straight away
+DEFAULT_COMMIT_BATCH_SIZE = 1
+# Longest time (seconds) a balance change waits for the rest of its group before being committed
+DEFAULT_COMMIT_MAX_DELAY = 0.05
+
+
+def holds_commit_lock(method):
+    """Run a write method with commit_lock held from its first change to its commit, so the group commit timer
+    can't commit part of it"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.commit_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Connection:
-    def __init__(self, db_filepath="Files/Data/data.db", mode="normal"):
+    def __init__(self, db_filepath="Files/Data/data.db", mode="normal",
+                 commit_batch_size: int = DEFAULT_COMMIT_BATCH_SIZE, commit_max_delay: float = DEFAULT_COMMIT_MAX_DELAY):
         self.connected = False
 
         # To limit functions to setup mode
         self.mode = mode
 
+        # Select waiting for its rows to be fetched before its timing is recorded
+        self.pending_query = None
+
+        # Group commit of balance changes
+        self.commit_batch_size = commit_batch_size
+        self.commit_max_delay = commit_max_delay
+        self.pending_writes = 0
+        self.first_pending_write = 0.0
+        # With group commit a timer commits a group that is still waiting after commit_max_delay, even if no more
+        # changes come in. The lock stops it committing part way through a change or any other write (see
+        # holds_commit_lock), and it is reentrant so a change can flush its own group.
+        self.commit_lock = threading.RLock()
+        self.commit_timer = None
+        self.commit_group = 0
+
+        # Idempotency keys added since expired ones were last pruned
+        self.keys_since_prune = 0
+
         try:
-            self.conn = sqlite3.connect(db_filepath)
+            # The commit timer runs on its own thread, so group commit needs the connection shared with it
+            self.conn = sqlite3.connect(db_filepath, check_same_thread=commit_batch_size <= 1)
             self.cursor = self.conn.cursor()
             self.connected = True
         except:
             print("Cannot connect to database.")
             self.connected = False
 
+        # Older databases won't have the ledger yet
+        if self.connected and mode != "setup":
+            for sql in LEDGER_SQL + IDEMPOTENCY_SQL + INTEREST_SQL + OVERDRAWN_INDEX_SQL + CUSTOMER_INDEX_SQL + \
+                    EXTREMES_INDEX_SQL + IMPORT_SQL:
+                self.__query(sql)
+            self.__setup_bank_stats()
+            self.__setup_geo_stats()
+
+    def __setup_bank_stats(self):
+        """Add the bank_stats table and its triggers to a database that doesn't have them yet, or remake them if
+        they are from an older version"""
+        stat, reply = self.__query("PRAGMA table_info(bank_stats)")
+        if not stat:
+            return
+        columns = {row[1] for row in self.__fetchall()}
+        if columns == {"id", "version"}.union(STATS_FIELDS):
+            return
+
+        # The totals are worked out in the same transaction as the triggers are made, so no change is missed
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            if columns:
+                self.cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND tbl_name IN "
+                                    "('accounts', 'customers') AND name LIKE 'bank_stats_%'")
+                for (name,) in self.cursor.fetchall():
+                    self.cursor.execute(f"DROP TRIGGER {name}")
+                self.cursor.execute("DROP TABLE bank_stats")
+            for sql in STATS_SQL:
+                self.cursor.execute(sql)
+            self.cursor.execute(STATS_REBUILD_SQL)
+            row = self.cursor.fetchone()
+            self.cursor.execute(f"UPDATE bank_stats SET {', '.join(field + '=?' for field in STATS_FIELDS)} "
+                                "WHERE id=1", row)
+            self.conn.commit()
+        except Exception as e:
+            print(f"Could not set up bank_stats. Reason: {str(e)}")
+            self.conn.rollback()
+
+    def __setup_geo_stats(self):
+        """Add the geo_stats table and its triggers to a database that doesn't have them yet"""
+        stat, reply = self.__query("SELECT 1 FROM sqlite_master WHERE type='table' AND name='geo_stats'")
+        if not stat or len(self.__fetchall()) == 1:
+            return
+
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            for sql in GEO_SQL:
+                self.cursor.execute(sql)
+            self.cursor.execute(f"INSERT INTO geo_stats (level, area, customers, accounts, total_balance) "
+                                f"{GEO_REBUILD_SQL}")
+            self.conn.commit()
+        except Exception as e:
+            print(f"Could not set up geo_stats. Reason: {str(e)}")
+            self.conn.rollback()
+
     def close_connection(self):
         """Close connection"""
         try:
+            self.flush()
+            if self.commit_timer is not None:
+                self.commit_timer.cancel()
             self.conn.close()
         except:
             # Do nothing, cause connection should already be closed if this happens
@@ -27,18 +418,107 @@ class Connection:
 
         self.connected = False
 
-    def __query(self, query: str):
+    def __query(self, query: str, params=()):
         """Query the data base and return the data"""
         if not self.connected:
             return False, "Not connected to database."
 
+        # Only time queries when instrumentation is switched on, this check is all it costs otherwise
+        if instrumentation.enabled:
+            start = instrumentation.start()
+            try:
+                self.cursor.execute(query, params)
+            except Exception as e:
+                print(str(e))
+                instrumentation.record(query, start, error=str(e), params=params)
+                return False, "An error occurred when querying the database."
+
+            if query.lstrip()[:6].upper() == "SELECT":
+                # Selects are recorded once the rows are fetched, as that is when sqlite does the work
+                self.pending_query = (query, start, params)
+            else:
+                instrumentation.record(query, start, rows=self.cursor.rowcount, params=params)
+            return True, "Successfully executed query"
+
         try:
-            self.cursor.execute(query)
+            self.cursor.execute(query, params)
             return True, "Successfully executed query"
         except Exception as e:
             print(str(e))
             return False, "An error occurred when querying the database."
 
+    def __query_many(self, query: str, rows):
+        """Run a query once for each row of parameters"""
+        if not self.connected:
+            return False, "Not connected to database."
+
+        start = None
+        if instrumentation.enabled:
+            # Only the first row of parameters is recorded, a batch can be any size
+            rows = list(rows)
+            first_params = rows[0] if rows else ()
+            start = instrumentation.start()
+
+        try:
+            self.cursor.executemany(query, rows)
+        except Exception as e:
+            print(str(e))
+            if start is not None:
+                instrumentation.record(query, start, error=str(e), params=first_params)
+            return False, "An error occurred when querying the database."
+
+        if start is not None:
+            instrumentation.record(query, start, rows=self.cursor.rowcount, params=first_params)
+        return True, "Successfully executed query"
+
+    def __fetchall(self) -> list:
+        """Fetch the rows of the last query"""
+        rows = self.cursor.fetchall()
+
+        if self.pending_query is not None:
+            query, start, params = self.pending_query
+            self.pending_query = None
+            instrumentation.record(query, start, rows=len(rows), params=params)
+
+        return rows
+
+    def flush(self) -> tuple:
+        """Commit any balance changes still waiting for their group commit"""
+        with self.commit_lock:
+            if self.pending_writes == 0:
+                return True, "Nothing to commit."
+
+            try:
+                self.conn.commit()
+            except Exception as e:
+                print(str(e))
+                return False, "An error occurred when committing to the database."
+
+            self.pending_writes = 0
+            return True, "Committed."
+
+    def __commit_batched(self):
+        """Commit now, or leave it for the rest of the group if group commit is switched on.
+        Called with commit_lock held."""
+        if self.pending_writes == 0:
+            self.first_pending_write = time()
+            if self.commit_batch_size > 1:
+                # Makes sure the group is committed within commit_max_delay however quiet the connection is
+                self.commit_group += 1
+                self.commit_timer = threading.Timer(self.commit_max_delay, self.__commit_due, (self.commit_group,))
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+        self.pending_writes += 1
+
+        if self.pending_writes >= self.commit_batch_size or time() - self.first_pending_write >= self.commit_max_delay:
+            self.flush()
+
+    def __commit_due(self, group: int):
+        """Timer callback, commit the group if it is still waiting"""
+        with self.commit_lock:
+            if group == self.commit_group and self.connected:
+                self.flush()
+
     def query(self, query: str):
         """Runs the __query but helps for setup"""
 
@@ -49,189 +529,222 @@ class Connection:
 
     # Getters
 
-    def get_customers(self, cid=None, fname=None, lname=None,
-                      address_l1=None, address_l2=None, address_l3=None, address_city=None, address_postcode=None,
-                      must_include_all: bool = False, exact: bool = True,
-                      return_as_dict: bool = False, get_all: bool = False) -> tuple:
-        """Return a list of customers from the database where all provided values are found"""
+    def build_customers_query(self, cid=None, fname=None, lname=None,
+                              address_l1=None, address_l2=None, address_l3=None, address_city=None,
+                              address_postcode=None, must_include_all: bool = False, exact: bool = True,
+                              get_all: bool = False) -> str:
+        """Build the SELECT used by get_customers, returns None if no search data is given"""
         if (cid is None and fname is None and lname is None and
                 address_l1 is None and address_l2 is None and address_l3 is None and
                 address_city is None and address_postcode is None) and not get_all:
-            return [], "No search data provided."
+            return None
+
+        if get_all:
+            sql = "SELECT id, first_name, last_name, " \
+                  "address_line1, address_line2, address_line3, address_city, address_postcode " \
+                  "FROM customers"
         else:
-            if get_all:
-                sql = "SELECT id, first_name, last_name, " \
-                      "address_line1, address_line2, address_line3, address_city, address_postcode " \
-                      "FROM customers"
+            sql = "SELECT id, first_name, last_name, " \
+                  "address_line1, address_line2, address_line3, address_city, address_postcode FROM customers WHERE "
+
+            if must_include_all:
+                op = 'AND'
             else:
-                sql = "SELECT id, first_name, last_name, " \
-                      "address_line1, address_line2, address_line3, address_city, address_postcode FROM customers WHERE "
+                op = 'OR'
 
-                if must_include_all:
-                    op = 'AND'
+            if cid is not None:
+                # Exact will not affect cid as it is unique
+                sql += f"id={str(cid)} {op} "
+
+            if fname is not None:
+                if exact:
+                    sql += f"first_name='{sql_text(fname)}' {op} "
                 else:
-                    op = 'OR'
+                    sql += f"first_name LIKE '%{sql_text(fname)}%' {op} "
 
-                if cid is not None:
-                    # Exact will not affect cid as it is unique
-                    sql += f"id={str(cid)} {op} "
+            if lname is not None:
+                if exact:
+                    sql += f"last_name='{sql_text(lname)}' {op} "
+                else:
+                    sql += f"last_name LIKE '%{sql_text(lname)}%' {op} "
 
-                if fname is not None:
-                    if exact:
-                        sql += f"first_name='{str(fname)}' {op} "
-                    else:
-                        sql += f"first_name LIKE '%{str(fname)}%' {op} "
+            if address_l1 is not None:
+                if exact:
+                    sql += f"address_line1='{sql_text(address_l1)}' {op} "
+                else:
+                    sql += f"address_line1 LIKE '%{sql_text(address_l1)}%' {op} "
 
-                if lname is not None:
-                    if exact:
-                        sql += f"last_name='{str(lname)}' {op} "
-                    else:
-                        sql += f"last_name LIKE '%{str(lname)}%' {op} "
+            if address_l2 is not None:
+                if exact:
+                    sql += f"address_line2='{sql_text(address_l2)}' {op} "
+                else:
+                    sql += f"address_line2 LIKE '%{sql_text(address_l2)}%' {op} "
 
-                if address_l1 is not None:
-                    if exact:
-                        sql += f"address_line1='{str(address_l1)}' {op} "
-                    else:
-                        sql += f"address_line1 LIKE '%{str(address_l1)}%' {op} "
+            if address_l3 is not None:
+                if exact:
+                    sql += f"address_line3='{sql_text(address_l3)}' {op} "
+                else:
+                    sql += f"address_line3 LIKE '%{sql_text(address_l3)}%' {op} "
 
-                if address_l2 is not None:
-                    if exact:
-                        sql += f"address_line2='{str(address_l2)}' {op} "
-                    else:
-                        sql += f"address_line2 LIKE '%{str(address_l2)}%' {op} "
+            if address_city is not None:
+                if exact:
+                    sql += f"address_city='{sql_text(address_city)}' {op} "
+                else:
+                    sql += f"address_city LIKE '%{sql_text(address_city)}%' {op} "
 
-                if address_l3 is not None:
-                    if exact:
-                        sql += f"address_line3='{str(address_l3)}' {op} "
-                    else:
-                        sql += f"address_line3 LIKE '%{str(address_l3)}%' {op} "
+            if address_postcode is not None:
+                if exact:
+                    sql += f"address_postcode='{sql_text(address_postcode)}' {op} "
+                else:
+                    sql += f"address_postcode LIKE '%{sql_text(address_postcode)}%' {op} "
 
-                if address_city is not None:
-                    if exact:
-                        sql += f"address_city='{str(address_city)}' {op} "
-                    else:
-                        sql += f"address_city LIKE '%{str(address_city)}%' {op} "
+            # Remove last 4 letters to remove the added operation (op) and two spaces
+            sql = sql[:-(len(op) + 2)]
 
-                if address_postcode is not None:
-                    if exact:
-                        sql += f"address_postcode='{str(address_postcode)}' {op} "
-                    else:
-                        sql += f"address_postcode LIKE '%{str(address_postcode)}%' {op} "
+        return sql
 
-                # Remove last 4 letters to remove the added operation (op) and two spaces
-                sql = sql[:-(len(op) + 2)]
+    def get_customers(self, cid=None, fname=None, lname=None,
+                      address_l1=None, address_l2=None, address_l3=None, address_city=None, address_postcode=None,
+                      must_include_all: bool = False, exact: bool = True,
+                      return_as_dict: bool = False, get_all: bool = False) -> tuple:
+        """Return a list of customers from the database where all provided values are found"""
+        sql = self.build_customers_query(cid=cid, fname=fname, lname=lname,
+                                         address_l1=address_l1, address_l2=address_l2,
+                                         address_l3=address_l3, address_city=address_city,
+                                         address_postcode=address_postcode, must_include_all=must_include_all,
+                                         exact=exact, get_all=get_all)
 
-            query_status, query_reply = self.__query(sql)
+        if sql is None:
+            return [], "No search data provided."
 
-            if query_status:
-                # Get results and convert into a dictionary
+        query_status, query_reply = self.__query(sql)
 
-                results = []
-                for row in self.cursor.fetchall():
+        if query_status:
+            # Get results and convert into a dictionary
 
-                    if return_as_dict:
-                        d = {'id': row[0], 'first_name': row[1], 'last_name': row[2],
-                             'address': [row[3], row[4], row[5], row[6], row[7]]}
-                        results.append(d)
-                    else:
-                        cust = Customer(row[0], row[1], row[2], [row[3], row[4], row[5], row[6], row[7]])
-                        results.append(cust)
+            results = []
+            for row in self.__fetchall():
 
-                return results, f"Query ran successfully. {len(results)} entries found."
-            else:
-                return [], query_reply
+                if return_as_dict:
+                    d = {'id': row[0], 'first_name': row[1], 'last_name': row[2],
+                         'address': [row[3], row[4], row[5], row[6], row[7]]}
+                    results.append(d)
+                else:
+                    cust = Customer(row[0], row[1], row[2], [row[3], row[4], row[5], row[6], row[7]])
+                    results.append(cust)
 
-    def get_accounts(self, accid=None, account_name=None, account_number=None, cust_id=None,
-                     balance=None, balance_opts='=', interest_rate=None, interest_opts='=',
-                     overdraft_limit=None, overdraft_opts='=',
-                     must_include_all: bool = False, exact_fields=False, return_as_dict: bool = False, get_all: bool = False) -> tuple:
-        """Return a list of accounts from the database where all provided values are found"""
+            return results, f"Query ran successfully. {len(results)} entries found."
+        else:
+            return [], query_reply
+
+    def build_accounts_query(self, accid=None, account_name=None, account_number=None, cust_id=None,
+                             balance=None, balance_opts='=', interest_rate=None, interest_opts='=',
+                             overdraft_limit=None, overdraft_opts='=',
+                             must_include_all: bool = False, exact_fields=False, get_all: bool = False) -> str:
+        """Build the SELECT used by get_accounts, returns None if no search data is given"""
         if (accid is None and account_name is None and account_number is None and
                 balance is None and interest_rate is None and overdraft_limit is None and cust_id is None) \
                 and not get_all:
-            return [], "No search data provided."
+            return None
+
+        if get_all:
+            sql = "SELECT id, account_name, " \
+                  "account_number, balance, interest_rate, overdraft_limit, customer_id FROM accounts"
         else:
-            if get_all:
-                sql = "SELECT id, account_name, " \
-                      "account_number, balance, interest_rate, overdraft_limit, customer_id FROM accounts"
+            sql = "SELECT id, account_name, " \
+                  "account_number, balance, interest_rate, overdraft_limit, customer_id FROM accounts WHERE "
+
+            if must_include_all:
+                op = 'AND'
             else:
-                sql = "SELECT id, account_name, " \
-                      "account_number, balance, interest_rate, overdraft_limit, customer_id FROM accounts WHERE "
+                op = 'OR'
 
-                if must_include_all:
-                    op = 'AND'
-                else:
-                    op = 'OR'
+            if accid is not None:
+                sql += "id=" + str(accid) + " " + op + " "
 
-                if accid is not None:
-                    sql += "id=" + str(accid) + " " + op + " "
+            if account_name is not None:
+                if exact_fields:
+                    sql += "account_name='" + sql_text(account_name) + "' " + op + " "
+                else:
+                    sql += "account_name LIKE'%" + sql_text(account_name) + "%' " + op + " "
 
-                if account_name is not None:
-                    if exact_fields:
-                        sql += "account_name='" + str(account_name) + "' " + op + " "
-                    else:
-                        sql += "account_name LIKE'%" + str(account_name) + "%' " + op + " "
+            if account_number is not None:
+                sql += "account_number=" + str(account_number) + " " + op + " "
 
-                if account_number is not None:
-                    sql += "account_number=" + str(account_number) + " " + op + " "
+            if balance is not None:
+                if balance_opts == ">":
+                    sql += "balance>=" + str(balance) + " " + op + " "
+                elif balance_opts == "<":
+                    sql += "balance<=" + str(balance) + " " + op + " "
+                else:
+                    sql += "balance=" + str(balance) + " " + op + " "
 
-                if balance is not None:
-                    if balance_opts == ">":
-                        sql += "balance>=" + str(balance) + " " + op + " "
-                    elif balance_opts == "<":
-                        sql += "balance<=" + str(balance) + " " + op + " "
-                    else:
-                        sql += "balance=" + str(balance) + " " + op + " "
+            if interest_rate is not None:
+                if interest_opts == ">":
+                    sql += "interest_rate>=" + str(interest_rate) + " " + op + " "
+                elif interest_opts == "<":
+                    sql += "interest_rate<=" + str(interest_rate) + " " + op + " "
+                else:
+                    sql += "interest_rate=" + str(interest_rate) + " " + op + " "
 
-                if interest_rate is not None:
-                    if interest_opts == ">":
-                        sql += "interest_rate>=" + str(interest_rate) + " " + op + " "
-                    elif interest_opts == "<":
-                        sql += "interest_rate<=" + str(interest_rate) + " " + op + " "
-                    else:
-                        sql += "interest_rate=" + str(interest_rate) + " " + op + " "
+            if overdraft_limit is not None:
+                if overdraft_opts == ">":
+                    sql += "overdraft_limit>=" + str(overdraft_limit) + " " + op + " "
+                elif overdraft_opts == "<":
+                    sql += "overdraft_limit<=" + str(overdraft_limit) + " " + op + " "
+                else:
+                    sql += "overdraft_limit=" + str(overdraft_limit) + " " + op + " "
 
-                if overdraft_limit is not None:
-                    if overdraft_opts == ">":
-                        sql += "overdraft_limit>=" + str(overdraft_limit) + " " + op + " "
-                    elif overdraft_opts == "<":
-                        sql += "overdraft_limit<=" + str(overdraft_limit) + " " + op + " "
-                    else:
-                        sql += "overdraft_limit=" + str(overdraft_limit) + " " + op + " "
+            if cust_id is not None:
+                sql += "customer_id=" + str(cust_id) + " " + op + " "
 
-                if cust_id is not None:
-                    sql += "customer_id=" + str(cust_id) + " " + op + " "
+            # remove the operator (op) and two space from the end
+            sql = sql[:-(len(op) + 2)]
 
-                # remove the operator (op) and two space from the end
-                sql = sql[:-(len(op) + 2)]
+        return sql
 
-            query_status, query_reply = self.__query(sql)
+    def get_accounts(self, accid=None, account_name=None, account_number=None, cust_id=None,
+                     balance=None, balance_opts='=', interest_rate=None, interest_opts='=',
+                     overdraft_limit=None, overdraft_opts='=',
+                     must_include_all: bool = False, exact_fields=False, return_as_dict: bool = False, get_all: bool = False) -> tuple:
+        """Return a list of accounts from the database where all provided values are found"""
+        sql = self.build_accounts_query(accid=accid, account_name=account_name, account_number=account_number,
+                                        cust_id=cust_id, balance=balance, balance_opts=balance_opts,
+                                        interest_rate=interest_rate, interest_opts=interest_opts,
+                                        overdraft_limit=overdraft_limit, overdraft_opts=overdraft_opts,
+                                        must_include_all=must_include_all, exact_fields=exact_fields,
+                                        get_all=get_all)
+
+        if sql is None:
+            return [], "No search data provided."
 
-            if query_status:
-                # Get results and convert into a dictionary
-                results = []
-                for row in self.cursor.fetchall():
-                    d = {'id': row[0], 'account_name': row[1], 'account_number': row[2], 'balance': row[3],
-                         'interest_rate': row[4], 'overdraft_limit': row[5], 'customer_id': row[6]}
-                    results.append(d)
+        query_status, query_reply = self.__query(sql)
 
-                if not return_as_dict:
-                    class_results = []
-                    for res in results:
-                        custs, reply = self.get_customers(cid=res["customer_id"])
-                        if len(custs) != 1:
-                            # No customer connected to this account so dont add to the list
-                            # print(f'Found account id:{res["id"]}, though it is connected to {len(custs)} customers.')
-                            pass
-                        else:
-                            acc = BankAccount(res["id"], res["account_name"], res["balance"],
-                                              res["interest_rate"], res["overdraft_limit"],
-                                              res["account_number"], custs[0])
-                            class_results.append(acc)
-                    return class_results, f"Query ran successfully. {len(class_results)} entries found"
-                return results, f"Query ran successfully. {len(results)} entries found"
-            else:
-                return [], query_reply
+        if query_status:
+            # Get results and convert into a dictionary
+            results = []
+            for row in self.__fetchall():
+                d = {'id': row[0], 'account_name': row[1], 'account_number': row[2], 'balance': row[3],
+                     'interest_rate': row[4], 'overdraft_limit': row[5], 'customer_id': row[6]}
+                results.append(d)
+
+            if not return_as_dict:
+                class_results = []
+                for res in results:
+                    custs, reply = self.get_customers(cid=res["customer_id"])
+                    if len(custs) != 1:
+                        # No customer connected to this account so dont add to the list
+                        # print(f'Found account id:{res["id"]}, though it is connected to {len(custs)} customers.')
+                        pass
+                    else:
+                        acc = BankAccount(res["id"], res["account_name"], res["balance"],
+                                          res["interest_rate"], res["overdraft_limit"],
+                                          res["account_number"], custs[0])
+                        class_results.append(acc)
+                return class_results, f"Query ran successfully. {len(class_results)} entries found"
+            return results, f"Query ran successfully. {len(results)} entries found"
+        else:
+            return [], query_reply
 
     def get_admin(self, ad_id: int = None, first_name: str = None, last_name: str = None,
                   address_l1: str = None, address_l2: str = None, address_l3: str = None,
@@ -257,28 +770,28 @@ class Connection:
                 sql += "id=" + str(ad_id) + " " + op + " "
 
             if first_name is not None:
-                sql += "first_name='" + first_name + "'" + op + " "
+                sql += "first_name='" + sql_text(first_name) + "'" + op + " "
 
             if last_name is not None:
-                sql += "last_name='" + last_name + "' " + op + " "
+                sql += "last_name='" + sql_text(last_name) + "' " + op + " "
 
             if address_l1 is not None:
-                sql += "address_line1='" + address_l1 + "' " + op + " "
+                sql += "address_line1='" + sql_text(address_l1) + "' " + op + " "
 
             if address_l2 is not None:
-                sql += "address_line2='" + address_l2 + "' " + op + " "
+                sql += "address_line2='" + sql_text(address_l2) + "' " + op + " "
 
             if address_l3 is not None:
-                sql += "address_line3='" + address_l3  + "' " + op + " "
+                sql += "address_line3='" + sql_text(address_l3) + "' " + op + " "
 
             if address_city is not None:
-                sql += "address_city='" + address_city + "' " + op + " "
+                sql += "address_city='" + sql_text(address_city) + "' " + op + " "
 
             if address_postcode is not None:
-                sql += "address_postcode='" + address_postcode + "' " + op + " "
+                sql += "address_postcode='" + sql_text(address_postcode) + "' " + op + " "
 
             if username is not None:
-                sql += "username='" + username + "' " + op + " "
+                sql += "username='" + sql_text(username) + "' " + op + " "
 
             if full_rights is not None:
                 sql += "full_rights=" + str(full_rights) + " " + op + " "
@@ -291,7 +804,7 @@ class Connection:
             if query_status:
                 # Get results and convert them into the correct form
                 results = []
-                for row in self.cursor.fetchall():
+                for row in self.__fetchall():
                     if return_as_dict:
                         # row index order: id, first_name, last_name, address, username, password_hash, full_rights
                         d = {"admin_id": row[0], "first_name": row[1], "last_name": row[2],
@@ -325,7 +838,7 @@ class Connection:
         query_status, query_reply = self.__query(sql)
 
         if query_status:
-            ret = self.cursor.fetchall()
+            ret = self.__fetchall()
             if len(ret) != 1:
                 print("Too many entries")
                 return None, f"{len(ret)}, entries found."
@@ -354,7 +867,7 @@ class Connection:
         query_status, query_reply = self.__query(sql)
 
         if query_status:
-            ret = self.cursor.fetchall()
+            ret = self.__fetchall()
             if len(ret) != 1:
                 return None, f"{len(ret)} entries returned."
             else:
@@ -365,31 +878,945 @@ class Connection:
 
     # Update table entries
     def change_balance(self, new_balance: int, account_id: int = None, account_number: int = None) -> tuple:
-        """Change the balance data of an account"""
+        """Change the balance data of an account, the difference is recorded in the ledger as an adjustment"""
         if account_id is None and account_number is None:
             return False, "No search data provided."
 
-        sql = f"UPDATE accounts " \
-              f"SET balance={new_balance} " \
-              f"WHERE "
+        where = ""
+        params = []
 
         if account_id is not None:
-            sql += f"id={account_id} AND "
+            where += "id=? AND "
+            params.append(account_id)
 
         if account_number is not None:
-            sql += f"account_number={account_number}"
+            where += "account_number=? AND "
+            params.append(account_number)
 
-        if sql[-4:] == "AND ":
-            sql = sql[:-4]
+        where = where[:-5]
 
-        query_status, query_reply = self.__query(sql)
+        # Held so the group commit timer can't commit the update without its ledger entries
+        with self.commit_lock:
+            stat, reply = self.__query(f"SELECT id, balance FROM accounts WHERE {where}", params)
+            if not stat:
+                return False, reply
+            rows = self.__fetchall()
 
-        if query_status:
+            query_status, query_reply = self.__query(f"UPDATE accounts SET balance=? WHERE {where}",
+                                                     [new_balance] + params)
+
+            if query_status:
+                for accid, old_balance in rows:
+                    self.__add_ledger_entry(accid, new_balance - old_balance, new_balance, "adjustment")
+                self.conn.commit()
+                self.pending_writes = 0
+                return True, "Updated."
+            else:
+                self.conn.rollback()
+                return False, query_reply
+
+    # Ledger
+    def __add_ledger_entry(self, account_id: int, amount: int, balance_after: int, kind: str, reference=None):
+        """Add a row to the transactions table, the caller commits"""
+        return self.__query("INSERT INTO transactions (account_id, created_at, amount, balance_after, kind, reference) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (account_id, int(time() * 1000000), amount, balance_after, kind, reference))
+
+    def __begin_change(self):
+        """Start a balance change. It gets its own savepoint so a failure only undoes itself and not the
+        changes waiting for their group commit."""
+        if not self.conn.in_transaction:
+            self.cursor.execute("BEGIN")
+        self.cursor.execute("SAVEPOINT balance_change")
+
+    def __end_change(self, success: bool):
+        """Keep or undo the balance change, then commit it (or leave it for its group)"""
+        if not success:
+            self.cursor.execute("ROLLBACK TO balance_change")
+        self.cursor.execute("RELEASE balance_change")
+
+        if success:
+            self.__commit_batched()
+        elif self.pending_writes == 0:
+            # Nothing else is waiting, so end the now empty transaction
             self.conn.commit()
-            return True, "Updated."
+
+    def __apply_change(self, account_id: int, amount: int, kind: str, reference=None,
+                       check_overdraft: bool = True) -> tuple:
+        """Move the balance and add the ledger entry without committing. Returns (status, reply)"""
+        sql = "UPDATE accounts SET balance=balance+? WHERE id=?"
+        params = [amount, account_id]
+
+        # Check the overdraft limit in the same statement, so nothing can change the balance in between
+        if check_overdraft and amount < 0:
+            sql += " AND balance+?>=-overdraft_limit"
+            params.append(amount)
+
+        stat, reply = self.__query(sql, params)
+        if not stat:
+            return False, reply
+
+        if self.cursor.rowcount != 1:
+            self.__query("SELECT 1 FROM accounts WHERE id=?", (account_id,))
+            if len(self.__fetchall()) == 0:
+                return False, "Account not found."
+            return False, "Insufficient funds available"
+
+        stat, reply = self.__query("SELECT balance FROM accounts WHERE id=?", (account_id,))
+        if not stat:
+            return False, reply
+        balance = self.__fetchall()[0][0]
+
+        stat, reply = self.__add_ledger_entry(account_id, amount, balance, kind, reference)
+        if not stat:
+            return False, reply
+
+        return True, "Updated."
+
+    def __find_idempotent_result(self, key: str, request: str):
+        """Return the stored result for an idempotency key, or None if the key hasn't been used"""
+        stat, reply = self.__query("SELECT request, result FROM idempotency_keys WHERE key=? AND created_at>=?",
+                                   (key, int((time() - IDEMPOTENCY_TTL) * 1000000)))
+        if not stat:
+            return False, reply
+
+        rows = self.__fetchall()
+        if len(rows) == 0:
+            return None
+
+        if rows[0][0] != request:
+            return False, "Idempotency key was already used for a different request."
+        return tuple(json.loads(rows[0][1]))
+
+    def __store_idempotent_result(self, key: str, request: str, result: tuple) -> tuple:
+        """Remember the result of a request made with an idempotency key"""
+        # Replace covers an expired key that hasn't been pruned yet
+        stat, reply = self.__query("INSERT OR REPLACE INTO idempotency_keys (key, request, result, created_at) "
+                                   "SELECT ?, ?, ?, ? WHERE NOT EXISTS "
+                                   "(SELECT 1 FROM idempotency_keys WHERE key=? AND created_at>=?)",
+                                   (key, request, json.dumps(result), int(time() * 1000000),
+                                    key, int((time() - IDEMPOTENCY_TTL) * 1000000)))
+        if stat and self.cursor.rowcount != 1:
+            return False, "A request with this idempotency key is already being processed."
+
+        self.keys_since_prune += 1
+        if stat and self.keys_since_prune >= IDEMPOTENCY_PRUNE_EVERY:
+            self.keys_since_prune = 0
+            self.__query("DELETE FROM idempotency_keys WHERE created_at<?",
+                         (int((time() - IDEMPOTENCY_TTL) * 1000000),))
+
+        return stat, reply
+
+    @holds_commit_lock
+    def prune_idempotency_keys(self, ttl: float = IDEMPOTENCY_TTL) -> tuple:
+        """Remove idempotency keys older than ttl seconds"""
+        stat, reply = self.__query("DELETE FROM idempotency_keys WHERE created_at<?",
+                                   (int((time() - ttl) * 1000000),))
+        if not stat:
+            return False, reply, 0
+
+        removed = self.cursor.rowcount
+        self.conn.commit()
+        self.pending_writes = 0
+        return True, f"Removed {removed} keys.", removed
+
+    def __run_change(self, change, idempotency_key: str = None, request: str = None) -> tuple:
+        """Run a balance change in its own savepoint. With an idempotency key, a key that has already been used
+        returns the first result instead of making the change again. Only successful changes are remembered, a
+        failed change did nothing so it is safe to retry.
+        The group commit timer waits for the whole change, so it never commits half of one."""
+        with self.commit_lock:
+            self.__begin_change()
+
+            if idempotency_key is not None:
+                previous = self.__find_idempotent_result(idempotency_key, request)
+                if previous is not None:
+                    self.__end_change(False)
+                    return previous
+
+            stat, reply = change()
+
+            if stat and idempotency_key is not None:
+                stored, stored_reply = self.__store_idempotent_result(idempotency_key, request, (stat, reply))
+                if not stored:
+                    stat, reply = False, stored_reply
+
+            self.__end_change(stat)
+            return stat, reply
+
+    def apply_balance_change(self, account_id: int, amount: int, kind: str, reference=None,
+                             check_overdraft: bool = True, idempotency_key: str = None) -> tuple:
+        """Add amount (negative to take money out) to the balance and record it in the ledger, in one transaction.
+        Taking money out fails if it would go past the overdraft limit, unless check_overdraft is False."""
+        if not self.connected:
+            return False, "Not connected to database."
+
+        return self.__run_change(lambda: self.__apply_change(account_id, amount, kind, reference, check_overdraft),
+                                 idempotency_key, f"{kind}:{account_id}:{amount}")
+
+    def transfer_balance(self, from_account_id: int, to_account_id: int, amount: int, reference=None,
+                         idempotency_key: str = None) -> tuple:
+        """Move money between two accounts and record both sides in the ledger, in one transaction"""
+        if not self.connected:
+            return False, "Not connected to database."
+
+        def change():
+            stat, reply = self.__apply_change(from_account_id, -amount, "transfer_out",
+                                              reference if reference is not None else str(to_account_id))
+            if stat:
+                stat, reply = self.__apply_change(to_account_id, amount, "transfer_in",
+                                                  reference if reference is not None else str(from_account_id),
+                                                  check_overdraft=False)
+            return stat, reply
+
+        return self.__run_change(change, idempotency_key, f"transfer:{from_account_id}:{to_account_id}:{amount}")
+
+    @holds_commit_lock
+    def batch_transfer(self, transfers: list) -> list:
+        """Apply a list of (from account number, to account number, amount) transfers in one transaction.
+        Items are checked in order against the running balances, so an item only fails if it would have failed as
+        a single transfer at that point. Accepted movements are netted per account and applied with one
+        conditional UPDATE each. Returns a (status, reply) for each item."""
+        results = [None] * len(transfers)
+
+        if not self.connected:
+            return [(False, "Not connected to database.")] * len(transfers)
+
+        # A batch can't join a group commit, it needs its own write transaction
+        self.flush()
+
+        numbers = set()
+        for from_num, to_num, amount in transfers:
+            numbers.add(from_num)
+            numbers.add(to_num)
+        numbers = list(numbers)
+
+        try:
+            # Take the write lock before reading, so the balances can't change before the updates
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            print(str(e))
+            return [(False, "Could not lock the database.")] * len(transfers)
+
+        # Resolve every account number in as few queries as possible
+        accounts = {}  # account number -> [id, balance, overdraft limit]
+        for start in range(0, len(numbers), MAX_IN_PARAMS):
+            chunk = numbers[start:start + MAX_IN_PARAMS]
+            stat, reply = self.__query("SELECT account_number, id, balance, overdraft_limit FROM accounts "
+                                       f"WHERE account_number IN ({', '.join('?' * len(chunk))})", chunk)
+            if not stat:
+                self.conn.rollback()
+                return [(False, reply)] * len(transfers)
+            for row in self.__fetchall():
+                accounts[row[0]] = [row[1], row[2], row[3]]
+
+        # Check each item against the running balances and build the ledger
+        net = {}  # account id -> total change
+        ledger = []
+        now = int(time() * 1000000)
+        for index, (from_num, to_num, amount) in enumerate(transfers):
+            from_acc = accounts.get(from_num)
+            to_acc = accounts.get(to_num)
+
+            if from_acc is None:
+                results[index] = (False, "Could not find from account")
+            elif to_acc is None:
+                results[index] = (False, "Could not find to account")
+            elif from_acc is to_acc:
+                results[index] = (False, "Can not transfer to the same account")
+            elif not isinstance(amount, int) or amount <= 0:
+                results[index] = (False, "Amount must be a positive number of pence")
+            elif from_acc[1] - amount < -from_acc[2]:
+                results[index] = (False, "Could not remove the money from the sender. "
+                                         "Reason: Insufficient funds available")
+            else:
+                from_acc[1] -= amount
+                to_acc[1] += amount
+                net[from_acc[0]] = net.get(from_acc[0], 0) - amount
+                net[to_acc[0]] = net.get(to_acc[0], 0) + amount
+                ledger.append((from_acc[0], now, -amount, from_acc[1], "transfer_out", str(to_acc[0])))
+                ledger.append((to_acc[0], now, amount, to_acc[1], "transfer_in", str(from_acc[0])))
+                results[index] = (True, "")
+
+        # One update per account, each still checks the overdraft limit against its netted result
+        for account_id, change in net.items():
+            if change == 0:
+                continue
+            stat, reply = self.__query("UPDATE accounts SET balance=balance+? "
+                                       "WHERE id=? AND balance+?>=-overdraft_limit",
+                                       (change, account_id, change))
+            if not stat or self.cursor.rowcount != 1:
+                self.conn.rollback()
+                return [(False, "Batch could not be applied, no transfers were made.")] * len(transfers)
+
+        if ledger:
+            stat, reply = self.__query_many("INSERT INTO transactions "
+                                            "(account_id, created_at, amount, balance_after, kind, reference) "
+                                            "VALUES (?, ?, ?, ?, ?, ?)", ledger)
+            if not stat:
+                self.conn.rollback()
+                return [(False, "Batch could not be applied, no transfers were made.")] * len(transfers)
+
+        self.conn.commit()
+        return results
+
+    def get_statement(self, account_id: int, start: float = None, end: float = None, limit: int = None) -> tuple:
+        """Return the ledger entries for an account, oldest first.
+        start and end are unix timestamps (seconds), end is exclusive."""
+        sql = "SELECT id, account_id, created_at, amount, balance_after, kind, reference " \
+              "FROM transactions WHERE account_id=?"
+        params = [account_id]
+
+        if start is not None:
+            sql += " AND created_at>=?"
+            params.append(int(start * 1000000))
+
+        if end is not None:
+            sql += " AND created_at<?"
+            params.append(int(end * 1000000))
+
+        sql += " ORDER BY created_at, id"
+
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+
+        stat, reply = self.__query(sql, params)
+        if not stat:
+            return [], reply
+
+        results = []
+        for row in self.__fetchall():
+            results.append({"id": row[0], "account_id": row[1], "time": row[2] / 1000000, "amount": row[3],
+                            "balance_after": row[4], "kind": row[5], "reference": row[6]})
+
+        return results, f"Query ran successfully. {len(results)} entries found."
+
+    def get_account_id_range(self) -> tuple:
+        """Return the lowest and highest account id, (None, None) if there are no accounts"""
+        stat, reply = self.__query("SELECT MIN(id), MAX(id) FROM accounts")
+        if not stat:
+            return None, None
+        return tuple(self.__fetchall()[0])
+
+    def get_bank_stats(self) -> dict:
+        """Return the running totals kept in bank_stats"""
+        stat, reply = self.__query(f"SELECT {', '.join(STATS_FIELDS)} FROM bank_stats WHERE id=1")
+        if not stat:
+            return {}
+
+        rows = self.__fetchall()
+        if len(rows) != 1:
+            return {}
+        return dict(zip(STATS_FIELDS, rows[0]))
+
+    def get_data_version(self):
+        """Return a number that changes whenever an account or customer changes, None if it can't be read"""
+        stat, reply = self.__query("SELECT version FROM bank_stats WHERE id=1")
+        if not stat:
+            return None
+
+        rows = self.__fetchall()
+        return rows[0][0] if rows else None
+
+    @holds_commit_lock
+    def rebuild_bank_stats(self) -> tuple:
+        """Work bank_stats out again from the tables"""
+        self.flush()
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            print(str(e))
+            return False, "Could not lock the database."
+
+        stat, reply = self.__query(STATS_REBUILD_SQL)
+        if stat:
+            row = self.__fetchall()[0]
+            # The version carries on counting up, so nothing cached from before the rebuild can match it
+            stat, reply = self.__query(f"INSERT INTO bank_stats (id, {', '.join(STATS_FIELDS)}) "
+                                       f"VALUES (1, {', '.join('?' * len(STATS_FIELDS))}) ON CONFLICT (id) DO UPDATE "
+                                       f"SET {', '.join(f'{field}=excluded.{field}' for field in STATS_FIELDS)}, "
+                                       "version=version+1", row)
+        if not stat:
+            self.conn.rollback()
+            return False, reply
+
+        self.conn.commit()
+        return True, "Rebuilt bank_stats."
+
+    def verify_bank_stats(self) -> tuple:
+        """Check bank_stats against the tables.
+        Returns status, reply and a dict of field -> (stored, actual) for the fields that don't match"""
+        stored = self.get_bank_stats()
+
+        stat, reply = self.__query(STATS_REBUILD_SQL)
+        if not stat:
+            return False, reply, {}
+        actual = dict(zip(STATS_FIELDS, self.__fetchall()[0]))
+
+        differences = {}
+        for field in STATS_FIELDS:
+            if field in STATS_FLOAT_FIELDS and field in stored and \
+                    abs(stored[field] - actual[field]) <= 1e-9 * max(1.0, abs(actual[field])):
+                continue
+            if stored.get(field) != actual[field]:
+                differences[field] = (stored.get(field), actual[field])
+
+        if differences:
+            return False, f"{len(differences)} totals don't match.", differences
+        return True, "bank_stats matches the tables.", differences
+
+    @holds_commit_lock
+    def rebuild_geo_stats(self) -> tuple:
+        """Work geo_stats out again from the tables"""
+        self.flush()
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            print(str(e))
+            return False, "Could not lock the database."
+
+        stat, reply = self.__query("DELETE FROM geo_stats")
+        if stat:
+            stat, reply = self.__query(f"INSERT INTO geo_stats (level, area, customers, accounts, total_balance) "
+                                       f"{GEO_REBUILD_SQL}")
+        if stat:
+            # So cached reports made from the old rows aren't used
+            stat, reply = self.__query("UPDATE bank_stats SET version=version+1 WHERE id=1")
+        if not stat:
+            self.conn.rollback()
+            return False, reply
+
+        self.conn.commit()
+        return True, "Rebuilt geo_stats."
+
+    def verify_geo_stats(self) -> tuple:
+        """Check geo_stats against the tables.
+        Returns status, reply and a dict of (level, area) -> (stored, actual) for the areas that don't match"""
+        stat, reply = self.__query("SELECT level, area, customers, accounts, total_balance FROM geo_stats "
+                                   "WHERE customers<>0 OR accounts<>0 OR total_balance<>0")
+        if not stat:
+            return False, reply, {}
+        stored = {(row[0], row[1]): tuple(row[2:]) for row in self.__fetchall()}
+
+        stat, reply = self.__query(GEO_REBUILD_SQL)
+        if not stat:
+            return False, reply, {}
+        actual = {(row[0], row[1]): tuple(row[2:]) for row in self.__fetchall()}
+
+        differences = {}
+        for key in set(stored).union(actual):
+            if stored.get(key) != actual.get(key):
+                differences[key] = (stored.get(key), actual.get(key))
+
+        if differences:
+            return False, f"{len(differences)} areas don't match.", differences
+        return True, "geo_stats matches the tables.", differences
+
+    def get_geo_stats(self, level: str = "city", sort: str = "customers", limit: int = 50, offset: int = 0) -> tuple:
+        """Return customers, accounts and total balance per city (level city) or postcode outward code (level
+        outward), a page of limit areas starting at offset, and how many areas there are"""
+        if level not in ("city", "outward") or sort not in GEO_SORTS:
+            return [], 0
+
+        stat, reply = self.__query("SELECT area, customers, accounts, total_balance FROM geo_stats "
+                                   "WHERE level=? AND (customers<>0 OR accounts<>0) "
+                                   f"ORDER BY {GEO_SORTS[sort]}, area LIMIT ? OFFSET ?", (level, limit, offset))
+        if not stat:
+            return [], 0
+
+        rows = [{"area": row[0], "customers": row[1], "accounts": row[2], "total_balance": row[3]}
+                for row in self.__fetchall()]
+
+        stat, reply = self.__query("SELECT COUNT(*) FROM geo_stats WHERE level=? AND (customers<>0 OR accounts<>0)",
+                                   (level,))
+        total = self.__fetchall()[0][0] if stat else len(rows)
+
+        return rows, total
+
+    def get_extreme_account(self, column: str, highest: bool = True):
+        """Return the account with the highest (or lowest) value in a column, the first by id on a tie"""
+        if column not in ("balance", "overdraft_limit", "interest_rate"):
+            return None
+
+        # MAX/MIN of an indexed column is one index lookup, and the ties come back from the index in id order
+        stat, reply = self.__query(f"SELECT id FROM accounts WHERE {column}=(SELECT {'MAX' if highest else 'MIN'}"
+                                   f"({column}) FROM accounts) ORDER BY id LIMIT 1")
+        if not stat:
+            return None
+
+        rows = self.__fetchall()
+        if len(rows) != 1:
+            return None
+
+        accounts, reply = self.get_accounts(accid=rows[0][0])
+        return accounts[0] if accounts else None
+
+    def iter_export(self, name: str, batch_size: int = 10000):
+        """Yield the column names of an export (see EXPORT_SQL), then its rows in batches (lists of tuples).
+        The rows are stepped through on their own cursor, so only one batch is held in memory at a time."""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(EXPORT_SQL[name])
+            yield [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def iter_sorted_values(self, metric: str, batch_size: int = 10000):
+        """Yield every value of a distribution metric in ascending order.
+        The rows are fetched in batches on their own cursor, so memory use doesn't grow with the table."""
+        expression, where = DISTRIBUTION_METRICS[metric]
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"SELECT {expression} AS value FROM accounts WHERE {where} ORDER BY value")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+        finally:
+            cursor.close()
+
+    def get_metric_count(self, metric: str) -> int:
+        """Return the number of accounts a distribution metric covers"""
+        expression, where = DISTRIBUTION_METRICS[metric]
+        stat, reply = self.__query(f"SELECT COUNT(*) FROM accounts WHERE {where}")
+        if not stat:
+            return 0
+        return self.__fetchall()[0][0]
+
+    def get_band_counts(self, metric: str, edges) -> list:
+        """Count and total the values of a distribution metric in bands split at the (ascending) edges.
+        Band 0 is below the first edge and band len(edges) is at or above the last.
+        Returns (band, count, total) for the bands that have any accounts."""
+        expression, where = DISTRIBUTION_METRICS[metric]
+        if not edges:
+            band = "0"
         else:
-            return False, query_reply
+            band = "CASE " + " ".join(f"WHEN value<? THEN {index}" for index in range(len(edges))) + \
+                   f" ELSE {len(edges)} END"
+
+        stat, reply = self.__query(f"SELECT {band} AS band, COUNT(*), SUM(value) FROM "
+                                   f"(SELECT {expression} AS value FROM accounts WHERE {where}) "
+                                   "GROUP BY band ORDER BY band", list(edges))
+        if not stat:
+            return []
+        return self.__fetchall()
+
+    def get_overdraft_risk(self, near_limit: float = 0.9) -> dict:
+        """Return the number of overdrawn accounts, how much they owe, and how many are near or past their limit"""
+        # "balance<0" has to be in the WHERE as written for sqlite to use the partial index
+        stat, reply = self.__query("SELECT COUNT(*), COALESCE(SUM(-balance), 0), COALESCE(SUM(overdraft_limit), 0), "
+                                   "COALESCE(SUM(-balance>overdraft_limit), 0), "
+                                   "COALESCE(SUM(-balance>=overdraft_limit*?), 0) "
+                                   "FROM accounts WHERE balance<0",
+                                   (near_limit,))
+        if not stat:
+            return {}
+
+        row = self.__fetchall()[0]
+        return {"overdrawn": row[0], "exposure": row[1], "overdrawn_limits": row[2], "over_limit": row[3],
+                "near_limit": row[4]}
+
+    def get_most_overdrawn(self, top: int = 10) -> list:
+        """Return the overdrawn accounts using the most of their overdraft, most used first.
+        Accounts with no overdraft limit that are overdrawn come first as they are past their limit."""
+        stat, reply = self.__query("SELECT id, account_number, customer_id, balance, overdraft_limit, "
+                                   "CASE WHEN overdraft_limit>0 THEN CAST(-balance AS REAL) / overdraft_limit "
+                                   "ELSE NULL END AS utilisation "
+                                   "FROM accounts WHERE balance<0 "
+                                   "ORDER BY utilisation IS NOT NULL, utilisation DESC, balance LIMIT ?", (top,))
+        if not stat:
+            return []
+
+        return [{"account_id": row[0], "account_number": row[1], "customer_id": row[2], "balance": row[3],
+                 "overdraft_limit": row[4], "utilisation": row[5]} for row in self.__fetchall()]
+
+    def get_customer_rollup(self, sort: str = "balance", limit: int = 50, offset: int = 0,
+                            min_accounts: int = None) -> tuple:
+        """Return per customer account counts, total balances and overdraft exposure from one GROUP BY, sorted
+        highest first by sort (see ROLLUP_SORTS), a page of limit rows starting at offset.
+        Returns the rows as dicts and how many customers there are in total (with at least min_accounts)."""
+        if sort not in ROLLUP_SORTS:
+            return [], 0
+        if min_accounts is not None and min_accounts <= 0:
+            # Every customer has at least 0 accounts
+            min_accounts = None
+
+        having = ""
+        params = []
+        if min_accounts is not None:
+            having = " HAVING COUNT(accounts.id)>=?"
+            params.append(min_accounts)
+
+        stat, reply = self.__query(f"{ROLLUP_SQL}{having} ORDER BY {ROLLUP_SORTS[sort]} DESC, customers.id "
+                                   "LIMIT ? OFFSET ?", params + [limit, offset])
+        if not stat:
+            return [], 0
+
+        rows = [dict(zip(ROLLUP_FIELDS, row)) for row in self.__fetchall()]
+
+        # Without a filter every customer is in the rollup
+        if min_accounts is None:
+            stat, reply = self.__query("SELECT COUNT(*) FROM customers")
+        else:
+            stat, reply = self.__query("SELECT COUNT(*) FROM (SELECT customer_id FROM accounts GROUP BY customer_id "
+                                       "HAVING COUNT(*)>=?)", (min_accounts,))
+        total = self.__fetchall()[0][0] if stat else len(rows)
+
+        return rows, total
+
+    def get_top_customers(self, limit: int = 10) -> dict:
+        """Return the first limit rows of the customer rollup for each of TOP_CUSTOMER_SORTS, as sort -> rows.
+        The rollup is worked out once (sqlite materialises a CTE that is used more than once) and each list is a
+        top-N pass over it, rather than a GROUP BY over every account per list."""
+        tops = " UNION ALL ".join(f"SELECT * FROM (SELECT '{sort}', * FROM rollup "
+                                  f"ORDER BY {ROLLUP_SORTS[sort]} DESC, id LIMIT ?)" for sort in TOP_CUSTOMER_SORTS)
+        stat, reply = self.__query(f"WITH rollup AS ({ROLLUP_SQL}) {tops}", [limit] * len(TOP_CUSTOMER_SORTS))
+
+        results = {sort: [] for sort in TOP_CUSTOMER_SORTS}
+        if not stat:
+            return results
+
+        for row in self.__fetchall():
+            results[row[0]].append(dict(zip(ROLLUP_FIELDS, row[1:])))
+        return results
+
+    def get_customers_with_accounts(self) -> int:
+        """Return how many customers have at least one account, counted off the customer_id index"""
+        stat, reply = self.__query("SELECT COUNT(DISTINCT customer_id) FROM accounts")
+        if not stat:
+            return 0
+        return self.__fetchall()[0][0]
+
+    def get_balance_totals_by_rate(self) -> list:
+        """Return (account type, interest rate, accounts, total balance) for the accounts in credit, grouped by type
+        and rate"""
+        stat, reply = self.__query("SELECT account_name, interest_rate, COUNT(*), SUM(balance) FROM accounts "
+                                   "WHERE balance>0 GROUP BY account_name, interest_rate")
+        if not stat:
+            return []
+        return self.__fetchall()
+
+    def get_interest_rows(self, after_id: int, last_id: int, limit: int) -> tuple:
+        """Return (status, reply, rows), up to limit (id, balance, interest rate) rows with ids in (after_id, last_id]
+        in id order. A failed read is a False status, not an empty list, so it is never taken as the end of the ids."""
+        stat, reply = self.__query("SELECT id, balance, interest_rate FROM accounts WHERE id>? AND id<=? "
+                                   "ORDER BY id LIMIT ?", (after_id, last_id, limit))
+        if not stat:
+            return False, reply, []
+        return True, reply, self.__fetchall()
+
+    def get_interest_run(self, run_id: str) -> list:
+        """Return the partitions of an interest run as dicts, in partition order"""
+        stat, reply = self.__query("SELECT partition, first_id, last_id, checkpoint_id, accounts, interest, "
+                                   "started_at, finished_at FROM interest_runs WHERE run_id=? ORDER BY partition",
+                                   (run_id,))
+        if not stat:
+            return []
+
+        return [{"partition": row[0], "first_id": row[1], "last_id": row[2], "checkpoint_id": row[3],
+                 "accounts": row[4], "interest": row[5], "started_at": row[6] / 1000000,
+                 "finished_at": None if row[7] is None else row[7] / 1000000} for row in self.__fetchall()]
+
+    @holds_commit_lock
+    def start_interest_partition(self, run_id: str, partition: int, first_id: int, last_id: int) -> tuple:
+        """Record the start of a partition of an interest run, does nothing if it was already started"""
+        self.flush()
+        stat, reply = self.__query("INSERT OR IGNORE INTO interest_runs "
+                                   "(run_id, partition, first_id, last_id, checkpoint_id, started_at) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)",
+                                   (run_id, partition, first_id, last_id, first_id - 1, int(time() * 1000000)))
+        if stat:
+            self.conn.commit()
+        return stat, reply
+
+    @holds_commit_lock
+    def apply_interest(self, run_id: str, partition: int, entries: list, checkpoint_id: int) -> tuple:
+        """Add a chunk of (account id, interest in pence) to the balances, write their ledger entries and move the
+        partition's checkpoint to checkpoint_id, all in one transaction. So after a crash either the whole chunk
+        was applied and the checkpoint is past it, or none of it was."""
+        if not self.connected:
+            return False, "Not connected to database."
+
+        self.flush()
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            print(str(e))
+            return False, "Could not lock the database."
+
+        # Only apply the chunk if the checkpoint hasn't already passed it, e.g. a resumed writer sending it twice
+        stat, reply = self.__query("UPDATE interest_runs SET checkpoint_id=?, accounts=accounts+?, interest=interest+? "
+                                   "WHERE run_id=? AND partition=? AND checkpoint_id<? AND finished_at IS NULL",
+                                   (checkpoint_id, len(entries), sum(interest for account_id, interest in entries),
+                                    run_id, partition, checkpoint_id))
+        if not stat or self.cursor.rowcount != 1:
+            self.conn.rollback()
+            return False, reply if not stat else "Chunk was already applied."
+
+        if entries:
+            stat, reply = self.__query_many("UPDATE accounts SET balance=balance+? WHERE id=?",
+                                            [(interest, account_id) for account_id, interest in entries])
+
+            if stat:
+                # Read the new balances back for the ledger, the chunk is a contiguous range of ids
+                stat, reply = self.__query("SELECT id, balance FROM accounts WHERE id>=? AND id<=?",
+                                           (entries[0][0], entries[-1][0]))
+            if stat:
+                balances = dict(self.__fetchall())
+                now = int(time() * 1000000)
+                stat, reply = self.__query_many("INSERT INTO transactions "
+                                                "(account_id, created_at, amount, balance_after, kind, reference) "
+                                                "VALUES (?, ?, ?, ?, 'interest', ?)",
+                                                [(account_id, now, interest, balances[account_id], run_id)
+                                                 for account_id, interest in entries])
+            if not stat:
+                self.conn.rollback()
+                return False, reply
+
+        self.conn.commit()
+        return True, f"Applied interest to {len(entries)} accounts."
+
+    @holds_commit_lock
+    def finish_interest_partition(self, run_id: str, partition: int) -> tuple:
+        """Mark a partition of an interest run as done"""
+        self.flush()
+        stat, reply = self.__query("UPDATE interest_runs SET checkpoint_id=last_id, finished_at=? "
+                                   "WHERE run_id=? AND partition=? AND finished_at IS NULL",
+                                   (int(time() * 1000000), run_id, partition))
+        if stat:
+            self.conn.commit()
+        return stat, reply
+
+    def get_import_run(self, import_id: str, kind: str):
+        """The progress of one file (customers or accounts) of an import, None if it hasn't been started"""
+        stat, reply = self.__query("SELECT source, checkpoint, imported, rejected, started_at, finished_at "
+                                   "FROM import_runs WHERE import_id=? AND kind=?", (import_id, kind))
+        if not stat:
+            return None
+        rows = self.__fetchall()
+        if not rows:
+            return None
+
+        row = rows[0]
+        return {"import_id": import_id, "kind": kind, "source": row[0], "checkpoint": row[1], "imported": row[2],
+                "rejected": row[3], "started_at": row[4] / 1000000,
+                "finished_at": None if row[5] is None else row[5] / 1000000}
+
+    @holds_commit_lock
+    def start_import(self, import_id: str, kind: str, source: str) -> tuple:
+        """Record the start of an import of one file, does nothing if it was already started"""
+        self.flush()
+        stat, reply = self.__query("INSERT OR IGNORE INTO import_runs (import_id, kind, source, started_at) "
+                                   "VALUES (?, ?, ?, ?)", (import_id, kind, source, int(time() * 1000000)))
+        if stat:
+            self.conn.commit()
+        return stat, reply
+
+    @holds_commit_lock
+    def finish_import(self, import_id: str, kind: str) -> tuple:
+        """Mark the import of one file as done"""
+        self.flush()
+        stat, reply = self.__query("UPDATE import_runs SET finished_at=? "
+                                   "WHERE import_id=? AND kind=? AND finished_at IS NULL",
+                                   (int(time() * 1000000), import_id, kind))
+        if stat:
+            self.conn.commit()
+        return stat, reply
+
+    def __next_id(self, table: str):
+        """The id the next row of an autoincrement table would get, only stays right while the write lock is held"""
+        stat, reply = self.__query(f"SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name='{table}'), 0), "
+                                   f"COALESCE((SELECT MAX(id) FROM {table}), 0)) + 1")
+        return self.__fetchall()[0][0] if stat else None
+
+    def __fetch_in(self, query: str, values: list, params=()) -> tuple:
+        """Run a query ending in IN ( for every chunk of values and return all the rows"""
+        rows = []
+        for start in range(0, len(values), MAX_IN_PARAMS):
+            chunk = values[start:start + MAX_IN_PARAMS]
+            stat, reply = self.__query(f"{query}{', '.join('?' * len(chunk))})", tuple(params) + tuple(chunk))
+            if not stat:
+                return False, reply, rows
+            rows += self.__fetchall()
+        return True, "", rows
+
+    def __allocate_account_numbers(self, count: int, avoid=()):
+        """Find a run of count unused account numbers, starting at a random place so imports don't pile up in one
+        part of the range. Only one query is needed however big the block. Needs the write lock to be held until
+        the numbers are used. Returns None if no free block was found."""
+        if count == 0:
+            return range(0)
+
+        for attempt in range(ACCOUNT_NUMBER_BLOCK_ATTEMPTS):
+            first = randint(ACCOUNT_NUMBER_MIN, ACCOUNT_NUMBER_MAX - count + 1)
+            last = first + count - 1
+            stat, reply = self.__query("SELECT 1 FROM accounts WHERE account_number>=? AND account_number<=? LIMIT 1",
+                                       (first, last))
+            if not stat:
+                return None
+            if not self.__fetchall() and not any(first <= number <= last for number in avoid):
+                return range(first, last + 1)
+        return None
+
+    def __finish_import_batch(self, import_id: str, kind: str, checkpoint: int, imported: int, rejects: list,
+                              before_commit) -> tuple:
+        """Move the import's checkpoint and commit the batch, or roll it back if the checkpoint has already passed it"""
+        stat, reply = self.__query("UPDATE import_runs SET checkpoint=?, imported=imported+?, rejected=rejected+? "
+                                   "WHERE import_id=? AND kind=? AND checkpoint<? AND finished_at IS NULL",
+                                   (checkpoint, imported, len(rejects), import_id, kind, checkpoint))
+        if not stat or self.cursor.rowcount != 1:
+            self.conn.rollback()
+            return False, reply if not stat else "Batch was already imported.", rejects
+
+        if before_commit is not None:
+            try:
+                before_commit(rejects)
+            except Exception as e:
+                self.conn.rollback()
+                return False, f"Batch was not imported. Reason: {str(e)}", rejects
+
+        self.conn.commit()
+        return True, f"Imported {imported} {kind}.", rejects
+
+    @holds_commit_lock
+    def import_customers(self, import_id: str, rows: list, checkpoint: int, rejects: list = None,
+                         before_commit=None) -> tuple:
+        """Insert a batch of validated customers (row number, source id, first name, last name, 5 address fields)
+        in one transaction, recording the new id of each source id and moving the import's checkpoint to checkpoint.
+        rejects are the (row number, reason) of the rows of the batch that failed validation, rows whose source id
+        was already imported are added to them. before_commit is called with the rejects just before committing,
+        so they can be written out knowing the batch will be kept.
+        Returns (stat, reply, rejects)."""
+        rejects = list(rejects or [])
+        if not self.connected:
+            return False, "Not connected to database.", rejects
 
+        self.flush()
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            print(str(e))
+            return False, "Could not lock the database.", rejects
+
+        stat, reply, existing = self.__fetch_in("SELECT source_id FROM import_customer_ids "
+                                                "WHERE import_id=? AND source_id IN (",
+                                                list({row[1] for row in rows}), (import_id,))
+        if not stat:
+            self.conn.rollback()
+            return False, reply, rejects
+
+        seen = {row[0] for row in existing}
+        accepted = []
+        for row in rows:
+            if row[1] in seen:
+                rejects.append((row[0], f"Customer id {row[1]} was already imported"))
+            else:
+                seen.add(row[1])
+                accepted.append(row)
+
+        # The ids are given rather than left to sqlite, so the mapping can be written with executemany too
+        next_id = self.__next_id("customers")
+        stat = next_id is not None
+        if stat and accepted:
+            stat, reply = self.__query_many("INSERT INTO customers (id, first_name, last_name, address_line1, "
+                                            "address_line2, address_line3, address_city, address_postcode) "
+                                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                            [(next_id + index,) + tuple(row[2:]) for index, row in enumerate(accepted)])
+            if stat:
+                stat, reply = self.__query_many("INSERT INTO import_customer_ids (import_id, source_id, customer_id) "
+                                                "VALUES (?, ?, ?)",
+                                                [(import_id, row[1], next_id + index)
+                                                 for index, row in enumerate(accepted)])
+        if not stat:
+            self.conn.rollback()
+            return False, reply, rejects
+
+        return self.__finish_import_batch(import_id, "customers", checkpoint, len(accepted), rejects, before_commit)
+
+    @holds_commit_lock
+    def import_accounts(self, import_id: str, rows: list, checkpoint: int, rejects: list = None,
+                        before_commit=None, customer_import_id: str = None) -> tuple:
+        """Insert a batch of validated accounts (row number, customer source id, account name, account number or
+        None, balance, interest rate, overdraft limit) in one transaction and move the import's checkpoint.
+        Customer source ids are looked up in the customers imported under customer_import_id (import_id if None).
+        Accounts without a number are given one from a single block allocated for the batch. Opening balances
+        get an 'import' ledger entry. rejects and before_commit work as they do for import_customers.
+        Returns (stat, reply, rejects)."""
+        rejects = list(rejects or [])
+        if not self.connected:
+            return False, "Not connected to database.", rejects
+
+        self.flush()
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            print(str(e))
+            return False, "Could not lock the database.", rejects
+
+        stat, reply, customers = self.__fetch_in("SELECT source_id, customer_id FROM import_customer_ids "
+                                                 "WHERE import_id=? AND source_id IN (",
+                                                 list({row[1] for row in rows}),
+                                                 (customer_import_id or import_id,))
+        if stat:
+            stat, reply, taken = self.__fetch_in("SELECT account_number FROM accounts WHERE account_number IN (",
+                                                 list({row[3] for row in rows if row[3] is not None}))
+        if not stat:
+            self.conn.rollback()
+            return False, reply, rejects
+
+        customers = dict(customers)
+        numbers = {row[0] for row in taken}
+        accepted = []
+        for row in rows:
+            if row[1] not in customers:
+                rejects.append((row[0], f"Customer id {row[1]} has not been imported"))
+            elif row[3] is not None and row[3] in numbers:
+                rejects.append((row[0], f"Account number {row[3]} is already used"))
+            else:
+                if row[3] is not None:
+                    numbers.add(row[3])
+                accepted.append(row)
+
+        block = self.__allocate_account_numbers(sum(row[3] is None for row in accepted), numbers)
+        next_id = self.__next_id("accounts")
+        if block is None or next_id is None:
+            self.conn.rollback()
+            return False, "Could not allocate account numbers.", rejects
+        block = iter(block)
+
+        accounts = []
+        ledger = []
+        now = int(time() * 1000000)
+        for index, row in enumerate(accepted):
+            accounts.append((next_id + index, customers[row[1]], row[2],
+                             next(block) if row[3] is None else row[3], row[4], row[5], row[6]))
+            if row[4] != 0:
+                ledger.append((next_id + index, now, row[4], row[4], import_id))
+
+        stat = True
+        if accounts:
+            stat, reply = self.__query_many("INSERT INTO accounts (id, customer_id, account_name, account_number, "
+                                            "balance, interest_rate, overdraft_limit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                            accounts)
+        if stat and ledger:
+            stat, reply = self.__query_many("INSERT INTO transactions "
+                                            "(account_id, created_at, amount, balance_after, kind, reference) "
+                                            "VALUES (?, ?, ?, ?, 'import', ?)", ledger)
+        if not stat:
+            self.conn.rollback()
+            return False, reply, rejects
+
+        return self.__finish_import_batch(import_id, "accounts", checkpoint, len(accounts), rejects, before_commit)
+
+    @holds_commit_lock
     def update_customer(self, cid, fname: str = None, lname: str = None, addr: list = None):
         """Update the customer entry"""
         if fname is None and lname is None and addr == [None, None, None, None, None]:
@@ -399,25 +1826,25 @@ class Connection:
                   "SET "
 
             if fname is not None:
-                sql += f"first_name='{str(fname)}', "
+                sql += f"first_name='{sql_text(fname)}', "
 
             if lname is not None:
-                sql += f"last_name='{str(lname)}', "
+                sql += f"last_name='{sql_text(lname)}', "
 
             if addr[0] is not None:
-                sql += f"address_line1='{str(addr[0])}', "
+                sql += f"address_line1='{sql_text(addr[0])}', "
 
             if addr[1] is not None:
-                sql += f"address_line2='{str(addr[1])}', "
+                sql += f"address_line2='{sql_text(addr[1])}', "
 
             if addr[2] is not None:
-                sql += f"address_line3='{str(addr[2])}', "
+                sql += f"address_line3='{sql_text(addr[2])}', "
 
             if addr[3] is not None:
-                sql += f"address_city='{str(addr[3])}', "
+                sql += f"address_city='{sql_text(addr[3])}', "
 
             if addr[4] is not None:
-                sql += f"address_postcode='{str(addr[4])}', "
+                sql += f"address_postcode='{sql_text(addr[4])}', "
 
             # Remove the comma and space that are at the end.
             sql = sql[:-2]
@@ -433,6 +1860,7 @@ class Connection:
             else:
                 return False, repl, None
 
+    @holds_commit_lock
     def update_account(self, accid, account_name: str = None, overdraft_limit: int = None,
                        interest_rate: float = None) -> tuple:
         """Update the account details with the given data"""
@@ -442,7 +1870,7 @@ class Connection:
             sql = "UPDATE accounts SET "
 
             if account_name is not None:
-                sql += f"account_name='{account_name}', "
+                sql += f"account_name='{sql_text(account_name)}', "
 
             if overdraft_limit is not None:
                 sql += f"overdraft_limit={overdraft_limit}, "
@@ -468,6 +1896,7 @@ class Connection:
             else:
                 return status, reply, None
 
+    @holds_commit_lock
     def update_admin(self, adid, first_name: str = None, last_name: str = None, username: str = None,
                      addr_l1: str = None, addr_l2: str = None, addr_l3: str = None,
                      addr_city: str = None, addr_post: str = None,
@@ -525,6 +1954,7 @@ class Connection:
             else:
                 return status, reply, None
 
+    @holds_commit_lock
     def update_admin_password(self, adid: int, new_hash: str) -> bool:
         """Updates the accounts hash with the new one provided"""
         sql = f"UPDATE admins SET password_hash='{new_hash}' WHERE id={adid}"
@@ -537,28 +1967,33 @@ class Connection:
         return stat, repl
 
     # Create new table entries
+    @holds_commit_lock
     def create_customer(self, fname: str, lname: str, addr: list) -> tuple:
         """Create a new table entry for the customer"""
         sql = f"INSERT INTO customers " \
               f"(first_name, last_name, address_line1, address_line2, address_line3, address_city, address_postcode)" \
-              f"VALUES ('{fname}', '{lname}', '{addr[0]}', '{addr[1]}', '{addr[2]}', '{addr[3]}', '{addr[4]}')"
+              f"VALUES ('{sql_text(fname)}', '{sql_text(lname)}', '{sql_text(addr[0])}', '{sql_text(addr[1])}', " \
+              f"'{sql_text(addr[2])}', '{sql_text(addr[3])}', '{sql_text(addr[4])}')"
 
         stat, repl = self.__query(sql)
         self.conn.commit()
         cid = self.cursor.lastrowid
         return stat, repl, cid
 
+    @holds_commit_lock
     def create_account(self, account_name: str, account_number: int, interest_rate: float, overdraft_limit: int,
                        customer_id: int) -> tuple:
         """Create a new account"""
         sql = f"INSERT INTO accounts (account_name, account_number, balance, interest_rate, overdraft_limit, customer_id) " \
-              f"VALUES ('{account_name}', {account_number}, 0, {interest_rate}, {overdraft_limit}, {customer_id})"
+              f"VALUES ('{sql_text(account_name)}', {account_number}, 0, {interest_rate}, {overdraft_limit}, " \
+              f"{customer_id})"
 
         stat, repl = self.__query(sql)
         self.conn.commit()
         accid = self.cursor.lastrowid
         return stat, repl, accid
 
+    @holds_commit_lock
     def create_admin_account(self, fname: str, lname: str, addr: list,
                              username: str, pass_hash: str, full_rights: int) -> tuple:
         """add an admin account"""
@@ -573,6 +2008,7 @@ class Connection:
         return stat, repl, adid
 
     # Delete table rows
+    @holds_commit_lock
     def delete_customer(self, cid):
         """Remove the customer row"""
 
@@ -584,6 +2020,7 @@ class Connection:
             self.conn.commit()
         return stat, repl
 
+    @holds_commit_lock
     def delete_account(self, accid):
         """Remove the account row"""
 
@@ -0,0 +1,80 @@
+import math
+
+DEFAULT_PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+DEFAULT_BUCKETS = 10  # Equal sized buckets, 10 gives deciles
+
+# Where the bands of each metric are split
+DEFAULT_BANDS = {"balance": (-100000, -10000, 0, 10000, 100000, 1000000, 10000000),  # Pence
+                 "overdraft_utilisation": (0.25, 0.5, 0.75, 0.9, 1.0),
+                 "interest_rate": (1, 2, 3, 5)}  # Percent
+
+
+def summarise_sorted(values, count: int, percentiles=DEFAULT_PERCENTILES, buckets: int = DEFAULT_BUCKETS) -> dict:
+    """Work out nearest rank percentiles and equal sized buckets in one pass over values in ascending order.
+    Only the answers are kept, so this works on any number of values. count must be how many values there are."""
+    result = {"count": count, "min": None, "max": None, "mean": 0.0,
+              "percentiles": {pct: None for pct in percentiles}, "buckets": []}
+    if count == 0:
+        return result
+
+    # Rank (1 based) of each percentile, several percentiles can share a rank
+    ranks = {}
+    for pct in percentiles:
+        ranks.setdefault(max(1, math.ceil(pct / 100 * count)), []).append(pct)
+
+    # Last rank of each bucket
+    buckets = min(buckets, count)
+    bucket_ends = [(index + 1) * count // buckets for index in range(buckets)]
+    bucket = {"lower": None, "upper": None, "count": 0, "total": 0}
+
+    total = 0
+    rank = 0
+    for value in values:
+        rank += 1
+        total += value
+
+        if rank == 1:
+            result["min"] = value
+        for pct in ranks.get(rank, ()):
+            result["percentiles"][pct] = value
+
+        if bucket["count"] == 0:
+            bucket["lower"] = value
+        bucket["count"] += 1
+        bucket["total"] += value
+        if rank == bucket_ends[len(result["buckets"])]:
+            bucket["upper"] = value
+            result["buckets"].append(bucket)
+            bucket = {"lower": None, "upper": None, "count": 0, "total": 0}
+
+        if rank == count:
+            result["max"] = value
+            break
+
+    if rank < count:
+        # The table shrank between counting and reading, finish with what was read
+        result["count"] = rank
+        result["max"] = value if rank else None
+        if bucket["count"]:
+            bucket["upper"] = value
+            result["buckets"].append(bucket)
+
+    result["mean"] = total / rank if rank else 0.0
+    return result
+
+
+def label_bands(band_counts, edges) -> list:
+    """Turn (band, count, total) rows into a full list of bands with their edges, including empty bands"""
+    counts = {band: (count, total) for band, count, total in band_counts}
+    bands = []
+    for index in range(len(edges) + 1):
+        count, total = counts.get(index, (0, 0))
+        bands.append({"lower": edges[index - 1] if index > 0 else None,
+                      "upper": edges[index] if index < len(edges) else None,
+                      "count": count, "total": total or 0})
+    return bands
+
+
+if __name__ == "__main__":
+    print("Module Only use")
+    exit()
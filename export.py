@@ -0,0 +1,95 @@
+import csv
+import gzip
+import json
+from time import perf_counter
+
+from connection import Connection, EXPORT_SQL
+
+FORMATS = ("csv", "jsonl")
+DEFAULT_BATCH_SIZE = 10000
+
+
+def open_output(filepath: str, compress: bool = None):
+    """Open the file to write text to, gzipped if compress is set (or, if it is None, the name ends in .gz)"""
+    if compress is None:
+        compress = filepath.endswith(".gz")
+    if compress:
+        return gzip.open(filepath, "wt", encoding="utf-8", newline="")
+    return open(filepath, "w", encoding="utf-8", newline="")
+
+
+def guess_format(filepath: str) -> str:
+    """Work out the format from the file name, csv unless it ends in .jsonl or .json (optionally with .gz)"""
+    name = filepath[:-3] if filepath.endswith(".gz") else filepath
+    return "jsonl" if name.endswith((".jsonl", ".json")) else "csv"
+
+
+def export_rows(connection: Connection, name: str, filepath: str, file_format: str = None, compress: bool = None,
+                batch_size: int = DEFAULT_BATCH_SIZE, progress=None) -> dict:
+    """Write one of the EXPORT_SQL exports to a CSV (with a header row) or JSON Lines file.
+    Rows are read and written a batch at a time, so any number of rows takes the same memory.
+    progress is called with the number of rows written so far after each batch.
+    The export is one SELECT, so it is a consistent snapshot, but writers have to wait for it to finish unless the
+    database is in WAL mode."""
+    if name not in EXPORT_SQL:
+        raise ValueError(f"Unknown export: {name}")
+    if file_format is None:
+        file_format = guess_format(filepath)
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown format: {file_format}")
+
+    start = perf_counter()
+    rows_written = 0
+
+    batches = connection.iter_export(name, batch_size)
+    columns = next(batches)
+
+    with open_output(filepath, compress) as file:
+        if file_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            for rows in batches:
+                writer.writerows(rows)
+                rows_written += len(rows)
+                if progress is not None:
+                    progress(rows_written)
+        else:
+            for rows in batches:
+                file.write("".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows))
+                rows_written += len(rows)
+                if progress is not None:
+                    progress(rows_written)
+
+    seconds = perf_counter() - start
+    return {"export": name, "file": filepath, "format": file_format, "rows": rows_written, "seconds": seconds,
+            "rows_per_second": rows_written / seconds if seconds else 0.0}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export customers, accounts or reports to CSV or JSON Lines.")
+    parser.add_argument("export", choices=sorted(EXPORT_SQL))
+    parser.add_argument("output", help="File to write, .jsonl for JSON Lines, add .gz to compress.")
+    parser.add_argument("--db", default="Files/Data/data.db")
+    parser.add_argument("--format", choices=FORMATS, default=None, help="Defaults to the output file's extension.")
+    parser.add_argument("--gzip", action="store_true", default=None, help="Compress even without a .gz name.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--quiet", action="store_true", help="Don't print progress.")
+    args = parser.parse_args()
+
+    def progress(done):
+        print(f"{done} rows", flush=True)
+
+    connection = Connection(db_filepath=args.db)
+    try:
+        summary = export_rows(connection, args.export, args.output, args.format, args.gzip, args.batch_size,
+                              None if args.quiet else progress)
+    finally:
+        connection.close_connection()
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
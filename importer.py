@@ -0,0 +1,483 @@
+import csv
+import gzip
+import json
+import math
+import os
+from collections import deque
+from itertools import islice
+from time import perf_counter
+
+from connection import Connection, ACCOUNT_NUMBER_MIN, ACCOUNT_NUMBER_MAX
+from export import FORMATS, guess_format
+
+KINDS = ("customers", "accounts")
+DEFAULT_BATCH_SIZE = 20000
+# Rows handed to a worker at a time by import_file_parallel
+DEFAULT_CHUNK_SIZE = 2000
+# Chunks read ahead for each worker, enough to keep them busy while the writer is inserting
+CHUNKS_IN_FLIGHT_PER_WORKER = 4
+# Fields read from each row. They have the same names as the customers and accounts exports, so an export can be
+# imported again. id and customer_id are the ids in the source system, they are mapped to the new ids.
+CUSTOMER_FIELDS = ("id", "first_name", "last_name", "address_line1", "address_line2", "address_line3",
+                   "address_city", "address_postcode")
+ACCOUNT_FIELDS = ("customer_id", "account_name", "account_number", "balance", "interest_rate", "overdraft_limit")
+
+
+def open_input(filepath: str):
+    """Open a file to read text from, gunzipping it if the name ends in .gz"""
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "rt", encoding="utf-8", newline="")
+    return open(filepath, "r", encoding="utf-8", newline="")
+
+
+def parse_json_line(line: str):
+    """A JSON line as a dict, or its text if it can't be read, so it can be rejected without stopping the import"""
+    try:
+        return json.loads(line)
+    except ValueError:
+        return line.rstrip("\r\n")
+
+
+def read_records(filepath: str, file_format: str = None):
+    """Yield each row of a CSV (with a header row) or JSON Lines file as a dict (see parse_json_line)"""
+    if file_format is None:
+        file_format = guess_format(filepath)
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown format: {file_format}")
+
+    with open_input(filepath) as file:
+        if file_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if not line.strip():
+                    continue
+                yield parse_json_line(line)
+
+
+def text_field(record: dict, field: str, required: bool = True):
+    """A text field with the spaces trimmed off, None if it is empty and not required"""
+    value = record.get(field)
+    value = "" if value is None else str(value).strip()
+    if value == "":
+        if required:
+            raise ValueError(f"{field} is required")
+        return None
+    return value
+
+
+def pence_field(record: dict, field: str, default: int = None) -> int:
+    """A whole number of pence, written as an integer (e.g. 1050 for £10.50)"""
+    value = record.get(field)
+    if value is None or value == "":
+        if default is None:
+            raise ValueError(f"{field} is required")
+        return default
+
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be a whole number of pence")
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip("-").isdigit():
+            value = int(value)
+    if not isinstance(value, int):
+        raise ValueError(f"{field} must be a whole number of pence")
+    return value
+
+
+def validate_customer(record) -> tuple:
+    """Check a customer row and return (source id, first name, last name, the 5 address fields).
+    The address can be given as its own fields or, in JSON Lines, as an 'address' list of 5.
+    Raises ValueError saying what is wrong."""
+    if not isinstance(record, dict):
+        raise ValueError("Row is not a JSON object")
+
+    if "address" in record:
+        address = record["address"]
+        if not isinstance(address, list) or len(address) != 5:
+            raise ValueError("address must be a list of 5 fields")
+        record = dict(record, **dict(zip(CUSTOMER_FIELDS[3:], address)))
+
+    return (text_field(record, "id"), text_field(record, "first_name"), text_field(record, "last_name"),
+            text_field(record, "address_line1"), text_field(record, "address_line2", False) or "",
+            text_field(record, "address_line3", False) or "", text_field(record, "address_city"),
+            text_field(record, "address_postcode"))
+
+
+def validate_account(record, keep_account_numbers: bool = True) -> tuple:
+    """Check an account row and return (customer source id, account name, account number or None, balance,
+    interest rate, overdraft limit). The account number is None if it isn't given, or keep_account_numbers is off,
+    and one is allocated when it is inserted. Raises ValueError saying what is wrong."""
+    if not isinstance(record, dict):
+        raise ValueError("Row is not a JSON object")
+
+    account_number = None
+    if keep_account_numbers and record.get("account_number") not in (None, ""):
+        account_number = pence_field(record, "account_number")
+        if not ACCOUNT_NUMBER_MIN <= account_number <= ACCOUNT_NUMBER_MAX:
+            raise ValueError("account_number must be 16 digits")
+
+    try:
+        interest_rate = float(record.get("interest_rate"))
+    except (TypeError, ValueError):
+        raise ValueError("interest_rate must be a number")
+    if not math.isfinite(interest_rate) or interest_rate < 0:
+        raise ValueError("interest_rate can not be negative")
+
+    overdraft_limit = pence_field(record, "overdraft_limit", default=0)
+    if overdraft_limit < 0:
+        raise ValueError("overdraft_limit can not be negative")
+
+    balance = pence_field(record, "balance", default=0)
+    if balance < -overdraft_limit:
+        raise ValueError("balance is past the overdraft limit")
+
+    return (text_field(record, "customer_id"), text_field(record, "account_name"), account_number, balance,
+            interest_rate, overdraft_limit)
+
+
+def default_reject_path(filepath: str) -> str:
+    """Where the rejected rows of an import go if no file is given"""
+    return filepath + ".rejects.jsonl"
+
+
+def trim_rejects(reject_path: str, checkpoint: int):
+    """Drop the rejects after the checkpoint from the reject file. They were written for a batch that never got
+    committed, and will be written again when the import carries on."""
+    if not os.path.exists(reject_path):
+        return
+
+    with open(reject_path, "r", encoding="utf-8") as file:
+        lines = file.readlines()
+    kept = [line for line in lines if line.strip() and json.loads(line)["row"] <= checkpoint]
+    if len(kept) != len(lines):
+        with open(reject_path, "w", encoding="utf-8") as file:
+            file.writelines(kept)
+
+
+def validate_records(kind: str, records, first_row: int, keep_account_numbers: bool = True) -> tuple:
+    """Validate rows of the given kind, numbering them from first_row.
+    Returns (rows, rejects), rows being (row number,) + the validated fields and rejects (row number, reason, row)"""
+    rows = []
+    rejects = []
+    for row_number, record in enumerate(records, first_row):
+        try:
+            if kind == "customers":
+                rows.append((row_number,) + validate_customer(record))
+            else:
+                rows.append((row_number,) + validate_account(record, keep_account_numbers))
+        except ValueError as e:
+            rejects.append((row_number, str(e), record))
+    return rows, rejects
+
+
+def row_data(kind: str, row: tuple) -> dict:
+    """A validated row as a dict with the same fields as the input, for the reject file"""
+    return dict(zip(CUSTOMER_FIELDS if kind == "customers" else ACCOUNT_FIELDS, row[1:]))
+
+
+def begin_import(connection: Connection, kind: str, filepath: str, import_id: str, reject_path: str) -> tuple:
+    """Start (or find where to carry on) an import of one file.
+    Returns (summary, checkpoint), the checkpoint being None if there is nothing to do and the summary says why."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown import: {kind}")
+
+    summary = {"import_id": import_id, "kind": kind, "file": filepath, "reject_file": reject_path, "rows_read": 0,
+               "imported": 0, "rejected": 0, "batches": 0, "resumed": False, "ok": True, "message": ""}
+
+    run = connection.get_import_run(import_id, kind)
+    if run is not None and run["source"] != os.path.basename(filepath):
+        summary["ok"] = False
+        summary["message"] = f"Import {import_id} already has a {kind} file: {run['source']}"
+        return summary, None
+    if run is not None and run["finished_at"] is not None:
+        summary["message"] = f"Import {import_id} of {kind} has already finished."
+        return summary, None
+
+    checkpoint = 0
+    if run is None:
+        stat, reply = connection.start_import(import_id, kind, os.path.basename(filepath))
+        if not stat:
+            summary["ok"] = False
+            summary["message"] = reply
+            return summary, None
+    else:
+        checkpoint = run["checkpoint"]
+        summary["resumed"] = checkpoint > 0
+    trim_rejects(reject_path, checkpoint)
+    return summary, checkpoint
+
+
+def write_batch(connection: Connection, summary: dict, reject_file, rows: list, rejects: list, first_row: int,
+                last_row: int, customer_import_id: str = None, progress=None) -> bool:
+    """Insert one batch of validated rows (rows first_row to last_row of the file) and add it to the summary.
+    The batch's rejects are written to reject_file just before it is committed. False if it couldn't be inserted."""
+    kind = summary["kind"]
+    records = {row: record for row, reason, record in rejects}
+
+    def write_rejects(batch_rejects):
+        if len(batch_rejects) > len(rejects):
+            # Rows the database turned down, only their validated fields are left
+            records.update((row[0], row_data(kind, row)) for row in rows)
+        reject_file.write("".join(json.dumps({"row": row, "reason": reason, "data": records[row]}) + "\n"
+                                  for row, reason in sorted(batch_rejects)))
+        reject_file.flush()
+
+    reasons = [(row, reason) for row, reason, record in rejects]
+    if kind == "customers":
+        stat, reply, batch_rejects = connection.import_customers(summary["import_id"], rows, last_row, reasons,
+                                                                 write_rejects)
+    else:
+        stat, reply, batch_rejects = connection.import_accounts(summary["import_id"], rows, last_row, reasons,
+                                                                write_rejects, customer_import_id)
+    if not stat:
+        summary["ok"] = False
+        summary["message"] = f"Stopped after row {first_row - 1}. Reason: {reply}"
+        return False
+
+    summary["rows_read"] += last_row - first_row + 1
+    summary["imported"] += last_row - first_row + 1 - len(batch_rejects)
+    summary["rejected"] += len(batch_rejects)
+    summary["batches"] += 1
+    if progress is not None:
+        progress(summary["rows_read"])
+    return True
+
+
+def end_import(connection: Connection, summary: dict, start: float) -> dict:
+    """Mark the import as done if every batch went in, and add the timings to the summary"""
+    if summary["ok"]:
+        connection.finish_import(summary["import_id"], summary["kind"])
+
+    summary["seconds"] = perf_counter() - start
+    summary["rows_per_second"] = summary["rows_read"] / summary["seconds"] if summary["seconds"] else 0.0
+    if summary["ok"]:
+        summary["message"] = f"Imported {summary['imported']} {summary['kind']}, {summary['rejected']} rejected."
+    return summary
+
+
+def import_file(connection: Connection, kind: str, filepath: str, import_id: str, reject_path: str = None,
+                file_format: str = None, batch_size: int = DEFAULT_BATCH_SIZE, customer_import_id: str = None,
+                keep_account_numbers: bool = True, progress=None) -> dict:
+    """Import a CSV or JSON Lines file of customers or accounts, batch_size rows per transaction.
+    Each batch is inserted with executemany, moves the import's checkpoint and is committed in one go, so running
+    the same import_id again carries on after the last committed row. Rows that fail are written to reject_path
+    (JSON Lines of row number, reason and the row) with the same guarantee, so the file always matches what was
+    committed. Accounts refer to customers by their id in the customers file imported under customer_import_id
+    (import_id if None).
+    progress is called with the number of rows read so far after each batch."""
+    if reject_path is None:
+        reject_path = default_reject_path(filepath)
+
+    start = perf_counter()
+    summary, checkpoint = begin_import(connection, kind, filepath, import_id, reject_path)
+    if checkpoint is None:
+        return summary
+
+    with open(reject_path, "a", encoding="utf-8") as reject_file:
+        records = islice(read_records(filepath, file_format), checkpoint, None)
+        first_row = checkpoint + 1
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+
+            rows, rejects = validate_records(kind, batch, first_row, keep_account_numbers)
+            if not write_batch(connection, summary, reject_file, rows, rejects, first_row, first_row + len(batch) - 1,
+                               customer_import_id, progress):
+                break
+            first_row += len(batch)
+
+    return end_import(connection, summary, start)
+
+
+def read_chunks(filepath: str, file_format: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE, skip_rows: int = 0):
+    """Split a CSV or JSON Lines file into chunks of chunk_size rows without parsing it, for the workers of
+    import_file_parallel. Yields the CSV header's field names (None for JSON Lines), then (first row number,
+    last row number, lines) for each chunk. The first skip_rows rows are left out.
+    A CSV row carries on over the next line while it has an odd number of quotes, so quoted fields can have line
+    breaks in them. That only costs counting the quotes of each line, the parsing is left to the workers."""
+    if file_format is None:
+        file_format = guess_format(filepath)
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown format: {file_format}")
+    is_csv = file_format == "csv"
+
+    with open_input(filepath) as file:
+        fieldnames = None
+        if is_csv:
+            header = []
+            for line in file:
+                header.append(line)
+                if "".join(header).count('"') % 2 == 0:
+                    break
+            fieldnames = next(csv.reader(header), None)
+        yield fieldnames
+
+        row_number = 0
+        quotes = 0
+        keep = False
+        first_row = 0
+        lines = []
+        for line in file:
+            if quotes % 2 == 0:
+                # The line starts a new row. Blank lines aren't rows, the same as for csv.DictReader and read_records
+                if not (line.rstrip("\r\n") if is_csv else line.strip()):
+                    continue
+                row_number += 1
+                keep = row_number > skip_rows
+                if keep and row_number - first_row == chunk_size and lines:
+                    yield first_row, row_number - 1, lines
+                    lines = []
+                if keep and not lines:
+                    first_row = row_number
+
+            if is_csv:
+                quotes += line.count('"')
+            if keep:
+                lines.append(line)
+
+        if lines:
+            yield first_row, row_number, lines
+
+
+def validate_chunk(args) -> tuple:
+    """Worker process for import_file_parallel: parse and validate one chunk from read_chunks.
+    Returns (rows, rejects) as validate_records does."""
+    kind, file_format, fieldnames, first_row, lines, keep_account_numbers = args
+
+    if file_format == "csv":
+        records = csv.DictReader(lines, fieldnames=fieldnames)
+    else:
+        records = (parse_json_line(line) for line in lines)
+    return validate_records(kind, records, first_row, keep_account_numbers)
+
+
+def import_file_parallel(db_filepath: str, kind: str, filepath: str, import_id: str, workers: int = None,
+                         reject_path: str = None, file_format: str = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE, customer_import_id: str = None,
+                         keep_account_numbers: bool = True, progress=None) -> dict:
+    """import_file with the parsing and validating split across a process pool.
+    This process splits the file into chunks of chunk_size rows (see read_chunks) and hands them to the workers,
+    then, as the only writer, takes the validated chunks back in file order and inserts them batch_size rows per
+    transaction, the same as import_file. So the checkpoint, the reject file and resuming (with any number of
+    workers, or with import_file) work the same way. At most CHUNKS_IN_FLIGHT_PER_WORKER chunks per worker are
+    read ahead, so memory use doesn't grow with the file.
+    The summary has the time spent writing, and waiting on the workers, to show which side is holding it up."""
+    from multiprocessing import Pool
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if reject_path is None:
+        reject_path = default_reject_path(filepath)
+    if file_format is None:
+        file_format = guess_format(filepath)
+
+    start = perf_counter()
+    connection = Connection(db_filepath=db_filepath)
+    try:
+        summary, checkpoint = begin_import(connection, kind, filepath, import_id, reject_path)
+        if checkpoint is None:
+            return summary
+        summary.update({"workers": workers, "chunks": 0, "write_seconds": 0.0, "wait_seconds": 0.0})
+
+        with open(reject_path, "a", encoding="utf-8") as reject_file, Pool(workers) as pool:
+            chunks = read_chunks(filepath, file_format, chunk_size, checkpoint)
+            fieldnames = next(chunks)
+            pending = deque()  # (first row, last row, result) in file order
+
+            def send_chunk():
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    first_row, last_row, lines = chunk
+                    pending.append((first_row, last_row, pool.apply_async(
+                        validate_chunk, ((kind, file_format, fieldnames, first_row, lines, keep_account_numbers),))))
+
+            for n in range(workers * CHUNKS_IN_FLIGHT_PER_WORKER):
+                send_chunk()
+
+            rows, rejects = [], []
+            batch_first = checkpoint + 1
+            batch_last = checkpoint
+            while pending:
+                first_row, last_row, result = pending.popleft()
+                step = perf_counter()
+                try:
+                    chunk_rows, chunk_rejects = result.get()
+                except Exception as e:
+                    summary["ok"] = False
+                    summary["message"] = f"Stopped after row {batch_first - 1}. Reason: a worker failed on rows " \
+                                         f"{first_row} to {last_row}: {str(e)}"
+                    break
+                summary["wait_seconds"] += perf_counter() - step
+                send_chunk()
+
+                rows += chunk_rows
+                rejects += chunk_rejects
+                batch_last = last_row
+                summary["chunks"] += 1
+
+                if batch_last - batch_first + 1 >= batch_size or not pending:
+                    step = perf_counter()
+                    written = write_batch(connection, summary, reject_file, rows, rejects, batch_first, batch_last,
+                                          customer_import_id, progress)
+                    summary["write_seconds"] += perf_counter() - step
+                    if not written:
+                        break
+                    rows, rejects = [], []
+                    batch_first = batch_last + 1
+
+        # Leaving the with block terminates the workers if the writer stopped early
+        return end_import(connection, summary, start)
+    finally:
+        connection.close_connection()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bulk import customers or accounts from CSV or JSON Lines.")
+    parser.add_argument("kind", choices=KINDS)
+    parser.add_argument("input", help="File to read, .jsonl for JSON Lines, .gz files are decompressed.")
+    parser.add_argument("--import-id", required=True,
+                        help="Name of the import. Rerunning it carries on where it stopped, and accounts find "
+                             "their customers by the ids in the customers file of the same import.")
+    parser.add_argument("--db", default="Files/Data/data.db")
+    parser.add_argument("--format", choices=FORMATS, default=None, help="Defaults to the input file's extension.")
+    parser.add_argument("--rejects", default=None, help="File for rejected rows, defaults to <input>.rejects.jsonl")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--customer-import-id", default=None,
+                        help="Import the customers of an accounts file were imported under, if not the same one.")
+    parser.add_argument("--new-account-numbers", action="store_true",
+                        help="Give every account a new number instead of keeping the ones in the file.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes parsing and validating, more than 1 runs in parallel.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows sent to a worker at a time.")
+    parser.add_argument("--quiet", action="store_true", help="Don't print progress.")
+    args = parser.parse_args()
+
+    def progress(done):
+        print(f"{done} rows", flush=True)
+
+    if args.workers > 1:
+        summary = import_file_parallel(args.db, args.kind, args.input, args.import_id, args.workers, args.rejects,
+                                       args.format, args.batch_size, args.chunk_size, args.customer_import_id,
+                                       not args.new_account_numbers, None if args.quiet else progress)
+    else:
+        connection = Connection(db_filepath=args.db)
+        try:
+            summary = import_file(connection, args.kind, args.input, args.import_id, args.rejects, args.format,
+                                  args.batch_size, args.customer_import_id, not args.new_account_numbers,
+                                  None if args.quiet else progress)
+        finally:
+            connection.close_connection()
+
+    print(json.dumps(summary, indent=2))
+    if not summary["ok"]:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+import os
+import queue
+from fractions import Fraction
+from time import perf_counter
+
+from connection import Connection
+
+# How a fraction of a penny is rounded:
+#   half_even - to the nearest penny, halves to the even penny (bankers rounding, no bias over many accounts)
+#   half_up   - to the nearest penny, halves away from zero
+#   down      - towards zero, the bank keeps the fractions
+ROUNDING_POLICIES = ("half_even", "half_up", "down")
+DEFAULT_ROUNDING = "half_even"
+DEFAULT_CHUNK_SIZE = 10000
+# Months shown by the projection report
+DEFAULT_HORIZONS = (1, 3, 6, 12, 24, 60)
+# Lower edges (percent) of the rate bands in the projection report
+DEFAULT_RATE_BANDS = (0, 1, 2, 3, 5)
+# Chunks each worker can have waiting for the writer before it has to wait, this bounds the memory used
+CHUNKS_IN_FLIGHT_PER_WORKER = 4
+
+
+def round_divide(numerator: int, denominator: int, rounding: str = DEFAULT_ROUNDING) -> int:
+    """Divide two integers and round the result to a whole number with the rounding policy"""
+    if rounding not in ROUNDING_POLICIES:
+        raise ValueError(f"Unknown rounding policy: {rounding}")
+
+    sign = -1 if (numerator < 0) != (denominator < 0) else 1
+    quotient, remainder = divmod(abs(numerator), abs(denominator))
+
+    if rounding == "half_up" and remainder * 2 >= abs(denominator):
+        quotient += 1
+    elif rounding == "half_even" and (remainder * 2 > abs(denominator) or
+                                      (remainder * 2 == abs(denominator) and quotient % 2 == 1)):
+        quotient += 1
+
+    return sign * quotient
+
+
+def rate_fraction(interest_rate: float, periods_per_year: int = 1) -> Fraction:
+    """The exact fraction of the balance paid each period for a yearly rate in percent.
+    The rate goes through its decimal text, so 1.1 is 11/1000 and not the nearest binary float."""
+    return Fraction(str(interest_rate)) / 100 / periods_per_year
+
+
+def compute_interest(rows, periods_per_year: int = 1, rounding: str = DEFAULT_ROUNDING,
+                     include_overdrawn: bool = False) -> list:
+    """Work out the interest in pence for (id, balance, interest rate) rows.
+    Returns (id, interest) for each account that gets a non zero amount. Overdrawn balances are skipped unless
+    include_overdrawn is set, in which case they are charged interest at their rate."""
+    fractions = {}  # Most accounts share a handful of rates
+    entries = []
+
+    for account_id, balance, interest_rate in rows:
+        if balance == 0 or (balance < 0 and not include_overdrawn) or not interest_rate:
+            continue
+
+        fraction = fractions.get(interest_rate)
+        if fraction is None:
+            fraction = rate_fraction(interest_rate, periods_per_year)
+            fractions[interest_rate] = fraction
+
+        interest = round_divide(balance * fraction.numerator, fraction.denominator, rounding)
+        if interest != 0:
+            entries.append((account_id, interest))
+
+    return entries
+
+
+def rate_band(interest_rate: float, rate_bands=DEFAULT_RATE_BANDS) -> str:
+    """Name of the band a rate falls in, e.g. 1-2%"""
+    for lower, upper in zip(rate_bands, rate_bands[1:]):
+        if interest_rate < upper:
+            return f"{lower}-{upper}%"
+    return f"{rate_bands[-1]}%+"
+
+
+def project_balances(groups, horizons=DEFAULT_HORIZONS, rate_bands=DEFAULT_RATE_BANDS) -> dict:
+    """Project balances forward with monthly compounding for every horizon (in months).
+    groups are (account type, rate, accounts, total balance) rows. Compounding is the same multiplier for every
+    account with the same rate, so each group is projected as one balance rather than account by account.
+    Returns the totals in pence, overall and by account type and rate band, keyed by horizon."""
+    horizons = sorted(set(horizons))
+
+    def new_totals():
+        return {"accounts": 0, "balance": 0, "projected": {months: 0.0 for months in horizons}}
+
+    total = new_totals()
+    by_type = {}
+    by_band = {}
+
+    for account_type, interest_rate, accounts, balance in groups:
+        monthly = 1 + (interest_rate or 0) / 100 / 12
+        band = rate_band(interest_rate or 0, rate_bands)
+
+        for totals in (total, by_type.setdefault(account_type, new_totals()), by_band.setdefault(band, new_totals())):
+            totals["accounts"] += accounts
+            totals["balance"] += balance
+            for months in horizons:
+                totals["projected"][months] += balance * monthly ** months
+
+    # Round to pence once everything is added up
+    for totals in [total] + list(by_type.values()) + list(by_band.values()):
+        totals["projected"] = {months: round(value) for months, value in totals["projected"].items()}
+        totals["interest"] = {months: value - totals["balance"] for months, value in totals["projected"].items()}
+
+    # Bands in rate order rather than name order
+    band_order = [rate_band(lower, rate_bands) for lower in rate_bands]
+    return {"horizons": horizons, "total": total, "by_type": dict(sorted(by_type.items())),
+            "by_band": {band: by_band[band] for band in band_order if band in by_band}}
+
+
+def plan_partitions(connection: Connection, run_id: str, partitions: int = 1, dry_run: bool = False) -> list:
+    """Return the partitions of a run, starting it split into equal id ranges if it is new.
+    A run that already exists keeps the partitions it started with."""
+    existing = connection.get_interest_run(run_id)
+    if existing:
+        return existing
+
+    first_id, last_id = connection.get_account_id_range()
+    if first_id is None:
+        return []
+
+    size = (last_id - first_id) // partitions + 1
+    planned = []
+    for partition in range(partitions):
+        start = first_id + partition * size
+        if start > last_id:
+            break
+        end = min(start + size - 1, last_id)
+
+        if not dry_run:
+            connection.start_interest_partition(run_id, partition, start, end)
+        planned.append({"partition": partition, "first_id": start, "last_id": end, "checkpoint_id": start - 1,
+                        "accounts": 0, "interest": 0, "finished_at": None})
+
+    return planned if dry_run else connection.get_interest_run(run_id)
+
+
+def accrue_interest(connection: Connection, run_id: str, periods_per_year: int = 1,
+                    rounding: str = DEFAULT_ROUNDING, chunk_size: int = DEFAULT_CHUNK_SIZE, dry_run: bool = False,
+                    include_overdrawn: bool = False, progress=None) -> dict:
+    """Pay one period of interest to every account, chunk_size accounts per transaction.
+    Each chunk updates the balances, writes an 'interest' ledger entry per account (referencing run_id) and moves
+    the run's checkpoint in the same transaction. Running the same run_id again carries on from the checkpoint,
+    so a crashed run can simply be restarted and no account is paid twice.
+    With dry_run nothing is written, the totals show what the run would pay.
+    progress is called with the number of accounts read so far after each chunk."""
+    if rounding not in ROUNDING_POLICIES:
+        raise ValueError(f"Unknown rounding policy: {rounding}")
+
+    start = perf_counter()
+    summary = {"run_id": run_id, "dry_run": dry_run, "rounding": rounding, "periods_per_year": periods_per_year,
+               "accounts_read": 0, "accounts": 0, "interest": 0, "chunks": 0, "resumed": False,
+               "ok": True, "message": ""}
+
+    for partition in plan_partitions(connection, run_id, dry_run=dry_run):
+        if partition["finished_at"] is not None:
+            continue
+        if partition["checkpoint_id"] >= partition["first_id"]:
+            summary["resumed"] = True
+
+        after_id = partition["checkpoint_id"]
+        while True:
+            stat, reply, rows = connection.get_interest_rows(after_id, partition["last_id"], chunk_size)
+            if not stat:
+                # The partition is left unfinished, so rerunning the run reads it again from its checkpoint
+                summary["ok"] = False
+                summary["message"] = f"Stopped after account id {after_id}. Reason: {reply}"
+                break
+            if not rows:
+                break
+
+            entries = compute_interest(rows, periods_per_year, rounding, include_overdrawn)
+            after_id = rows[-1][0]
+
+            if not dry_run:
+                stat, reply = connection.apply_interest(run_id, partition["partition"], entries, after_id)
+                if not stat:
+                    summary["ok"] = False
+                    summary["message"] = f"Stopped at account id {after_id}. Reason: {reply}"
+                    break
+
+            summary["accounts_read"] += len(rows)
+            summary["accounts"] += len(entries)
+            summary["interest"] += sum(interest for account_id, interest in entries)
+            summary["chunks"] += 1
+
+            if progress is not None:
+                progress(summary["accounts_read"])
+
+        if not summary["ok"]:
+            break
+        if not dry_run:
+            connection.finish_interest_partition(run_id, partition["partition"])
+
+    summary["seconds"] = perf_counter() - start
+    summary["accounts_per_second"] = summary["accounts_read"] / summary["seconds"] if summary["seconds"] else 0.0
+    if summary["ok"]:
+        summary["message"] = f"{'Would pay' if dry_run else 'Paid'} {summary['interest']}p interest " \
+                             f"to {summary['accounts']} accounts."
+    return summary
+
+
+def compute_partition(args) -> dict:
+    """Worker process for accrue_interest_parallel: read one partition in chunks, work out the interest and put
+    each chunk on the writer's queue. Ends with a (partition, None, ...) marker once the partition is read to its
+    end, a failed read raises instead. Returns the worker's timings."""
+    (db_filepath, partition, after_id, last_id, periods_per_year, rounding, chunk_size, include_overdrawn,
+     chunks) = args
+
+    stats = {"partition": partition, "pid": os.getpid(), "accounts_read": 0, "read_seconds": 0.0,
+             "compute_seconds": 0.0, "wait_seconds": 0.0}
+    start = perf_counter()
+
+    connection = Connection(db_filepath=db_filepath)
+    try:
+        while True:
+            step = perf_counter()
+            stat, reply, rows = connection.get_interest_rows(after_id, last_id, chunk_size)
+            stats["read_seconds"] += perf_counter() - step
+            if not stat:
+                raise RuntimeError(f"Partition {partition} stopped after account id {after_id}. Reason: {reply}")
+            if not rows:
+                break
+
+            step = perf_counter()
+            entries = compute_interest(rows, periods_per_year, rounding, include_overdrawn)
+            after_id = rows[-1][0]
+            stats["compute_seconds"] += perf_counter() - step
+
+            # Blocks when the writer is behind
+            step = perf_counter()
+            chunks.put((partition, entries, after_id, len(rows)))
+            stats["wait_seconds"] += perf_counter() - step
+            stats["accounts_read"] += len(rows)
+    finally:
+        connection.close_connection()
+
+    # Only sent once every chunk is queued, so a failed worker never gets its partition marked as finished
+    chunks.put((partition, None, after_id, 0))
+
+    stats["seconds"] = perf_counter() - start
+    stats["accounts_per_second"] = stats["accounts_read"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+def accrue_interest_parallel(db_filepath: str, run_id: str, workers: int = None, partitions: int = None,
+                             periods_per_year: int = 1, rounding: str = DEFAULT_ROUNDING,
+                             chunk_size: int = DEFAULT_CHUNK_SIZE, dry_run: bool = False,
+                             include_overdrawn: bool = False, progress=None) -> dict:
+    """accrue_interest split across a process pool. The accounts are split into id range partitions (workers of
+    them by default), worker processes read and compute the partitions, and this process is the only writer,
+    applying each chunk with its partition's checkpoint. A run keeps the partitions it was started with, so it
+    can be resumed with any number of workers (or with accrue_interest).
+    The summary has the timings of each partition and of each worker process."""
+    from multiprocessing import Manager, Pool
+
+    if rounding not in ROUNDING_POLICIES:
+        raise ValueError(f"Unknown rounding policy: {rounding}")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if partitions is None:
+        partitions = workers
+
+    start = perf_counter()
+    summary = {"run_id": run_id, "dry_run": dry_run, "rounding": rounding, "periods_per_year": periods_per_year,
+               "accounts_read": 0, "accounts": 0, "interest": 0, "chunks": 0, "resumed": False,
+               "ok": True, "message": "", "workers": workers, "write_seconds": 0.0}
+
+    writer = Connection(db_filepath=db_filepath)
+    try:
+        pending = [partition for partition in plan_partitions(writer, run_id, partitions, dry_run)
+                   if partition["finished_at"] is None]
+        summary["resumed"] = any(partition["checkpoint_id"] >= partition["first_id"] for partition in pending)
+
+        with Manager() as manager, Pool(max(1, min(workers, len(pending)))) as pool:
+            chunks = manager.Queue(maxsize=workers * CHUNKS_IN_FLIGHT_PER_WORKER)
+            result = pool.map_async(compute_partition, [(db_filepath, partition["partition"],
+                                                         partition["checkpoint_id"], partition["last_id"],
+                                                         periods_per_year, rounding, chunk_size, include_overdrawn,
+                                                         chunks) for partition in pending])
+
+            remaining = len(pending)
+            while remaining and summary["ok"]:
+                try:
+                    partition, entries, checkpoint_id, rows_read = chunks.get(timeout=1)
+                except queue.Empty:
+                    if result.ready() and not result.successful():
+                        summary["ok"] = False
+                        try:
+                            result.get()
+                        except Exception as e:
+                            summary["message"] = f"A worker failed ({str(e)}), rerun the run to carry on from " \
+                                                 f"its checkpoints."
+                    continue
+
+                if entries is None:
+                    remaining -= 1
+                    if not dry_run:
+                        writer.finish_interest_partition(run_id, partition)
+                    continue
+
+                if not dry_run:
+                    step = perf_counter()
+                    stat, reply = writer.apply_interest(run_id, partition, entries, checkpoint_id)
+                    summary["write_seconds"] += perf_counter() - step
+                    if not stat:
+                        summary["ok"] = False
+                        summary["message"] = f"Stopped at account id {checkpoint_id}. Reason: {reply}"
+                        break
+
+                summary["accounts_read"] += rows_read
+                summary["accounts"] += len(entries)
+                summary["interest"] += sum(interest for account_id, interest in entries)
+                summary["chunks"] += 1
+
+                if progress is not None:
+                    progress(summary["accounts_read"])
+
+            # Leaving the with block terminates the workers if the writer stopped early
+            partition_stats = result.get() if summary["ok"] else []
+    finally:
+        writer.close_connection()
+
+    # A worker process can have handled several partitions
+    worker_stats = {}
+    for stats in partition_stats:
+        totals = worker_stats.setdefault(stats["pid"], {"pid": stats["pid"], "partitions": 0, "accounts_read": 0,
+                                                        "seconds": 0.0})
+        totals["partitions"] += 1
+        totals["accounts_read"] += stats["accounts_read"]
+        totals["seconds"] += stats["seconds"]
+    for totals in worker_stats.values():
+        totals["accounts_per_second"] = totals["accounts_read"] / totals["seconds"] if totals["seconds"] else 0.0
+
+    summary["partitions"] = partition_stats
+    summary["worker_stats"] = list(worker_stats.values())
+    summary["seconds"] = perf_counter() - start
+    summary["accounts_per_second"] = summary["accounts_read"] / summary["seconds"] if summary["seconds"] else 0.0
+    if summary["ok"]:
+        summary["message"] = f"{'Would pay' if dry_run else 'Paid'} {summary['interest']}p interest " \
+                             f"to {summary['accounts']} accounts."
+    return summary
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Pay a period of interest to every account.")
+    parser.add_argument("run_id", help="Name of the run, e.g. 2024-06. Rerun with the same name to resume.")
+    parser.add_argument("--db", default="Files/Data/data.db")
+    parser.add_argument("--periods", type=int, default=1, help="Interest periods per year, e.g. 12 for monthly.")
+    parser.add_argument("--rounding", choices=ROUNDING_POLICIES, default=DEFAULT_ROUNDING)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--include-overdrawn", action="store_true", help="Charge interest on overdrawn balances.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be paid.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, more than 1 runs in parallel.")
+    parser.add_argument("--partitions", type=int, default=None,
+                        help="Account id ranges to split a new run into, defaults to the number of workers.")
+    args = parser.parse_args()
+
+    def progress(done):
+        print(f"{done} accounts", flush=True)
+
+    if args.workers > 1:
+        summary = accrue_interest_parallel(args.db, args.run_id, args.workers, args.partitions, args.periods,
+                                           args.rounding, args.chunk_size, args.dry_run, args.include_overdrawn,
+                                           progress=progress)
+    else:
+        connection = Connection(db_filepath=args.db)
+        try:
+            summary = accrue_interest(connection, args.run_id, args.periods, args.rounding, args.chunk_size,
+                                      args.dry_run, args.include_overdrawn, progress=progress)
+        finally:
+            connection.close_connection()
+
+    print(json.dumps(summary, indent=2))
+    if not summary["ok"]:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
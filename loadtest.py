@@ -0,0 +1,230 @@
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+from time import perf_counter
+
+# Default mix of operations, the numbers are relative weights
+DEFAULT_MIX = {"search_accounts": 25, "get_customer_data": 25, "deposit": 15, "withdraw": 15,
+               "transfer": 15, "report": 5}
+
+REPORTS = ["interest_report", "balance_report", "overdraft_report", "customer_report"]
+
+LOADTEST_ADMIN = ("loadtest", "loadtest")
+
+
+def seed_database(db_filepath: str, customers: int = 1000, accounts: int = 2000, seed: int = 0):
+    """Create a fresh database at the path with the tables, the load test admin and generated customers/accounts"""
+    import setup_db
+    import bank
+
+    if os.path.exists(db_filepath):
+        os.remove(db_filepath)
+
+    conn = sqlite3.connect(db_filepath)
+    for query in setup_db.SETUP_SQL:
+        conn.execute(query)
+
+    conn.execute("INSERT INTO admins (first_name, last_name, address_line1, username, password_hash, full_rights) "
+                 "VALUES ('Load', 'Test', 'Nowhere', ?, ?, 1)",
+                 (LOADTEST_ADMIN[0], bank.BankingSystem.hash_password(LOADTEST_ADMIN[1])))
+    conn.commit()
+    conn.close()
+
+    setup_db.generate_data(db_filepath, customers, accounts, seed, progress=False)
+
+
+def load_targets(db_filepath: str) -> dict:
+    """Read the ids/numbers/names the workers pick from, this is not timed"""
+    conn = sqlite3.connect(db_filepath)
+    targets = {"accounts": conn.execute("SELECT id, account_number FROM accounts ORDER BY id").fetchall(),
+               "customers": [row[0] for row in conn.execute("SELECT id FROM customers ORDER BY id")],
+               "last_names": [row[0] for row in conn.execute("SELECT DISTINCT last_name FROM customers "
+                                                             "ORDER BY last_name")]}
+    conn.close()
+    return targets
+
+
+def run_operation(system, name: str, rand: random.Random, targets: dict) -> bool:
+    """Run a single operation, returns if it succeeded"""
+    if name == "search_accounts":
+        result = system.search_accounts(cust_last=rand.choice(targets["last_names"]), exact_fields=True)
+    elif name == "get_customer_data":
+        result = system.get_customer_data(rand.choice(targets["customers"]))
+        return isinstance(result, dict)
+    elif name == "deposit":
+        result = system.deposit(rand.choice(targets["accounts"])[0], rand.randint(1, 10000))
+    elif name == "withdraw":
+        result = system.withdraw(rand.choice(targets["accounts"])[0], rand.randint(1, 10000))
+    elif name == "transfer":
+        from_acc, to_acc = rand.sample(targets["accounts"], 2)
+        result = system.transfer(from_acc[1], to_acc[1], rand.randint(1, 10000))
+    elif name == "report":
+        result = getattr(system, rand.choice(REPORTS))()
+        return isinstance(result, dict)
+    else:
+        raise ValueError(f"Unknown operation: {name}")
+
+    return isinstance(result, tuple) and bool(result[0])
+
+
+def run_worker(worker_args: tuple) -> dict:
+    """Run a workers share of the operations and return the latencies (seconds) of each operation"""
+    import bank
+
+    db_filepath, worker_id, ops, mix, seed = worker_args
+
+    # Every worker gets its own random stream so the run is reproducible whatever the scheduling
+    rand = random.Random(f"{seed}-{worker_id}")
+    names = list(mix.keys())
+    weights = [mix[name] for name in names]
+
+    targets = load_targets(db_filepath)
+
+    system = bank.BankingSystem(db_filepath=db_filepath)
+    system.login(*LOADTEST_ADMIN)
+
+    latencies = {name: [] for name in names}
+    failures = {name: 0 for name in names}
+    errors = {name: 0 for name in names}
+
+    # Only time the operations, not the login and setup above
+    run_start = perf_counter()
+    for name in rand.choices(names, weights, k=ops):
+        start = perf_counter()
+        try:
+            ok = run_operation(system, name, rand, targets)
+        except Exception:
+            ok = None
+        latencies[name].append(perf_counter() - start)
+
+        if ok is None:
+            errors[name] += 1
+        elif not ok:
+            failures[name] += 1
+
+    elapsed = perf_counter() - run_start
+
+    system.connection.close_connection()
+    return {"latencies": latencies, "failures": failures, "errors": errors, "elapsed": elapsed}
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarise(results: list) -> dict:
+    """Merge the worker results into the per operation statistics"""
+    # The workers run side by side, so the run took as long as the slowest one
+    elapsed = max(result["elapsed"] for result in results)
+    operations = {}
+    total_ops = 0
+
+    names = sorted({name for result in results for name in result["latencies"]})
+    for name in names:
+        values = sorted(value for result in results for value in result["latencies"].get(name, []))
+        total_ops += len(values)
+        operations[name] = {"count": len(values),
+                            "failures": sum(result["failures"].get(name, 0) for result in results),
+                            "errors": sum(result["errors"].get(name, 0) for result in results),
+                            "ops_per_sec": len(values) / elapsed if elapsed else 0.0,
+                            "mean_ms": (sum(values) / len(values) * 1000) if values else 0.0,
+                            "p50_ms": percentile(values, 50) * 1000,
+                            "p95_ms": percentile(values, 95) * 1000,
+                            "p99_ms": percentile(values, 99) * 1000,
+                            "max_ms": (values[-1] * 1000) if values else 0.0}
+
+    return {"elapsed_sec": elapsed, "total_ops": total_ops,
+            "ops_per_sec": total_ops / elapsed if elapsed else 0.0, "operations": operations}
+
+
+def run_load_test(db_filepath: str, workers: int = 4, ops_per_worker: int = 1000, mix: dict = None,
+                  seed: int = 0, use_processes: bool = False) -> dict:
+    """Run the workers against the database and return the results"""
+    if mix is None:
+        mix = DEFAULT_MIX
+
+    worker_args = [(db_filepath, worker_id, ops_per_worker, mix, seed) for worker_id in range(workers)]
+
+    if use_processes:
+        from multiprocessing import Pool
+        with Pool(workers) as pool:
+            results = pool.map(run_worker, worker_args)
+    else:
+        results = [None] * workers
+
+        def thread_main(index):
+            results[index] = run_worker(worker_args[index])
+
+        threads = [threading.Thread(target=thread_main, args=(index,)) for index in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    report = summarise(results)
+    report["config"] = {"workers": workers, "ops_per_worker": ops_per_worker, "mix": mix, "seed": seed,
+                        "mode": "processes" if use_processes else "threads"}
+    return report
+
+
+def parse_mix(text: str) -> dict:
+    """Parse a mix given as name=weight,name=weight"""
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulate concurrent tellers against the banking system.")
+    parser.add_argument("--db", default=None, help="Database to run against, it is seeded first if it does not exist. "
+                             "A temporary one is used if not given.")
+    parser.add_argument("--customers", type=int, default=1000, help="Customers to seed.")
+    parser.add_argument("--accounts", type=int, default=2000, help="Accounts to seed.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--ops", type=int, default=1000, help="Operations per worker.")
+    parser.add_argument("--mix", default=None, help="Operation weights, e.g. deposit=1,transfer=2")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", action="store_true", help="Use processes instead of threads.")
+    parser.add_argument("--output", default=None, help="File to write the JSON results to.")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+
+    temp_dir = None
+    db_filepath = args.db
+    if db_filepath is None:
+        temp_dir = tempfile.mkdtemp()
+        db_filepath = os.path.join(temp_dir, "loadtest.db")
+
+    if not os.path.exists(db_filepath):
+        seed_database(db_filepath, args.customers, args.accounts, args.seed)
+
+    report = run_load_test(db_filepath, args.workers, args.ops, mix, args.seed, args.processes)
+    report["config"]["customers"] = args.customers
+    report["config"]["accounts"] = args.accounts
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    print(text)
+
+    if temp_dir is not None:
+        os.remove(db_filepath)
+        os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
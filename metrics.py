@@ -0,0 +1,206 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+DEFAULT_METRICS_PORT = 9100
+
+
+def format_labels(labels: dict) -> str:
+    """Turn a dict of labels into the {name="value"} form"""
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def format_value(value) -> str:
+    """Format a sample value"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsRegistry:
+    """Counters and latency histograms for the BankingSystem operations, rendered in the Prometheus text format.
+    Other parts of the system (connection pools, caches) add their own numbers through collectors."""
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+
+        # (method, outcome) -> count
+        self.calls = {}
+        # method -> [bucket counts..., +Inf count], sum of seconds
+        self.buckets = {}
+        self.durations = {}
+
+        # Functions returning a list of (name, type, help, [(labels, value)]) when the metrics are rendered
+        self.collectors = []
+
+        self.lock = threading.Lock()
+
+    def enable(self):
+        """Start collecting"""
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting, the numbers so far are kept"""
+        self.enabled = False
+
+    def reset(self):
+        """Clear all the collected numbers"""
+        with self.lock:
+            self.calls = {}
+            self.buckets = {}
+            self.durations = {}
+
+    def record_call(self, method: str, seconds: float, outcome: str):
+        """Record a finished call to a BankingSystem method.
+        outcome is one of ok, failed (returned False), denied (not logged in) or error (raised)"""
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = index
+                break
+
+        with self.lock:
+            key = (method, outcome)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+            if method not in self.buckets:
+                self.buckets[method] = [0] * (len(LATENCY_BUCKETS) + 1)
+                self.durations[method] = 0.0
+            self.buckets[method][bucket] += 1
+            self.durations[method] += seconds
+
+    def add_collector(self, collector):
+        """Add a function that returns extra metrics as a list of (name, type, help, [(labels, value)])"""
+        with self.lock:
+            self.collectors = self.collectors + [collector]
+
+    def remove_collector(self, collector):
+        """Stop rendering a collector"""
+        with self.lock:
+            self.collectors = [other for other in self.collectors if other is not collector]
+
+    def render(self) -> str:
+        """Return all the metrics in the Prometheus text format"""
+        with self.lock:
+            calls = dict(self.calls)
+            buckets = {method: list(counts) for method, counts in self.buckets.items()}
+            durations = dict(self.durations)
+            collectors = self.collectors
+
+        lines = ["# HELP bank_operation_calls_total Calls to BankingSystem methods by outcome.",
+                 "# TYPE bank_operation_calls_total counter"]
+        for (method, outcome), count in sorted(calls.items()):
+            lines.append(f"bank_operation_calls_total{format_labels({'method': method, 'outcome': outcome})} {count}")
+
+        lines += ["# HELP bank_operation_duration_seconds Time taken by BankingSystem methods.",
+                  "# TYPE bank_operation_duration_seconds histogram"]
+        for method in sorted(buckets):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], buckets[method]):
+                cumulative += count
+                labels = format_labels({"method": method, "le": bound})
+                lines.append(f"bank_operation_duration_seconds_bucket{labels} {cumulative}")
+            labels = format_labels({"method": method})
+            lines.append(f"bank_operation_duration_seconds_sum{labels} {format_value(durations[method])}")
+            lines.append(f"bank_operation_duration_seconds_count{labels} {cumulative}")
+
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {str(e)}")
+                continue
+
+            for name, metric_type, help_text, samples in collected:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filepath: str):
+        """Write the metrics to a file, e.g for the node exporter textfile collector"""
+        # Write to a temporary file first so readers never see half a file
+        temp_path = filepath + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.render())
+        os.replace(temp_path, filepath)
+
+
+def query_stats_collector() -> list:
+    """Export the Connection query timings (see query_stats) if they are being collected"""
+    from query_stats import instrumentation
+
+    if not instrumentation.enabled:
+        return []
+
+    counts = []
+    seconds = []
+    rows = []
+    errors = []
+    for shape, stat in instrumentation.snapshot().items():
+        labels = {"query": shape}
+        counts.append((labels, stat["count"]))
+        seconds.append((labels, stat["total_ms"] / 1000))
+        rows.append((labels, stat["rows"]))
+        errors.append((labels, stat["errors"]))
+
+    return [("bank_query_calls_total", "counter", "Queries run by shape.", counts),
+            ("bank_query_seconds_total", "counter", "Time spent running queries by shape.", seconds),
+            ("bank_query_rows_total", "counter", "Rows returned or changed by shape.", rows),
+            ("bank_query_errors_total", "counter", "Queries that failed by shape.", errors)]
+
+
+# Shared by every BankingSystem, switched on with the BANK_METRICS environment variable or metrics.enable()
+metrics = MetricsRegistry(enabled=os.environ.get("BANK_METRICS", "") not in ("", "0"))
+metrics.add_collector(query_stats_collector)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the registry on /metrics"""
+    registry = metrics
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        data = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Don't print every scrape
+        pass
+
+
+def start_metrics_server(host: str = "127.0.0.1", port: int = DEFAULT_METRICS_PORT, registry=None):
+    """Serve /metrics on a background thread, returns the server so it can be shut down"""
+    if registry is None:
+        registry = metrics
+
+    handler = type("RegistryHandler", (MetricsRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+
+    registry.enable()
+    return server
+
+
+if __name__ == "__main__":
+    print("Module Only use")
+    exit()
@@ -0,0 +1,131 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import tracemalloc
+from time import strftime, perf_counter
+
+DEFAULT_PROFILE_DIR = "Files/Profiles"
+DEFAULT_SAMPLE_RATE = 0.01  # Fraction of calls that get profiled
+TOP_ALLOCATIONS = 25
+TOP_FUNCTIONS = 40
+
+
+class Profiler:
+    """Profiles a sample of calls to chosen BankingSystem methods with cProfile and tracemalloc.
+    Each profiled call writes a .prof file (open with pstats or snakeviz) and a .txt summary with the
+    slowest functions and the top allocation sites."""
+    def __init__(self):
+        self.enabled = False
+        self.methods = set()  # Empty means every decorated method
+        self.directory = DEFAULT_PROFILE_DIR
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.trace_memory = True
+
+        # Only one call is profiled at a time, tracemalloc is process wide and cProfile can't nest
+        self.busy = threading.Lock()
+        self.count = 0
+
+    def enable(self, methods=None, directory: str = None, sample_rate: float = None, trace_memory: bool = True):
+        """Start profiling a sample of calls to the given method names (all decorated methods if None)"""
+        self.methods = set(methods) if methods else set()
+        if directory is not None:
+            self.directory = directory
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.trace_memory = trace_memory
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.enabled = True
+
+    def disable(self):
+        """Stop profiling"""
+        self.enabled = False
+
+    def should_profile(self, name: str) -> bool:
+        """Decide if this call is one of the sampled ones"""
+        if self.methods and name not in self.methods:
+            return False
+        return random.random() < self.sample_rate
+
+    def run(self, name: str, call):
+        """Run the call, profiling it if it is picked by the sampling"""
+        if not self.should_profile(name):
+            return call()
+
+        # Skip if another call (or the outer call of this one) is already being profiled
+        if not self.busy.acquire(blocking=False):
+            return call()
+
+        try:
+            return self.profile(name, call)
+        finally:
+            self.busy.release()
+
+    def profile(self, name: str, call):
+        """Run the call under cProfile (and tracemalloc) and write out the results"""
+        started_tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+
+        profile = cProfile.Profile()
+        start = perf_counter()
+        profile.enable()
+        try:
+            return call()
+        finally:
+            profile.disable()
+            elapsed = perf_counter() - start
+
+            snapshot = None
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+
+            try:
+                self.write_results(name, elapsed, profile, snapshot)
+            except OSError as e:
+                print(f"Could not write profile. Reason: {str(e)}")
+
+    def write_results(self, name: str, elapsed: float, profile: cProfile.Profile, snapshot):
+        """Write the .prof and summary files for one call"""
+        self.count += 1
+        base = os.path.join(self.directory, f"{strftime('%Y%m%d-%H%M%S')}_{name}_{os.getpid()}_{self.count}")
+
+        profile.dump_stats(base + ".prof")
+
+        text = io.StringIO()
+        text.write(f"{name} took {round(elapsed * 1000, 3)}ms\n\n")
+
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+        if snapshot is not None:
+            # Ignore the allocations made by the profilers themselves
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                               tracemalloc.Filter(False, cProfile.__file__),
+                                               tracemalloc.Filter(False, __file__)])
+            text.write(f"\nTop {TOP_ALLOCATIONS} allocation sites:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                text.write(f"{stat}\n")
+
+        with open(base + ".txt", "w") as file:
+            file.write(text.getvalue())
+
+
+# Shared by every BankingSystem. Can be switched on with environment variables:
+#   BANK_PROFILE=interest_report,search_accounts (or "all"), BANK_PROFILE_DIR, BANK_PROFILE_SAMPLE=0.01
+profiler = Profiler()
+if os.environ.get("BANK_PROFILE"):
+    profiler.enable(methods=None if os.environ["BANK_PROFILE"] == "all" else os.environ["BANK_PROFILE"].split(","),
+                    directory=os.environ.get("BANK_PROFILE_DIR"),
+                    sample_rate=float(os.environ.get("BANK_PROFILE_SAMPLE", DEFAULT_SAMPLE_RATE)))
+
+
+if __name__ == "__main__":
+    print("Module Only use")
+    exit()
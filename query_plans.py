@@ -0,0 +1,316 @@
+import itertools
+import json
+import re
+import sqlite3
+import threading
+
+from connection import Connection
+
+# Sample values used when building a search, the values don't matter to the plan only the fields used
+CUSTOMER_FIELDS = {"cid": 1, "fname": "John", "lname": "Smith", "address_l1": "1 High Street",
+                   "address_l2": "Curzon", "address_l3": "Digbeth", "address_city": "Birmingham",
+                   "address_postcode": "B4 7XG"}
+ACCOUNT_FIELDS = {"accid": 1, "account_name": "ISA", "account_number": 1000000000000000, "cust_id": 1,
+                  "balance": 0, "interest_rate": 1.0, "overdraft_limit": 0}
+# Fields the exact/LIKE option changes, the others are always matched exactly
+LIKE_FIELDS = {"fname", "lname", "address_l1", "address_l2", "address_l3", "address_city", "address_postcode",
+               "account_name"}
+
+TERM_REGEX = re.compile(r"(\w+)\s*(>=|<=|=|LIKE)\s*('(?:[^']|'')*'|\?|-?[\d.]+)", re.IGNORECASE)
+TABLE_REGEX = re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE)
+
+
+def explain(conn, sql: str, params=()) -> list:
+    """Return the detail lines of the EXPLAIN QUERY PLAN for a query"""
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+
+def scanned_tables(plan: list) -> list:
+    """Tables the plan reads in full"""
+    tables = []
+    for detail in plan:
+        # Older sqlite versions say SCAN TABLE x, newer ones SCAN x
+        match = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+        if match and "USING" not in detail and match.group(1) != "CONSTANT":
+            tables.append(match.group(1))
+    return tables
+
+
+def existing_indexes(conn, table: str) -> dict:
+    """Return index name -> list of columns for a table. Partial indexes (CREATE INDEX ... WHERE) are left out,
+    they only cover the queries that match their WHERE."""
+    indexes = {}
+    for row in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        name, partial = row[1], row[4]
+        if partial:
+            continue
+        indexes[name] = [info[2] for info in conn.execute(f"PRAGMA index_info({name})").fetchall()]
+    return indexes
+
+
+def suggest_indexes(conn, sql: str) -> tuple:
+    """Work out indexes that would stop the query scanning its table.
+    Returns (list of CREATE INDEX statements, list of notes)"""
+    suggestions = []
+    notes = []
+
+    match = TABLE_REGEX.search(sql)
+    if match is None or " WHERE " not in sql.upper():
+        return suggestions, ["Query has no WHERE clause, it always reads the whole table."]
+    table = match.group(1)
+    if table.startswith("sqlite_"):
+        return suggestions, ["sqlite's own tables can not be indexed."]
+
+    where = sql[sql.upper().index(" WHERE ") + 7:]
+    terms = TERM_REGEX.findall(where)
+    uses_or = re.search(r"\bOR\b", where, re.IGNORECASE) is not None
+
+    leading_columns = {columns[0] for columns in existing_indexes(conn, table).values() if columns}
+    leading_columns.add("id")  # The integer primary key is the rowid
+
+    indexable = []  # (column, is equality)
+    for column, operator, value in terms:
+        if operator.upper() == "LIKE":
+            if value.startswith("'%") or value == "?":
+                notes.append(f"{column} LIKE with a leading % can never use an index.")
+                if uses_or:
+                    # With OR, one unindexable term means the whole table has to be read anyway
+                    notes.append("The terms are joined with OR, so this search will always scan.")
+                    return [], notes
+                continue
+            indexable.append((column, True))
+        else:
+            indexable.append((column, operator == "="))
+
+    if not indexable:
+        return [], notes
+
+    if uses_or:
+        # sqlite can answer an OR from several indexes, but only if every term has one
+        for column, equality in indexable:
+            if column not in leading_columns:
+                suggestions.append(f"CREATE INDEX {table}_{column}_index ON {table} ({column})")
+                leading_columns.add(column)
+    else:
+        if any(column in leading_columns for column, equality in indexable):
+            return [], notes
+
+        # Equality columns first, then at most one range column
+        columns = [column for column, equality in indexable if equality]
+        ranges = [column for column, equality in indexable if not equality]
+        columns += ranges[:1]
+        suggestions.append(f"CREATE INDEX {table}_{'_'.join(columns)}_index ON {table} ({', '.join(columns)})")
+
+    return sorted(set(suggestions)), notes
+
+
+def analyse_query(conn, sql: str, params=()) -> dict:
+    """Explain a query, and if it scans, suggest indexes and check the plan with them in place"""
+    plan = explain(conn, sql, params)
+    scans = scanned_tables(plan)
+
+    result = {"query": sql, "plan": plan, "uses": "scan" if scans else "index", "scanned_tables": scans,
+              "suggestions": [], "notes": [], "uses_with_suggestions": None}
+
+    if not scans:
+        return result
+
+    suggestions, notes = suggest_indexes(conn, sql)
+    result["suggestions"] = suggestions
+    result["notes"] = notes
+
+    if suggestions:
+        # Try the indexes inside a transaction and roll them back, sqlite DDL is transactional
+        conn.execute("SAVEPOINT try_indexes")
+        try:
+            for statement in suggestions:
+                conn.execute(statement)
+            after = scanned_tables(explain(conn, sql, params))
+            result["uses_with_suggestions"] = "scan" if after else "index"
+        finally:
+            conn.execute("ROLLBACK TO try_indexes")
+            conn.execute("RELEASE try_indexes")
+
+    return result
+
+
+def build_search(connection: Connection, table: str, fields, exact: bool = True,
+                 must_include_all: bool = False) -> str:
+    """Build the same SQL the search functions would for the given fields"""
+    if table == "customers":
+        values = {field: CUSTOMER_FIELDS[field] for field in fields}
+        return connection.build_customers_query(must_include_all=must_include_all, exact=exact, **values)
+    elif table == "accounts":
+        values = {field: ACCOUNT_FIELDS[field] for field in fields}
+        return connection.build_accounts_query(must_include_all=must_include_all, exact_fields=exact, **values)
+    raise ValueError(f"Unknown table: {table}")
+
+
+def analyse_search(db_filepath: str, table: str, fields, exact: bool = True, must_include_all: bool = False) -> dict:
+    """Analyse one search form combination"""
+    connection = Connection(db_filepath=db_filepath)
+    try:
+        result = analyse_query(connection.conn, build_search(connection, table, fields, exact, must_include_all))
+        result.update({"table": table, "fields": list(fields), "exact": exact, "must_include_all": must_include_all})
+        return result
+    finally:
+        connection.close_connection()
+
+
+def analyse_combinations(db_filepath: str, tables=("customers", "accounts"), max_fields: int = 2) -> list:
+    """Analyse every combination of up to max_fields search fields, exact and LIKE, AND and OR"""
+    connection = Connection(db_filepath=db_filepath)
+    results = []
+    try:
+        for table in tables:
+            all_fields = CUSTOMER_FIELDS if table == "customers" else ACCOUNT_FIELDS
+            for count in range(1, max_fields + 1):
+                for fields in itertools.combinations(all_fields, count):
+                    # Only try LIKE if it changes the query
+                    for exact in ((True, False) if LIKE_FIELDS.intersection(fields) else (True,)):
+                        for must_include_all in ((False, True) if count > 1 else (False,)):
+                            sql = build_search(connection, table, fields, exact, must_include_all)
+                            result = analyse_query(connection.conn, sql)
+                            result.update({"table": table, "fields": list(fields), "exact": exact,
+                                           "must_include_all": must_include_all})
+                            results.append(result)
+    finally:
+        connection.close_connection()
+    return results
+
+
+def is_analysable(sql: str) -> bool:
+    """Only plain SELECTs of the bank's tables are worth checking, not PRAGMAs, DDL or sqlite's own tables"""
+    match = TABLE_REGEX.search(sql)
+    return sql.lstrip().upper().startswith("SELECT") and not (match and match.group(1).startswith("sqlite_"))
+
+
+def analyse_workload(db_filepath: str, workload_path: str) -> list:
+    """Analyse each query shape in a recorded workload or slow query log (JSON lines with the shape, and the sql and
+    params if values were logged). A shape on its own is explained with NULL for each ?, which gives the same plan.
+    A query that can't be explained (e.g. its table doesn't exist in this database) gets an error result rather
+    than stopping the run."""
+    connection = Connection(db_filepath=db_filepath)
+    results = []
+    seen = set()
+    try:
+        with open(workload_path) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["shape"] in seen or not is_analysable(entry["shape"]):
+                    continue
+                seen.add(entry["shape"])
+
+                # Older logs have the shape with the literals taken out of it as its params
+                sql = entry.get("sql", entry["shape"])
+                params = entry.get("params")
+                if params is None:
+                    params = [None] * sql.count("?")
+                try:
+                    results.append(analyse_query(connection.conn, sql, params))
+                except sqlite3.Error as e:
+                    results.append({"query": sql, "plan": [], "uses": "error", "error": str(e),
+                                    "scanned_tables": [], "suggestions": [], "notes": [],
+                                    "uses_with_suggestions": None})
+    finally:
+        connection.close_connection()
+    return results
+
+
+def record_workload(filepath: str, values: bool = False):
+    """Append every query run through Connection to a workload file for analyse_workload, only the shapes unless
+    values is set (which switches on the instrumentation's log_values). Returns the listener so it can be
+    unsubscribed."""
+    from query_stats import instrumentation
+
+    lock = threading.Lock()
+
+    def listener(event):
+        entry = {key: event[key] for key in ("shape", "sql", "params") if key in event}
+        with lock, open(filepath, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    instrumentation.subscribe(listener)
+    instrumentation.enable(log_values=True if values else None)
+    return listener
+
+
+def summarise(results: list) -> str:
+    """Text report, scans first"""
+    lines = []
+    scans = [result for result in results if result["uses"] == "scan"]
+    errors = [result for result in results if result["uses"] == "error"]
+    lines.append(f"{len(results)} queries checked, {len(scans)} scan a whole table"
+                 f"{f', {len(errors)} could not be checked' if errors else ''}.\n")
+
+    for result in scans + errors + [result for result in results if result["uses"] not in ("scan", "error")]:
+        if "fields" in result:
+            label = f"{result['table']} by {', '.join(result['fields'])} " \
+                    f"({'exact' if result['exact'] else 'LIKE'}, {'AND' if result['must_include_all'] else 'OR'})"
+        else:
+            label = result["query"]
+        lines.append(f"[{result['uses'].upper()}] {label}")
+        if result["uses"] == "error":
+            lines.append(f"    error: {result['error']}")
+
+        if result["uses"] == "scan":
+            for detail in result["plan"]:
+                lines.append(f"    plan: {detail}")
+            for note in result["notes"]:
+                lines.append(f"    note: {note}")
+            for suggestion in result["suggestions"]:
+                lines.append(f"    suggest: {suggestion};")
+            if result["uses_with_suggestions"] is not None:
+                lines.append(f"    with suggestions: {result['uses_with_suggestions']}")
+
+    # All the distinct suggestions at the end so they can be copied
+    suggestions = sorted({suggestion for result in results for suggestion in result["suggestions"]})
+    if suggestions:
+        lines.append("\nSuggested indexes:")
+        for suggestion in suggestions:
+            lines.append(f"{suggestion};")
+
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check which searches use indexes and which scan.")
+    parser.add_argument("--db", default="Files/Data/data.db")
+    parser.add_argument("--json", action="store_true", help="Print the full results as JSON.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = commands.add_parser("search", help="Check one search combination.")
+    search_parser.add_argument("table", choices=["customers", "accounts"])
+    search_parser.add_argument("fields", help="Comma separated fields, e.g. fname,lname or cust_id,balance")
+    search_parser.add_argument("--like", action="store_true", help="Use LIKE instead of exact matches.")
+    search_parser.add_argument("--all", action="store_true", help="Fields must all match (AND instead of OR).")
+
+    combinations_parser = commands.add_parser("combinations", help="Check every search combination.")
+    combinations_parser.add_argument("--max-fields", type=int, default=2)
+    combinations_parser.add_argument("--table", choices=["customers", "accounts"], default=None)
+
+    workload_parser = commands.add_parser("workload", help="Check the queries in a workload or slow query log.")
+    workload_parser.add_argument("log")
+
+    args = parser.parse_args()
+
+    if args.command == "search":
+        results = [analyse_search(args.db, args.table, args.fields.split(","), not args.like, args.all)]
+    elif args.command == "combinations":
+        tables = (args.table,) if args.table else ("customers", "accounts")
+        results = analyse_combinations(args.db, tables, args.max_fields)
+    else:
+        results = analyse_workload(args.db, args.log)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(summarise(results))
+
+
+if __name__ == "__main__":
+    main()
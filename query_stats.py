@@ -0,0 +1,188 @@
+import json
+import os
+import re
+import threading
+from collections import deque
+from time import perf_counter, time
+
+# Upper bounds (ms) of the timing histogram buckets, anything slower goes into the last (+Inf) bucket
+HISTOGRAM_BUCKETS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000]
+
+DEFAULT_SLOW_THRESHOLD = 100  # ms
+SLOW_LOG_SIZE = 200  # Number of slow queries kept in memory
+
+# Matches the literal values put into the queries: 'strings' (with '' escapes) and numbers
+LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+SPACE_REGEX = re.compile(r"\s+")
+# Queries of the admins table carry password hashes, their values are never logged
+REDACTED_TABLES_REGEX = re.compile(r"\badmins\b", re.IGNORECASE)
+
+
+def normalize_sql(sql: str) -> tuple:
+    """Replace the literals in a query with ? so queries of the same shape group together.
+    Returns (shape, list of the literals)"""
+    params = []
+
+    def replace(match):
+        value = match.group(0)
+        if value.startswith("'"):
+            params.append(value[1:-1].replace("''", "'"))
+        elif "." in value:
+            params.append(float(value))
+        else:
+            params.append(int(value))
+        return "?"
+
+    shape = LITERAL_REGEX.sub(replace, sql)
+    return SPACE_REGEX.sub(" ", shape).strip(), params
+
+
+class QueryInstrumentation:
+    """Collects timings for the queries run through Connection.
+    Disabled by default, when disabled the connection only checks the enabled attribute.
+    Only the shapes of the queries are logged unless log_values is set, the SQL holds customer details."""
+    def __init__(self, enabled: bool = False, slow_threshold: float = DEFAULT_SLOW_THRESHOLD,
+                 slow_log_path: str = None, log_values: bool = False):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold  # ms
+        self.slow_log_path = slow_log_path
+        self.log_values = log_values
+
+        # shape -> {"count", "errors", "total_ms", "max_ms", "rows", "buckets"}
+        self.stats = {}
+        self.slow_queries = deque(maxlen=SLOW_LOG_SIZE)
+
+        # Functions called with every query event, see subscribe()
+        self.listeners = []
+
+        self.lock = threading.Lock()
+
+    def enable(self, slow_threshold: float = None, slow_log_path: str = None, log_values: bool = None):
+        """Start collecting"""
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if slow_log_path is not None:
+            self.slow_log_path = slow_log_path
+        if log_values is not None:
+            self.log_values = log_values
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting, the stats so far are kept"""
+        self.enabled = False
+
+    def reset(self):
+        """Clear all the collected stats"""
+        with self.lock:
+            self.stats = {}
+            self.slow_queries.clear()
+
+    def subscribe(self, listener):
+        """Call listener(event) after every query. The event is a dict with the keys shape, duration_ms, rows and
+        error. With log_values on (and not for the admins table) it also has sql, params (the values bound to the
+        query's ? placeholders) and literals (the values written into the SQL, which are ? in the shape).
+        Listeners must be quick and thread safe."""
+        with self.lock:
+            self.listeners = self.listeners + [listener]
+
+    def unsubscribe(self, listener):
+        """Stop calling a listener"""
+        with self.lock:
+            self.listeners = [other for other in self.listeners if other is not listener]
+
+    @staticmethod
+    def start() -> float:
+        """Timestamp to pass back to record()"""
+        return perf_counter()
+
+    def record(self, sql: str, start: float, rows: int = None, error: str = None, params=()):
+        """Record a finished query, params being the values bound to it"""
+        duration = (perf_counter() - start) * 1000
+        shape, literals = normalize_sql(sql)
+
+        bucket = len(HISTOGRAM_BUCKETS)
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if duration <= bound:
+                bucket = index
+                break
+
+        with self.lock:
+            stat = self.stats.get(shape)
+            if stat is None:
+                stat = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                        "buckets": [0] * (len(HISTOGRAM_BUCKETS) + 1)}
+                self.stats[shape] = stat
+
+            stat["count"] += 1
+            stat["total_ms"] += duration
+            stat["max_ms"] = max(stat["max_ms"], duration)
+            stat["buckets"][bucket] += 1
+            if rows is not None:
+                stat["rows"] += rows
+            if error is not None:
+                stat["errors"] += 1
+
+            listeners = self.listeners
+
+        event = {"shape": shape, "duration_ms": duration, "rows": rows, "error": error}
+        if self.log_values and not REDACTED_TABLES_REGEX.search(shape):
+            event.update(sql=sql, params=list(params), literals=literals)
+
+        if duration >= self.slow_threshold:
+            self.log_slow_query(event)
+
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"Query listener failed: {str(e)}")
+
+    def log_slow_query(self, event: dict):
+        """Keep a slow query in memory and write it to the slow log file if one is set"""
+        entry = {"time": time(), "shape": event["shape"], "duration_ms": round(event["duration_ms"], 3),
+                 "rows": event["rows"], "error": event["error"]}
+        # With log_values the SQL is kept as well, so the query can be run again with its bound params
+        for key in ("sql", "params", "literals"):
+            if key in event:
+                entry[key] = event[key]
+        self.slow_queries.append(entry)
+
+        if self.slow_log_path is not None:
+            try:
+                with self.lock, open(self.slow_log_path, "a") as file:
+                    file.write(json.dumps(entry) + "\n")
+            except OSError as e:
+                print(f"Could not write to the slow query log. Reason: {str(e)}")
+
+    def snapshot(self) -> dict:
+        """Return a copy of the stats for every query shape, with the mean added"""
+        with self.lock:
+            data = {}
+            for shape, stat in self.stats.items():
+                data[shape] = dict(stat, buckets=list(stat["buckets"]),
+                                   mean_ms=stat["total_ms"] / stat["count"] if stat["count"] else 0.0)
+            return data
+
+    def report(self, top: int = 20) -> str:
+        """Text table of the query shapes that took the most total time"""
+        lines = [f"{'count':>8} {'total ms':>12} {'mean ms':>10} {'max ms':>10} {'rows':>10}  query"]
+        stats = sorted(self.snapshot().items(), key=lambda item: item[1]["total_ms"], reverse=True)
+        for shape, stat in stats[:top]:
+            lines.append(f"{stat['count']:>8} {stat['total_ms']:>12.2f} {stat['mean_ms']:>10.3f} "
+                         f"{stat['max_ms']:>10.3f} {stat['rows']:>10}  {shape}")
+        return "\n".join(lines)
+
+
+# Shared by every Connection. Can be switched on with the BANK_QUERY_STATS environment variable,
+# BANK_SLOW_QUERY_MS and BANK_SLOW_QUERY_LOG set the threshold and log file, and BANK_QUERY_LOG_VALUES opts in to
+# logging the SQL and values of the queries as well as their shapes.
+instrumentation = QueryInstrumentation(enabled=os.environ.get("BANK_QUERY_STATS", "") not in ("", "0"),
+                                       slow_threshold=float(os.environ.get("BANK_SLOW_QUERY_MS",
+                                                                           DEFAULT_SLOW_THRESHOLD)),
+                                       slow_log_path=os.environ.get("BANK_SLOW_QUERY_LOG"),
+                                       log_values=os.environ.get("BANK_QUERY_LOG_VALUES", "") not in ("", "0"))
+
+
+if __name__ == "__main__":
+    print("Module Only use")
+    exit()
@@ -0,0 +1,120 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from metrics import metrics
+
+DEFAULT_MAX_ENTRIES = 256
+
+
+class ReportCache:
+    """Keeps the results of reports until the data they were made from changes.
+    Each result is stored with the data version (see Connection.get_data_version) it was worked out at and is
+    returned while the version is the same. With max_staleness > 0 a result up to that many seconds old is also
+    returned after the data has changed, so reports aren't redone after every write when there are lots of them.
+    Results are shared, callers must not change them."""
+    def __init__(self, enabled: bool = True, max_staleness: float = 0.0, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.enabled = enabled
+        self.max_staleness = max_staleness
+        self.max_entries = max_entries
+
+        # key -> (version, time worked out, result), oldest used first
+        self.entries = OrderedDict()
+        # key -> lock, so a report that many threads ask for at once is only worked out once
+        self.key_locks = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    def enable(self, max_staleness: float = None):
+        """Start caching"""
+        if max_staleness is not None:
+            self.max_staleness = max_staleness
+        self.enabled = True
+
+    def disable(self):
+        """Stop caching and drop the cached results"""
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        """Drop all the cached results"""
+        with self.lock:
+            self.entries = OrderedDict()
+
+    def lookup(self, key, version):
+        """Return the cached result for the key if it can still be used, otherwise None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            cached_version, created, result = entry
+            if cached_version == version:
+                self.hits += 1
+            elif self.max_staleness > 0 and monotonic() - created <= self.max_staleness:
+                self.stale_hits += 1
+            else:
+                return None
+
+            self.entries.move_to_end(key)
+            return result
+
+    def get(self, key, version, compute):
+        """Return the cached result for the key at this data version, calling compute() to make it if needed.
+        A version of None means the data version is unknown, so nothing is cached."""
+        if not self.enabled or version is None:
+            return compute()
+
+        result = self.lookup(key, version)
+        if result is not None:
+            return result
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another thread may have worked it out while this one waited
+            result = self.lookup(key, version)
+            if result is not None:
+                return result
+
+            with self.lock:
+                self.misses += 1
+
+            result = compute()
+
+            with self.lock:
+                self.entries[key] = (version, monotonic(), result)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    old_key, old_entry = self.entries.popitem(last=False)
+                    self.key_locks.pop(old_key, None)
+
+        return result
+
+    def collect_metrics(self) -> list:
+        """Cache numbers for the metrics registry"""
+        with self.lock:
+            lookups = [({"result": "hit"}, self.hits), ({"result": "stale_hit"}, self.stale_hits),
+                       ({"result": "miss"}, self.misses)]
+            size = len(self.entries)
+
+        return [("bank_report_cache_lookups_total", "counter", "Report cache lookups by result.", lookups),
+                ("bank_report_cache_entries", "gauge", "Reports held in the cache.", [({}, size)])]
+
+
+# Shared by every BankingSystem. Can be set up with environment variables:
+#   BANK_REPORT_CACHE=0 to switch it off, BANK_REPORT_CACHE_STALE=<seconds> to allow stale results
+report_cache = ReportCache(enabled=os.environ.get("BANK_REPORT_CACHE", "1") != "0",
+                           max_staleness=float(os.environ.get("BANK_REPORT_CACHE_STALE", 0)))
+metrics.add_collector(report_cache.collect_metrics)
+
+
+if __name__ == "__main__":
+    print("Module Only use")
+    exit()
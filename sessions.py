@@ -0,0 +1,97 @@
+import hmac
+import hashlib
+import secrets
+import threading
+from time import time
+
+# How long a session token is valid for (seconds) after it was last used
+SESSION_LIFETIME = 30 * 60
+
+
+class SessionManager:
+    """Issues and checks signed, expiring session tokens for logged in admins"""
+    def __init__(self, secret: bytes = None, lifetime: int = SESSION_LIFETIME):
+        # Tokens are signed with this so they cannot be forged, a new secret invalidates all old tokens
+        if secret is None:
+            secret = secrets.token_bytes(32)
+        self.secret = secret
+
+        self.lifetime = lifetime
+
+        # session id -> [admin, expiry time]
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def __sign(self, session_id: str) -> str:
+        """Create the signature for a session id"""
+        return hmac.new(self.secret, session_id.encode('ascii'), hashlib.sha256).hexdigest()
+
+    def issue(self, admin) -> str:
+        """Create a new session for the admin and return its token"""
+        session_id = secrets.token_hex(16)
+
+        with self.lock:
+            self.__prune()
+            self.sessions[session_id] = [admin, time() + self.lifetime]
+
+        return f"{session_id}.{self.__sign(session_id)}"
+
+    def get_admin(self, token: str):
+        """Return the admin the token belongs to, or None if the token is invalid or has expired"""
+        if not isinstance(token, str) or token.count(".") != 1:
+            return None
+
+        session_id, signature = token.split(".")
+
+        # Check the token was made by us before looking it up
+        if not hmac.compare_digest(signature, self.__sign(session_id)):
+            return None
+
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+
+            admin, expires = session
+            if expires < time():
+                del self.sessions[session_id]
+                return None
+
+            # Sliding expiry, using the session keeps it alive
+            session[1] = time() + self.lifetime
+
+        return admin
+
+    def update_admin(self, token: str, admin):
+        """Replace the admin stored against a session, e.g after their details were changed"""
+        session_id = token.split(".")[0]
+
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions[session_id][0] = admin
+
+    def revoke(self, token: str) -> bool:
+        """End a session"""
+        if self.get_admin(token) is None:
+            return False
+
+        with self.lock:
+            self.sessions.pop(token.split(".")[0], None)
+        return True
+
+    def active_sessions(self) -> int:
+        """Returns the number of sessions that have not expired"""
+        with self.lock:
+            self.__prune()
+            return len(self.sessions)
+
+    def __prune(self):
+        """Remove expired sessions, lock must be held by the caller"""
+        now = time()
+        for session_id in [sid for sid, (admin, expires) in self.sessions.items() if expires < now]:
+            del self.sessions[session_id]
+
+
+if __name__ == "__main__":
+    print("Module Only use")
+    exit()
@@ -1,5 +1,7 @@
 import os
 from time import time
+from connection import LEDGER_SQL, IDEMPOTENCY_SQL, INTEREST_SQL, STATS_SQL, OVERDRAWN_INDEX_SQL, \
+    CUSTOMER_INDEX_SQL, EXTREMES_INDEX_SQL, GEO_SQL, IMPORT_SQL
 FILE_NAME = "data.db"
 FILE_PATH = "Files/Data/"
 
@@ -46,7 +48,8 @@ SETUP_SQL = ["""create table admins
     overdraft_limit int  default 0 not null
 );""", """create unique index accounts_account_number_uindex
     on accounts (account_number);"""
-]
+] + LEDGER_SQL + IDEMPOTENCY_SQL + INTEREST_SQL + STATS_SQL + OVERDRAWN_INDEX_SQL + CUSTOMER_INDEX_SQL + \
+    EXTREMES_INDEX_SQL + GEO_SQL + IMPORT_SQL
 
 def move_old_db():
     try:
@@ -55,11 +58,11 @@ def move_old_db():
     except Exception as e:
         print(f"Could not move file. Reason: {str(e)}")
 
-def setup_tables():
+def setup_tables(db_filepath=FILE_PATH + FILE_NAME):
     """Set up the tables of the database"""
     import connection
 
-    conn = connection.Connection(db_filepath=FILE_PATH + FILE_NAME, mode="setup")
+    conn = connection.Connection(db_filepath=db_filepath, mode="setup")
     for query in SETUP_SQL:
         stat, reply = conn.query(query)
         if stat: print(f"Successfully ran query: \n{query}")
@@ -69,11 +72,11 @@ def setup_tables():
     conn.close_connection()
 
 
-def setup_admins():
+def setup_admins(db_filepath=FILE_PATH + FILE_NAME):
     """Set up some default admin accounts"""
     import connection
     import bank
-    conn = connection.Connection(db_filepath=FILE_PATH + FILE_NAME)
+    conn = connection.Connection(db_filepath=db_filepath)
 
     conn.create_admin_account('Preston', "Garvery", ['The Castle', '', '', 'Boston', 'MA5 SCH'],
                               'admin1', bank.BankingSystem.hash_password('hunter2'), True)
@@ -84,12 +87,12 @@ def setup_admins():
     conn.close_connection()
 
 
-def setup_users():
+def setup_users(db_filepath=FILE_PATH + FILE_NAME):
     import bank
 
     cids = []
 
-    system = bank.BankingSystem(db_filepath=FILE_PATH + FILE_NAME)
+    system = bank.BankingSystem(db_filepath=db_filepath)
     system.login('admin1', 'hunter2')
 
     stat, reply, cid = system.create_new_customer('John', 'Smith', ['Birmingham City University', 'Curzon', '', 'Birmingham', 'B4 123'])
@@ -121,10 +124,10 @@ def setup_users():
     return cids
 
 
-def setup_accounts(cid1, cid2, cid3):
+def setup_accounts(cid1, cid2, cid3, db_filepath=FILE_PATH + FILE_NAME):
     import bank
 
-    system = bank.BankingSystem(db_filepath=FILE_PATH + FILE_NAME)
+    system = bank.BankingSystem(db_filepath=db_filepath)
     system.login('admin1', 'hunter2')
 
     # Customer 1
@@ -155,24 +158,203 @@ def setup_accounts(cid1, cid2, cid3):
     else: print(f"Failed to create account. Reason: {reply}")
 
 
+# Synthetic data generation
+# Name lists are roughly in order of how common they are, picks are Zipf weighted so the first names are the most used
+GEN_FIRST_NAMES = ["Oliver", "Olivia", "George", "Amelia", "Harry", "Isla", "Jack", "Ava", "Jacob", "Emily",
+                   "Noah", "Sophia", "Charlie", "Grace", "Muhammad", "Mia", "Thomas", "Poppy", "Oscar", "Ella",
+                   "William", "Lily", "James", "Evie", "Leo", "Isabella", "Alfie", "Sophie", "Henry", "Ivy",
+                   "Joshua", "Freya", "Freddie", "Harper", "Archie", "Willow", "Ethan", "Charlotte", "Isaac", "Jessica",
+                   "Alexander", "Rosie", "Joseph", "Daisy", "Edward", "Alice", "Samuel", "Sienna", "Max", "Matilda"]
+GEN_LAST_NAMES = ["Smith", "Jones", "Williams", "Taylor", "Brown", "Davies", "Evans", "Wilson", "Thomas", "Johnson",
+                  "Roberts", "Robinson", "Thompson", "Wright", "Walker", "White", "Edwards", "Hughes", "Green", "Hall",
+                  "Lewis", "Harris", "Clarke", "Patel", "Jackson", "Wood", "Turner", "Martin", "Cooper", "Hill",
+                  "Ward", "Morris", "Moore", "Clark", "Lee", "King", "Baker", "Harrison", "Morgan", "Allen",
+                  "James", "Scott", "Phillips", "Watson", "Davis", "Parker", "Price", "Bennett", "Young", "Griffiths",
+                  "Mitchell", "Kelly", "Cook", "Carter", "Richardson", "Bailey", "Collins", "Bell", "Shaw", "Murphy",
+                  "Khan", "Ali", "Singh", "Begum", "Hussain", "Ahmed", "Shah", "Kaur", "Rahman", "Chen"]
+GEN_STREETS = ["High Street", "Station Road", "Main Street", "Park Road", "Church Road", "Church Street",
+               "London Road", "Victoria Road", "Green Lane", "Manor Road", "Church Lane", "Park Avenue",
+               "The Avenue", "The Crescent", "Queens Road", "New Road", "Grange Road", "Kings Road"]
+# (city, postcode area) in rough order of size
+GEN_CITIES = [("London", "E"), ("Birmingham", "B"), ("Manchester", "M"), ("Leeds", "LS"), ("Glasgow", "G"),
+              ("Liverpool", "L"), ("Bristol", "BS"), ("Sheffield", "S"), ("Edinburgh", "EH"), ("Cardiff", "CF"),
+              ("Leicester", "LE"), ("Nottingham", "NG"), ("Newcastle", "NE"), ("Coventry", "CV"),
+              ("Bradford", "BD"), ("Belfast", "BT"), ("Brighton", "BN"), ("Plymouth", "PL"), ("Norwich", "NR"),
+              ("York", "YO")]
+# (account name, weight, chance of an overdraft facility, interest rates to pick from)
+GEN_ACCOUNT_TYPES = [("Current Account", 55, 0.6, [0.0, 0.1, 0.5, 1.0, 1.3]),
+                     ("Savings Account", 25, 0.0, [1.2, 1.5, 1.7, 2.0, 2.25]),
+                     ("ISA", 15, 0.0, [2.0, 2.5, 2.75, 3.0]),
+                     ("Business Account", 5, 0.8, [0.0, 0.25, 0.5])]
+GEN_OVERDRAFT_LIMITS = [10000, 25000, 50000, 100000, 250000, 500000]  # In pence
+GEN_ACCOUNT_NUMBER_BASE = 1000000000000000
+GEN_ACCOUNT_NUMBER_RANGE = 9000000000000000
+# Coprime with the range, so (i * step) mod range gives a unique, scattered number for every i
+GEN_ACCOUNT_NUMBER_STEP = 5915587277
+
+
+def zipf_weights(count: int, exponent: float = 1.0) -> list:
+    """Cumulative Zipf weights for picking from a list of the given length with random.choices"""
+    weights = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1 / rank ** exponent
+        weights.append(total)
+    return weights
+
+
+def generate_data(db_filepath=FILE_PATH + FILE_NAME, customers: int = 1000, accounts: int = 2000, seed: int = 0,
+                  batch_size: int = 50000, progress: bool = True):
+    """Bulk insert generated customers and accounts into an empty database in a single transaction.
+    The same seed always gives the same data."""
+    import sqlite3
+    import random
+
+    rand = random.Random(seed)
+
+    conn = sqlite3.connect(db_filepath)
+    # The whole thing is one transaction on a fresh file, if it fails it just needs running again
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+
+    first_weights = zipf_weights(len(GEN_FIRST_NAMES))
+    last_weights = zipf_weights(len(GEN_LAST_NAMES))
+    street_weights = zipf_weights(len(GEN_STREETS))
+    city_weights = zipf_weights(len(GEN_CITIES), 0.8)
+
+    # Households share postcodes, roughly 15 customers per postcode
+    postcodes = []
+    for n in range(max(1, customers // 15)):
+        city, area = rand.choices(GEN_CITIES, cum_weights=city_weights)[0]
+        postcodes.append((city, f"{area}{rand.randint(1, 30)} {rand.randint(1, 9)}"
+                                f"{rand.choice('ABDEFGHJLNPQRSTUWXYZ')}{rand.choice('ABDEFGHJLNPQRSTUWXYZ')}"))
+
+    def customer_rows(start, count):
+        firsts = rand.choices(GEN_FIRST_NAMES, cum_weights=first_weights, k=count)
+        lasts = rand.choices(GEN_LAST_NAMES, cum_weights=last_weights, k=count)
+        streets = rand.choices(GEN_STREETS, cum_weights=street_weights, k=count)
+        places = rand.choices(postcodes, k=count)
+        return [(start + n, firsts[n], lasts[n], f"{rand.randint(1, 250)} {streets[n]}", "", "",
+                 places[n][0], places[n][1]) for n in range(count)]
+
+    type_weights = [account_type[1] for account_type in GEN_ACCOUNT_TYPES]
+
+    def account_rows(start, count):
+        types = rand.choices(GEN_ACCOUNT_TYPES, weights=type_weights, k=count)
+        rows = []
+        for n in range(count):
+            index = start + n
+            name, weight, overdraft_chance, rates = types[n]
+
+            # Every customer gets one account, the rest go to random customers
+            if index <= customers:
+                cid = index
+            else:
+                cid = rand.randint(1, customers)
+
+            account_num = GEN_ACCOUNT_NUMBER_BASE + (index * GEN_ACCOUNT_NUMBER_STEP) % GEN_ACCOUNT_NUMBER_RANGE
+
+            # Balances are heavily skewed, most are small with a long tail of large ones (pence)
+            balance = int(rand.lognormvariate(11, 1.6))
+
+            overdraft = 0
+            if rand.random() < overdraft_chance:
+                overdraft = rand.choice(GEN_OVERDRAFT_LIMITS)
+                # Some accounts with a facility are using it
+                if rand.random() < 0.2:
+                    balance = -rand.randint(1, overdraft)
+
+            rows.append((index, cid, name, account_num, balance, rand.choice(rates), overdraft))
+        return rows
+
+    for start in range(1, customers + 1, batch_size):
+        count = min(batch_size, customers - start + 1)
+        conn.executemany("INSERT INTO customers (id, first_name, last_name, address_line1, address_line2, "
+                         "address_line3, address_city, address_postcode) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         customer_rows(start, count))
+        if progress:
+            print(f"Generated {start + count - 1} of {customers} customers.")
+
+    for start in range(1, accounts + 1, batch_size):
+        count = min(batch_size, accounts - start + 1)
+        conn.executemany("INSERT INTO accounts (id, customer_id, account_name, account_number, balance, "
+                         "interest_rate, overdraft_limit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         account_rows(start, count))
+        if progress:
+            print(f"Generated {start + count - 1} of {accounts} accounts.")
+
+    conn.commit()
+    conn.close()
+
+
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Set up the banking system database.")
+    parser.add_argument("--generate", nargs=2, type=int, metavar=("CUSTOMERS", "ACCOUNTS"), default=None,
+                        help="Fill the new database with generated customers and accounts instead of the defaults.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated data.")
+    parser.add_argument("--db", default=FILE_PATH + FILE_NAME, help="Database file to create.")
+    parser.add_argument("--rebuild-stats", action="store_true",
+                        help="Work out the bank_stats and geo_stats totals of an existing database again, then stop.")
+    parser.add_argument("--verify-stats", action="store_true",
+                        help="Check the bank_stats and geo_stats totals of an existing database against its tables, "
+                             "then stop.")
+    args = parser.parse_args()
+    if args.generate is not None:
+        if min(args.generate) < 0:
+            parser.error("--generate: CUSTOMERS and ACCOUNTS can't be negative")
+        if args.generate[0] == 0 and args.generate[1] > 0:
+            parser.error("--generate: accounts need customers to belong to, CUSTOMERS must be more than 0")
+
+    if args.rebuild_stats or args.verify_stats:
+        import connection
+
+        conn = connection.Connection(db_filepath=args.db)
+        all_ok = True
+        if args.rebuild_stats:
+            for rebuild in (conn.rebuild_bank_stats, conn.rebuild_geo_stats):
+                stat, reply = rebuild()
+                print(reply)
+                all_ok = all_ok and stat
+        else:
+            for verify in (conn.verify_bank_stats, conn.verify_geo_stats):
+                stat, reply, differences = verify()
+                print(reply)
+                for field, (stored, actual) in differences.items():
+                    print(f"{field}: stored {stored}, actual {actual}")
+                all_ok = all_ok and stat
+        conn.close_connection()
+        exit(0 if all_ok else 1)
+
     print("Moving original DB.")
-    move_old_db()
+    if args.db == FILE_PATH + FILE_NAME:
+        move_old_db()
+    elif os.path.exists(args.db):
+        os.remove(args.db)
     print("Completed.\n")
 
     print("Setting up new database tables.")
-    setup_tables()
+    setup_tables(args.db)
     print("Completed.\n")
 
     print("Setting up default admin accounts.")
-    setup_admins()
+    setup_admins(args.db)
     print("Completed.\n")
 
+    if args.generate is not None:
+        print("Generating customers and accounts.")
+        start = time()
+        generate_data(args.db, args.generate[0], args.generate[1], args.seed)
+        print(f"Completed in {round(time() - start, 1)}s.\n")
+        exit()
+
     print("Setting up default users.")
-    cids = setup_users()
+    cids = setup_users(args.db)
     print("Completed.\n")
 
     print("Setting up accounts.")
-    setup_accounts(cids[0], cids[1], cids[2])
+    setup_accounts(cids[0], cids[1], cids[2], args.db)
     print("Completed.\n")
 